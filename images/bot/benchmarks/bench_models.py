@@ -0,0 +1,133 @@
+# Compare decoding GitHub API responses with yaml.safe_load (the bot's former parser)
+# against json.loads + the slot-based models.
+#
+# Usage: python benchmarks/bench_models.py [repeats]
+# The payloads are synthetic but follow the layout (and roughly the size) of real
+# bioconda-recipes responses: a page of 100 PRs and a ~300 KB toJson(github) job context.
+import json
+import sys
+from timeit import timeit
+
+from bioconda_bot.models import JobContext, PullRequest
+
+try:
+    from yaml import safe_load
+except ImportError:
+    safe_load = None
+
+
+def user(i: int) -> dict:
+    return {
+        "login": f"user{i}",
+        "id": 1000 + i,
+        "node_id": f"MDQ6VXNlcj{i:08d}",
+        "avatar_url": f"https://avatars.githubusercontent.com/u/{1000 + i}?v=4",
+        "url": f"https://api.github.com/users/user{i}",
+        "html_url": f"https://github.com/user{i}",
+        "type": "User",
+        "site_admin": False,
+    }
+
+
+def repo(i: int, owner: str) -> dict:
+    return {
+        "id": 42000000 + i,
+        "name": "bioconda-recipes",
+        "full_name": f"{owner}/bioconda-recipes",
+        "private": False,
+        "owner": user(i),
+        "html_url": f"https://github.com/{owner}/bioconda-recipes",
+        "description": "Conda recipes for the bioconda channel.",
+        "fork": owner != "bioconda",
+        **{f"{name}_url": f"https://api.github.com/repos/{owner}/bioconda-recipes/{name}" for name in (
+            "forks", "keys", "collaborators", "teams", "hooks", "issue_events", "events",
+            "assignees", "branches", "tags", "blobs", "git_tags", "git_refs", "trees",
+            "statuses", "languages", "stargazers", "contributors", "subscribers",
+            "subscription", "commits", "git_commits", "comments", "issue_comment",
+            "contents", "compare", "merges", "archive", "downloads", "issues", "pulls",
+            "milestones", "notifications", "labels", "releases", "deployments",
+        )},
+        "created_at": "2015-09-10T12:00:00Z",
+        "updated_at": "2026-10-01T12:00:00Z",
+        "pushed_at": "2026-10-01T12:00:00Z",
+        "size": 250000,
+        "stargazers_count": 1500,
+        "default_branch": "master",
+    }
+
+
+def pull_request(i: int) -> dict:
+    owner = f"user{i}"
+    return {
+        "url": f"https://api.github.com/repos/bioconda/bioconda-recipes/pulls/{50000 + i}",
+        "id": 1500000000 + i,
+        "number": 50000 + i,
+        "state": "open",
+        "locked": False,
+        "title": f"Update recipe-{i} to 1.{i}.0",
+        "user": user(i),
+        "body": "Describe your pull request here\n\n" * 20,
+        "labels": [{"id": 1, "name": "please review & merge", "color": "0e8a16"}],
+        "created_at": "2026-09-30T12:00:00Z",
+        "updated_at": f"2026-10-01T12:{i % 60:02d}:00Z",
+        "merge_commit_sha": f"{i:040x}",
+        "assignees": [],
+        "requested_reviewers": [user(i + 1)],
+        "head": {
+            "label": f"{owner}:recipe-{i}",
+            "ref": f"recipe-{i}",
+            "sha": f"{i + 1:040x}",
+            "user": user(i),
+            "repo": repo(i, owner),
+        },
+        "base": {
+            "label": "bioconda:master",
+            "ref": "master",
+            "sha": f"{i + 2:040x}",
+            "user": user(0),
+            "repo": repo(0, "bioconda"),
+        },
+        "author_association": "CONTRIBUTOR",
+        "draft": False,
+    }
+
+
+def job_context() -> dict:
+    event = {
+        "action": "created",
+        "issue": {"number": 50000, "pull_request": {"url": "..."}, "body": "x" * 2000},
+        "comment": {"body": "@BiocondaBot please fetch artifacts", "user": user(1)},
+        "pull_request": pull_request(0),
+        "repository": repo(0, "bioconda"),
+        "sender": user(1),
+        # Commit lists, check suites, etc. make up most of real payloads
+        "commits": [pull_request(i) for i in range(40)],
+    }
+    return {
+        "event_name": "issue_comment",
+        "actor": "user1",
+        "repository": "bioconda/bioconda-recipes",
+        "token": "***",
+        "event": event,
+    }
+
+
+def main() -> None:
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    payloads = {
+        "PR page (100 PRs)": (json.dumps([pull_request(i) for i in range(100)]), PullRequest.from_json_list),
+        "job context": (json.dumps(job_context()), JobContext.from_json),
+    }
+    for name, (text, to_model) in payloads.items():
+        print(f"{name}: {len(text) / 1024:.0f} KiB")
+        json_time = timeit(lambda: to_model(json.loads(text)), number=repeats) / repeats
+        print(f"  json.loads + models: {json_time * 1000:8.2f} ms")
+        if safe_load is None:
+            print("  yaml.safe_load:      (PyYAML not installed)")
+            continue
+        yaml_time = timeit(lambda: safe_load(text), number=max(1, repeats // 10)) / max(1, repeats // 10)
+        print(f"  yaml.safe_load:      {yaml_time * 1000:8.2f} ms ({yaml_time / json_time:.0f}x slower)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,59 @@
 import logging
-import os
+import time
+from asyncio import Semaphore, gather
+from statistics import median
 
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import List, Optional, Set
 
 from aiohttp import ClientSession
-from yaml import safe_load
 
 from .common import (
+    create_session,
     get_job_context,
+    get_pr_info,
     get_prs_for_sha,
     get_sha_for_status_check,
     get_sha_for_workflow_run,
+    list_labeled_prs,
+    send_comment,
 )
-from .merge import MergeState, request_merge
+from .checks import all_checks_passed
+from .coalesce import get_coalescer
+from .github import RECIPES_REPO, get_github
+from .models import JobContext, Label
+from .pr_snapshot import PRSnapshot, get_pr_snapshot
+from .merge import (
+    MERGE_ERROR_MESSAGE,
+    MERGE_INIT_MESSAGE,
+    MergeState,
+    check_is_mergeable,
+    format_commit_messages,
+    put_merge,
+    request_merge,
+    upload_artifacts,
+)
+from .tracing import traced
 
 logger = logging.getLogger(__name__)
 log = logger.info
 
+# Number of PRs whose checks/uploads run concurrently in the merge queue
+MAX_QUEUE_CHECKS = 8
+MAX_QUEUE_UPLOADS = 3
+# The merge queue considers at most this many pages of automerge PRs
+MAX_QUEUE_PAGES = 10
+
+QUEUE_HEAD_MOVED_MESSAGE = (
+    "This PR got new commits after its checks and reviews were verified, so I did not upload or merge it. "
+    "It will be merged once the new commits pass all checks."
+)
+
 
 async def get_pr_labels(session: ClientSession, pr: int) -> Set[str]:
-    token = os.environ["BOT_TOKEN"]
-    url = f"https://api.github.com/repos/bioconda/bioconda-recipes/issues/{pr}/labels"
-    headers = {
-        "Authorization": f"token {token}",
-        "User-Agent": "BiocondaCommentResponder",
-    }
-    async with session.get(url, headers=headers) as response:
-        response.raise_for_status()
-        res = await response.text()
-    labels = safe_load(res)
-    return {label["name"] for label in labels}
+    labels = Label.from_json_list(
+        await get_github(session).get_json(f"{RECIPES_REPO}/issues/{pr}/labels")
+    )
+    return {label.name for label in labels}
 
 
 async def is_automerge_labeled(session: ClientSession, pr: int) -> bool:
@@ -37,74 +61,169 @@ async def is_automerge_labeled(session: ClientSession, pr: int) -> bool:
     return "automerge" in labels
 
 
-async def merge_if_labeled(session: ClientSession, pr: int) -> MergeState:
-    if not await is_automerge_labeled(session, pr):
+# Return True if all checks of sha passed
+# A green rollup of the head commit's checks and statuses in a fresh snapshot saves looking at
+# the check runs one by one. Any other state is checked run by run, since the rollup also counts
+# the bot's own automerge check, which all_checks_passed ignores.
+async def checks_passed(session: ClientSession, sha: str, snapshot: Optional[PRSnapshot]) -> bool:
+    if snapshot is not None and snapshot.head_sha == sha and snapshot.check_state == "SUCCESS":
+        log("All checks and statuses of SHA %s passed", sha)
+        return True
+    return await all_checks_passed(session, sha)
+
+
+async def merge_if_labeled(session: ClientSession, pr: int, sha: str) -> MergeState:
+    snapshot = await get_pr_snapshot(session, pr)
+    if snapshot is not None:
+        labeled = "automerge" in snapshot.labels
+    else:
+        labeled = await is_automerge_labeled(session, pr)
+    if not labeled:
         return MergeState.UNKNOWN
-    return await request_merge(session, pr)
-
-
-async def get_check_runs(session: ClientSession, sha: str) -> Any:
-    url = f"https://api.github.com/repos/bioconda/bioconda-recipes/commits/{sha}/check-runs"
-
-    headers = {
-        "User-Agent": "BiocondaCommentResponder",
-        "Accept": "application/vnd.github.antiope-preview+json",
-    }
-    async with session.get(url, headers=headers) as response:
-        response.raise_for_status()
-        res = await response.text()
-    check_runs = [
-        check_run
-        for check_run in safe_load(res)["check_runs"] or []
-        if check_run["name"] != "bioconda-bot automerge"
-    ]
-    log("Got %d check_runs for SHA %s", len(check_runs or []), sha)
-    return check_runs
-
-
-async def all_checks_completed(session: ClientSession, sha: str) -> bool:
-    check_runs = await get_check_runs(session, sha)
-
-    is_all_completed = all(check_run["status"] == "completed" for check_run in check_runs)
-    if not is_all_completed:
-        log("Some check_runs are not completed yet.")
-        for i, check_run in enumerate(check_runs, 1):
-            log("check_run %d / %d: %s", i, len(check_runs), check_run)
-    return is_all_completed
-
-
-async def all_checks_passed(session: ClientSession, sha: str) -> bool:
-    check_runs = await get_check_runs(session, sha)
-
-    # TODO: "neutral" might be a valid conclusion to consider in the future.
-    valid_conclusions = {"success", "skipped"}
-    if any(check_run["conclusion"] not in valid_conclusions for check_run in check_runs):
-        log(f"Some check_runs are not marked as {'/'.join(valid_conclusions)} yet.")
-        for i, check_run in enumerate(check_runs, 1):
-            log("check_run %d / %d: %s", i, len(check_runs), check_run)
-        return False
-    return True
-
-
-async def merge_automerge_passed(sha: str) -> None:
-    async with ClientSession() as session:
-        if not await all_checks_passed(session, sha):
-            return
-        prs = await get_prs_for_sha(session, sha)
-        if not prs:
-            log("No PRs found for SHA %s", sha)
-        for pr in prs:
-            merge_state = await merge_if_labeled(session, pr)
-            log("PR %d has merge state %s", pr, merge_state)
-            if merge_state is MergeState.MERGED:
-                break
-
-
-async def get_sha_for_review(job_context: Dict[str, Any]) -> Optional[str]:
-    if job_context["event_name"] != "pull_request_review":
+    if not await checks_passed(session, sha, snapshot):
+        return MergeState.NOT_MERGEABLE
+    return await request_merge(session, pr, snapshot)
+
+
+# Return True if a PR was merged
+@traced
+async def merge_automerge_passed(session: ClientSession, sha: str) -> bool:
+    prs = await get_prs_for_sha(session, sha)
+    if not prs:
+        log("No PRs found for SHA %s", sha)
+    for pr in prs:
+        merge_state = await merge_if_labeled(session, pr, sha)
+        log("PR %d has merge state %s", pr, merge_state)
+        if merge_state is MergeState.MERGED:
+            return True
+    return False
+
+
+# Open PRs with the automerge label, by number
+async def list_automerge_prs(session: ClientSession) -> List[int]:
+    return await list_labeled_prs(session, "automerge", MAX_QUEUE_PAGES)
+
+
+# Progress of one PR through the merge queue, times are seconds since the queue started
+class QueueEntry:
+    __slots__ = ("pr", "sha", "snapshot", "state", "checked", "uploaded", "merged", "error")
+
+    def __init__(self, pr: int) -> None:
+        self.pr = pr
+        self.sha: Optional[str] = None
+        self.snapshot: Optional[PRSnapshot] = None
+        self.state = MergeState.UNKNOWN
+        self.checked: Optional[float] = None
+        self.uploaded: Optional[float] = None
+        self.merged: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def __str__(self) -> str:
+        times = ", ".join(
+            f"{name} after {getattr(self, name):.1f}s"
+            for name in ("checked", "uploaded", "merged")
+            if getattr(self, name) is not None
+        )
+        error = f" ({self.error})" if self.error else ""
+        return f"PR {self.pr}: {self.state.name}{error}, {times}"
+
+
+# Merge all green, mergeable PRs with the automerge label in one go
+# Checks and uploads of the PRs run concurrently, the merges happen one after the other in
+# order of the PR numbers, so the result doesn't depend on which upload finished first.
+@traced
+async def merge_queue(
+    session: ClientSession,
+    max_checks: int = MAX_QUEUE_CHECKS,
+    max_uploads: int = MAX_QUEUE_UPLOADS,
+) -> List[QueueEntry]:
+    start = time.monotonic()
+    entries = [QueueEntry(pr) for pr in await list_automerge_prs(session)]
+    log("Merge queue: %d PRs with the automerge label", len(entries))
+
+    check_slots = Semaphore(max_checks)
+
+    async def check(entry: QueueEntry) -> None:
+        async with check_slots:
+            try:
+                entry.snapshot = await get_pr_snapshot(session, entry.pr)
+                if entry.snapshot is not None:
+                    entry.sha = entry.snapshot.head_sha
+                else:
+                    entry.sha = (await get_pr_info(session, entry.pr)).head_sha
+                if await checks_passed(session, entry.sha, entry.snapshot):
+                    entry.state = await check_is_mergeable(session, entry.pr, snapshot=entry.snapshot)
+                else:
+                    entry.error = "checks did not pass"
+            except Exception as error:
+                # Don't let one PR stop the whole queue
+                logger.exception("Merge queue: checking PR %d failed", entry.pr)
+                entry.state = MergeState.UNKNOWN
+                entry.error = f"check failed: {error}"
+            entry.checked = time.monotonic() - start
+
+    await gather(*map(check, entries))
+    mergeable = [entry for entry in entries if entry.state is MergeState.MERGEABLE]
+    log("Merge queue: %d of %d PRs are mergeable", len(mergeable), len(entries))
+
+    upload_slots = Semaphore(max_uploads)
+
+    async def upload(entry: QueueEntry) -> None:
+        async with upload_slots:
+            try:
+                head_sha = (await get_pr_info(session, entry.pr)).head_sha
+                if head_sha != entry.sha:
+                    # The PR got new commits since it was checked, they weren't vetted
+                    entry.error = f"head moved to {head_sha} after the checks"
+                    await send_comment(session, entry.pr, QUEUE_HEAD_MOVED_MESSAGE)
+                    return
+                await send_comment(session, entry.pr, MERGE_INIT_MESSAGE)
+                # Upload the checked commit only, put_merge fails if the head moves after this
+                await upload_artifacts(session, entry.pr, entry.sha)
+            except Exception as error:
+                logger.exception("Merge queue: uploading the artifacts of PR %d failed", entry.pr)
+                entry.error = f"upload failed: {error}"
+                await send_comment(session, entry.pr, MERGE_ERROR_MESSAGE)
+                return
+            entry.uploaded = time.monotonic() - start
+
+    await gather(*map(upload, mergeable))
+
+    for entry in sorted(mergeable, key=lambda entry: entry.pr):
+        if entry.uploaded is None:
+            entry.state = MergeState.NOT_MERGEABLE
+            continue
+        snapshot = entry.snapshot
+        msg = format_commit_messages(snapshot.commit_messages, snapshot.commits) if snapshot else None
+        rc = await put_merge(session, entry.pr, entry.sha, msg)
+        if rc == 200:
+            entry.state = MergeState.MERGED
+            entry.merged = time.monotonic() - start
+        else:
+            entry.state = MergeState.NOT_MERGEABLE
+            entry.error = f"merge returned {rc}"
+            await send_comment(session, entry.pr, MERGE_ERROR_MESSAGE)
+
+    elapsed = time.monotonic() - start
+    merged = [entry for entry in entries if entry.state is MergeState.MERGED]
+    for entry in entries:
+        log("Merge queue: %s", entry)
+    log(
+        "Merge queue: merged %d of %d PRs in %.1fs (%.2f PRs/min), median latency %.1fs",
+        len(merged),
+        len(entries),
+        elapsed,
+        len(merged) / max(elapsed, 1e-6) * 60,
+        median(entry.merged for entry in merged) if merged else 0.0,
+    )
+    return entries
+
+
+async def get_sha_for_review(job_context: JobContext) -> Optional[str]:
+    if job_context.event_name != "pull_request_review":
         return None
     log("Got %s event", "pull_request_review")
-    event = job_context["event"]
+    event = job_context.event
     if event["review"]["state"] != "approved":
         return None
     sha: Optional[str] = event["pull_request"]["head"]["sha"]
@@ -112,11 +231,11 @@ async def get_sha_for_review(job_context: Dict[str, Any]) -> Optional[str]:
     return sha
 
 
-async def get_sha_for_labeled_pr(job_context: Dict[str, Any]) -> Optional[str]:
-    if job_context["event_name"] != "pull_request":
+async def get_sha_for_labeled_pr(job_context: JobContext) -> Optional[str]:
+    if job_context.event_name != "pull_request":
         return None
     log("Got %s event", "pull_request")
-    event = job_context["event"]
+    event = job_context.event
     if event["action"] != "labeled" or event["label"]["name"] != "automerge":
         return None
     sha: Optional[str] = event["pull_request"]["head"]["sha"]
@@ -127,12 +246,24 @@ async def get_sha_for_labeled_pr(job_context: Dict[str, Any]) -> Optional[str]:
 # This requires that a JOB_CONTEXT environment variable, which is made with `toJson(github)`
 async def main() -> None:
     job_context = await get_job_context()
+    async with create_session() as session:
+        await handle(session, job_context)
 
+
+# Respond to one event, this is shared by main and the webhook server
+async def handle(session: ClientSession, job_context: JobContext) -> None:
+    # Failed checks count as well, so the coalescer sees the last check of the sha finish
+    # whatever its outcome; merge_automerge_passed only merges if all of them passed.
     sha = (
-        await get_sha_for_status_check(job_context)
-        or await get_sha_for_workflow_run(job_context)
+        await get_sha_for_status_check(job_context, finished=True)
+        or await get_sha_for_workflow_run(job_context, finished=True)
         or await get_sha_for_review(job_context)
         or await get_sha_for_labeled_pr(job_context)
     )
     if sha:
-        await merge_automerge_passed(sha)
+        await get_coalescer(session).run(sha, "automerge", lambda: merge_automerge_passed(session, sha))
+
+
+async def queue_main() -> None:
+    async with create_session() as session:
+        await merge_queue(session)
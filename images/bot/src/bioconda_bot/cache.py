@@ -0,0 +1,106 @@
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from hashlib import sha256
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+# Default size limit of the artifact cache, override with BIOCONDA_BOT_ARTIFACT_CACHE_SIZE (bytes)
+MAX_ARTIFACT_CACHE_SIZE = 10 * 1024 ** 3
+
+
+# Directory for data that is kept between bot runs, set BIOCONDA_BOT_CACHE_DIR to change it
+def get_cache_dir(*parts: str) -> Path:
+    root = os.environ.get("BIOCONDA_BOT_CACHE_DIR") or Path.home() / ".cache" / "bioconda-bot"
+    path = Path(root, *parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+# Hard link src to dst (both on the same file system in the common case), copy otherwise
+def link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+# Content-addressed store for downloaded artifact zip files
+# Entries are keyed by (provider, build id, artifact id/digest) and evicted in least recently
+# used order once the total size exceeds max_size. Entries are written to a temporary file
+# and renamed into place, so concurrent runs never see (or clobber) partial files.
+class ArtifactCache:
+    def __init__(self, directory: Path, max_size: int = MAX_ARTIFACT_CACHE_SIZE) -> None:
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, key: Tuple[str, ...]) -> Path:
+        digest = sha256("\0".join(key).encode()).hexdigest()
+        return self.directory / f"{digest}.zip"
+
+    # Return the path of a cached entry and mark it as recently used
+    def get(self, key: Tuple[str, ...]) -> Optional[str]:
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        log("Using cached artifact %s for %s", path, key)
+        return str(path)
+
+    # Write a new entry through the yielded file object, it is only added once the block succeeds
+    @contextmanager
+    def open_for_write(self, key: Tuple[str, ...]) -> Iterator[BinaryIO]:
+        path = self.path(key)
+        with NamedTemporaryFile(dir=self.directory, prefix=".", suffix=".part", delete=False) as fd:
+            try:
+                yield fd
+                fd.flush()
+                os.fsync(fd.fileno())
+            except BaseException:
+                fd.close()
+                os.remove(fd.name)
+                raise
+        os.replace(fd.name, path)
+        self.evict(keep=path)
+
+    # Remove least recently used entries until the cache fits into max_size
+    def evict(self, keep: Optional[Path] = None) -> None:
+        entries = []
+        for path in self.directory.glob("*.zip"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            log("Evicting cached artifact %s (%d bytes)", path, size)
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+_artifact_cache: Optional[ArtifactCache] = None
+
+
+# Return the shared artifact cache, or None if it's disabled (BIOCONDA_BOT_ARTIFACT_CACHE_SIZE=0)
+def get_artifact_cache() -> Optional[ArtifactCache]:
+    global _artifact_cache
+    max_size = int(os.environ.get("BIOCONDA_BOT_ARTIFACT_CACHE_SIZE", MAX_ARTIFACT_CACHE_SIZE))
+    if max_size <= 0:
+        return None
+    if _artifact_cache is None:
+        _artifact_cache = ArtifactCache(get_cache_dir("artifacts"), max_size)
+    return _artifact_cache
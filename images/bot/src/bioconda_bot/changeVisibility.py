@@ -11,10 +11,10 @@ from typing import Any, Dict, List, Optional, Set, Tuple
 from zipfile import ZipFile, ZipInfo
 
 from aiohttp import ClientSession
-from yaml import safe_load
 
 from .common import (
     async_exec,
+    create_session,
     fetch_pr_sha_artifacts,
     get_job_context,
     get_pr_comment,
@@ -22,6 +22,9 @@ from .common import (
     is_bioconda_member,
     send_comment,
 )
+from .models import JobContext
+from .scheduler import request
+from .tracing import traced
 
 logger = logging.getLogger(__name__)
 log = logger.info
@@ -29,6 +32,7 @@ log = logger.info
 
 # Ensure uploaded containers are in repos that have public visibility
 # TODO: This should ping @bioconda/core if it fails
+@traced
 async def toggle_visibility(session: ClientSession, container_repo: str) -> None:
     url = f"https://quay.io/api/v1/repository/biocontainers/{container_repo}/changevisibility"
     QUAY_OAUTH_TOKEN = os.environ["QUAY_OAUTH_TOKEN"]
@@ -39,7 +43,7 @@ async def toggle_visibility(session: ClientSession, container_repo: str) -> None
     body = {"visibility": "public"}
     rc = 0
     try:
-        async with session.post(url, headers=headers, json=body) as response:
+        async with request(session, "POST", url, headers=headers, json=body) as response:
             rc = response.status
     except:
         # Do nothing
@@ -50,6 +54,12 @@ async def toggle_visibility(session: ClientSession, container_repo: str) -> None
 # This requires that a JOB_CONTEXT environment variable, which is made with `toJson(github)`
 async def main() -> None:
     job_context = await get_job_context()
+    async with create_session() as session:
+        await handle(session, job_context)
+
+
+# Respond to one event, this is shared by main and the webhook server
+async def handle(session: ClientSession, job_context: JobContext) -> None:
     issue_number, original_comment = await get_pr_comment(job_context)
     if issue_number is None or original_comment is None:
         return
@@ -58,6 +68,5 @@ async def main() -> None:
     if comment.startswith(("@bioconda-bot", "@biocondabot")):
         if " please toggle visibility" in comment:
             pkg = comment.split("please change visibility")[1].strip().split()[0]
-            async with ClientSession() as session:
-                await toggle_visibility(session, pkg)
-                await send_comment(session, issue_number, "Visibility changed.")
+            await toggle_visibility(session, pkg)
+            await send_comment(session, issue_number, "Visibility changed.")
@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import tarfile
+from asyncio import Lock, get_running_loop
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from typing import Any, Dict, List, Optional, Tuple
+from weakref import WeakKeyDictionary
+from zipfile import ZipFile, ZipInfo
+
+from aiohttp import ClientSession
+
+from .cache import get_cache_dir
+from .scheduler import request
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+CHANNEL_URL = "https://conda.anaconda.org/bioconda"
+READ_BUFFER_SIZE = 1024 * 1024
+KNOWN_SUBDIRS = {"noarch", "linux-64", "linux-aarch64", "osx-64", "osx-arm64", "win-64"}
+
+
+# Name, version, build, subdir and sha256 of a package file
+class PackageInfo:
+    __slots__ = ("filename", "name", "version", "build", "subdir", "sha256")
+
+    def __init__(
+        self,
+        filename: str,
+        sha256: str,
+        name: Optional[str] = None,
+        version: Optional[str] = None,
+        build: Optional[str] = None,
+        subdir: Optional[str] = None,
+    ) -> None:
+        self.filename = filename
+        self.sha256 = sha256
+        self.name = name
+        self.version = version
+        self.build = build
+        self.subdir = subdir
+
+    def __str__(self) -> str:
+        return f"{self.subdir}/{self.filename}"
+
+
+# Pass reads through while hashing them, so tarfile can stream the member in the same pass
+class HashingReader:
+    def __init__(self, fd) -> None:
+        self.fd = fd
+        self.checksum = sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fd.read(size)
+        self.checksum.update(data)
+        return data
+
+    # Hash whatever tarfile didn't need to read
+    def finish(self) -> str:
+        while self.read(READ_BUFFER_SIZE):
+            pass
+        return self.checksum.hexdigest()
+
+
+def read_tar_index(fd, mode: str) -> Optional[Dict[str, Any]]:
+    with tarfile.open(fileobj=fd, mode=mode) as tar:
+        for info in tar:
+            if info.name == "info/index.json":
+                return json.load(tar.extractfile(info))
+    return None
+
+
+# .conda files are zip files with the metadata in info-*.tar.zst
+def read_conda_index(fd) -> Optional[Dict[str, Any]]:
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    with ZipFile(fd) as conda:
+        for name in conda.namelist():
+            if name.startswith("info-") and name.endswith(".tar.zst"):
+                with conda.open(name) as compressed:
+                    reader = zstandard.ZstdDecompressor().stream_reader(compressed)
+                    return read_tar_index(reader, "r|")
+    return None
+
+
+# Read info/index.json and the sha256 of a package in a zip file without extracting it
+# Without the optional zstandard module, the subdir of a .conda package is taken from its path.
+def read_package_info(zf: ZipFile, e: ZipInfo) -> PackageInfo:
+    filename = e.filename.split("/").pop()
+    index: Optional[Dict[str, Any]] = None
+    with zf.open(e) as member:
+        if filename.endswith(".tar.bz2"):
+            reader = HashingReader(member)
+            index = read_tar_index(reader, "r|bz2")
+            digest = reader.finish()
+        else:
+            checksum = sha256()
+            for chunk in iter(lambda: member.read(READ_BUFFER_SIZE), b""):
+                checksum.update(chunk)
+            digest = checksum.hexdigest()
+    if index is None and filename.endswith(".conda"):
+        # Zip members are seekable (slowly), which is enough to read the central directory
+        with zf.open(e) as member:
+            index = read_conda_index(member)
+    if index is None:
+        parent = os.path.basename(os.path.dirname(e.filename))
+        return PackageInfo(filename, digest, subdir=parent if parent in KNOWN_SUBDIRS else None)
+    return PackageInfo(
+        filename, digest, index.get("name"), index.get("version"), index.get("build"), index.get("subdir")
+    )
+
+
+# Replace package records by their sha256 while they're parsed, so the full records never pile up
+def reduce_package_record(pairs: List[Tuple[str, Any]]) -> Any:
+    record = dict(pairs)
+    if "build" in record and "depends" in record:
+        return record.get("sha256", "")
+    return record
+
+
+# Return {filename: sha256} of the packages in a repodata.json file
+def parse_repodata(path: str) -> Dict[str, str]:
+    with open(path, "rb") as fd:
+        repodata = json.load(fd, object_pairs_hook=reduce_package_record)
+    return {
+        filename: sha if isinstance(sha, str) else sha.get("sha256", "")
+        for key in ("packages", "packages.conda")
+        for filename, sha in (repodata.get(key) or {}).items()
+    }
+
+
+# Return the ETag and packages saved by save_packages, None if there are none
+def load_packages(path: str) -> Optional[Tuple[Optional[str], Dict[str, str]]]:
+    try:
+        with open(path) as fd:
+            saved = json.load(fd)
+        return saved["etag"], saved["packages"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_packages(path: str, etag: Optional[str], packages: Dict[str, str]) -> None:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fd:
+        json.dump({"etag": etag, "packages": packages}, fd)
+    os.replace(tmp_path, path)
+
+
+# The sha256 of every package on the channel, the repodata of each subdir is fetched once
+# repodata.json has tens to hundreds of MB. It is streamed to a temporary file and reduced to the
+# sha256 of each package, which is kept in the cache directory with the ETag of the repodata. As
+# long as the repodata didn't change, the saved packages are used without downloading it again.
+class ChannelIndex:
+    def __init__(self, session: ClientSession, url: str = CHANNEL_URL) -> None:
+        self.session = session
+        self.url = url
+        self.directory = get_cache_dir("channel")
+        self.subdirs: Dict[str, Dict[str, str]] = {}
+        self.locks: Dict[str, Lock] = {}
+
+    async def packages(self, subdir: str) -> Dict[str, str]:
+        lock = self.locks.setdefault(subdir, Lock())
+        async with lock:
+            if subdir not in self.subdirs:
+                self.subdirs[subdir] = await self.fetch(subdir)
+        return self.subdirs[subdir]
+
+    async def fetch(self, subdir: str) -> Dict[str, str]:
+        url = f"{self.url}/{subdir}/repodata.json"
+        path = str(self.directory / f"{sha256(url.encode()).hexdigest()}.json")
+        loop = get_running_loop()
+        # Reading and parsing these files takes a while => use a thread
+        saved = await loop.run_in_executor(None, load_packages, path)
+        headers = {"If-None-Match": saved[0]} if saved and saved[0] else {}
+        with span("download", "repodata", url=url) as download_span:
+            async with request(self.session, "GET", url, headers=headers) as response:
+                if response.status == 304 and saved:
+                    log("%s is unchanged: %d packages", url, len(saved[1]))
+                    return saved[1]
+                response.raise_for_status()
+                etag = response.headers.get("ETag")
+                with NamedTemporaryFile(dir=self.directory, prefix=".", suffix=".part", delete=False) as fd:
+                    try:
+                        async for chunk in response.content.iter_chunked(READ_BUFFER_SIZE):
+                            fd.write(chunk)
+                    except BaseException:
+                        fd.close()
+                        os.remove(fd.name)
+                        raise
+            download_span.set(bytes=os.path.getsize(fd.name))
+        try:
+            packages = await loop.run_in_executor(None, parse_repodata, fd.name)
+        finally:
+            os.remove(fd.name)
+        try:
+            await loop.run_in_executor(None, save_packages, path, etag, packages)
+        except OSError as error:
+            log("Saving the packages of %s failed (%s)", url, error)
+        log("Fetched %s: %d packages", url, len(packages))
+        return packages
+
+    # Return True if an identical package is on the channel already
+    async def contains(self, package: PackageInfo) -> bool:
+        if not package.subdir:
+            return False
+        try:
+            packages = await self.packages(package.subdir)
+        except Exception as error:
+            log("Can't check %s for %s (%s), uploading it", self.url, package, error)
+            return False
+        return packages.get(package.filename) == package.sha256
+
+
+_indices: "WeakKeyDictionary[ClientSession, ChannelIndex]" = WeakKeyDictionary()
+
+
+# Return the channel index bound to a session
+def get_channel_index(session: ClientSession) -> ChannelIndex:
+    index = _indices.get(session)
+    if index is None:
+        index = _indices[session] = ChannelIndex(session)
+    return index
@@ -0,0 +1,123 @@
+import logging
+import time
+from asyncio import Lock, gather
+from typing import Dict, List, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+from aiohttp import ClientSession
+
+from .github import RECIPES_REPO, get_github
+from .models import CheckRun
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+CHECK_RUNS_PER_PAGE = 100
+# A snapshot is reused for this many seconds, e.g., by the checks of one automerge run
+MAX_SNAPSHOT_AGE = 15.0
+# The bot's own check run, it's never completed while the bot runs
+AUTOMERGE_CHECK_NAME = "bioconda-bot automerge"
+# TODO: "neutral" might be a valid conclusion to consider in the future.
+PASSED_CONCLUSIONS = {"success", "skipped"}
+
+
+# All check runs of a commit, fetched at once
+class CheckRunSnapshot:
+    __slots__ = ("sha", "check_runs", "fetched_at")
+
+    def __init__(self, sha: str, check_runs: List[CheckRun]) -> None:
+        self.sha = sha
+        self.check_runs = check_runs
+        self.fetched_at = time.monotonic()
+
+    # Fetch the first page, then all remaining pages concurrently
+    @classmethod
+    async def fetch(cls, session: ClientSession, sha: str) -> "CheckRunSnapshot":
+        github = get_github(session)
+        path = f"{RECIPES_REPO}/commits/{sha}/check-runs"
+
+        async def get_page(page: int) -> Tuple[int, List[CheckRun]]:
+            res_object = await github.get_json(path, params={"per_page": CHECK_RUNS_PER_PAGE, "page": page})
+            return res_object["total_count"], CheckRun.from_json_list(res_object["check_runs"] or [])
+
+        total_count, check_runs = await get_page(1)
+        pages = -(-total_count // CHECK_RUNS_PER_PAGE)
+        for _, page_check_runs in await gather(*map(get_page, range(2, pages + 1))):
+            check_runs.extend(page_check_runs)
+        log("Got %d check_runs (%d pages) for SHA %s", len(check_runs), max(pages, 1), sha)
+        return cls(sha, check_runs)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    # The check runs the automerge decisions are based on
+    @property
+    def builds(self) -> List[CheckRun]:
+        return [check_run for check_run in self.check_runs if check_run.name != AUTOMERGE_CHECK_NAME]
+
+    def pending(self) -> List[CheckRun]:
+        return [check_run for check_run in self.builds if check_run.status != "completed"]
+
+    def not_passed(self) -> List[CheckRun]:
+        return [check_run for check_run in self.builds if check_run.conclusion not in PASSED_CONCLUSIONS]
+
+    def log_check_runs(self) -> None:
+        for i, check_run in enumerate(self.builds, 1):
+            log("check_run %d / %d: %s", i, len(self.builds), check_run)
+
+
+# Recent snapshots of a session, so the checks of one run share a single fetch
+class CheckRunCache:
+    def __init__(self, session: ClientSession) -> None:
+        self.session = session
+        self.snapshots: Dict[str, CheckRunSnapshot] = {}
+        self.locks: Dict[str, Lock] = {}
+
+    async def get(self, sha: str, max_age: float = MAX_SNAPSHOT_AGE) -> CheckRunSnapshot:
+        lock = self.locks.setdefault(sha, Lock())
+        async with lock:
+            snapshot = self.snapshots.get(sha)
+            if snapshot is None or snapshot.age > max_age:
+                snapshot = self.snapshots[sha] = await CheckRunSnapshot.fetch(self.session, sha)
+        # Drop the ones nobody will use anymore
+        for other_sha, other in list(self.snapshots.items()):
+            if other.age > max_age and not self.locks[other_sha].locked():
+                del self.snapshots[other_sha]
+                del self.locks[other_sha]
+        return snapshot
+
+
+_caches: "WeakKeyDictionary[ClientSession, CheckRunCache]" = WeakKeyDictionary()
+
+
+# Return a check run snapshot of sha that is at most max_age seconds old
+async def get_check_run_snapshot(
+    session: ClientSession, sha: str, max_age: float = MAX_SNAPSHOT_AGE
+) -> CheckRunSnapshot:
+    cache = _caches.get(session)
+    if cache is None:
+        cache = _caches[session] = CheckRunCache(session)
+    return await cache.get(sha, max_age)
+
+
+async def all_checks_completed(
+    session: ClientSession, sha: str, snapshot: Optional[CheckRunSnapshot] = None
+) -> bool:
+    snapshot = snapshot or await get_check_run_snapshot(session, sha)
+    is_all_completed = not snapshot.pending()
+    if not is_all_completed:
+        log("Some check_runs are not completed yet.")
+        snapshot.log_check_runs()
+    return is_all_completed
+
+
+async def all_checks_passed(
+    session: ClientSession, sha: str, snapshot: Optional[CheckRunSnapshot] = None
+) -> bool:
+    snapshot = snapshot or await get_check_run_snapshot(session, sha)
+    if snapshot.not_passed():
+        log(f"Some check_runs are not marked as {'/'.join(PASSED_CONCLUSIONS)} yet.")
+        snapshot.log_check_runs()
+        return False
+    return True
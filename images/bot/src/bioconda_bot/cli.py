@@ -1,12 +1,13 @@
+import os
 from logging import INFO, basicConfig
 
-from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
 from asyncio import run
 from typing import List, Optional
 
 
 def build_parser_comment(parser: ArgumentParser) -> None:
-    def run_command() -> None:
+    def run_command(args: Namespace) -> None:
         from .comment import main as main_
 
         run(main_())
@@ -15,7 +16,7 @@ def build_parser_comment(parser: ArgumentParser) -> None:
 
 
 def build_parser_merge(parser: ArgumentParser) -> None:
-    def run_command() -> None:
+    def run_command(args: Namespace) -> None:
         from .merge import main as main_
 
         run(main_())
@@ -24,17 +25,46 @@ def build_parser_merge(parser: ArgumentParser) -> None:
 
 
 def build_parser_update(parser: ArgumentParser) -> None:
-    def run_command() -> None:
-        from .update import main as main_
+    parser.add_argument(
+        "--all-labelled",
+        metavar="LABEL",
+        help="Update the branches of all open PRs with this label instead of handling JOB_CONTEXT",
+    )
+    parser.add_argument(
+        "--prs",
+        type=int,
+        nargs="+",
+        default=[],
+        metavar="PR",
+        help="Update the branches of these PRs instead of handling JOB_CONTEXT",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="Number of PR branches updated concurrently")
 
-        run(main_())
+    def run_command(args: Namespace) -> None:
+        if args.all_labelled or args.prs:
+            from .update import bulk_main
+
+            run(bulk_main(args.prs, args.all_labelled, args.workers))
+        else:
+            from .update import main as main_
+
+            run(main_())
 
     parser.set_defaults(run_command=run_command)
 
 
 def build_parser_automerge(parser: ArgumentParser) -> None:
-    def run_command() -> None:
-        from .automerge import main as main_
+    parser.add_argument(
+        "--queue",
+        action="store_true",
+        help="Merge all green, mergeable PRs with the automerge label instead of handling JOB_CONTEXT",
+    )
+
+    def run_command(args: Namespace) -> None:
+        if args.queue:
+            from .automerge import queue_main as main_
+        else:
+            from .automerge import main as main_
 
         run(main_())
 
@@ -42,7 +72,7 @@ def build_parser_automerge(parser: ArgumentParser) -> None:
 
 
 def build_parser_changeVisibility(parser: ArgumentParser) -> None:
-    def run_command() -> None:
+    def run_command(args: Namespace) -> None:
         from .changeVisibility import main as main_
 
         run(main_())
@@ -50,6 +80,28 @@ def build_parser_changeVisibility(parser: ArgumentParser) -> None:
     parser.set_defaults(run_command=run_command)
 
 
+def build_parser_serve(parser: ArgumentParser) -> None:
+    parser.add_argument("--host", default="0.0.0.0", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=8, help="Number of events handled concurrently")
+    parser.add_argument(
+        "--coalesce-window",
+        type=float,
+        default=30.0,
+        help="Seconds to collect status events for a commit before acting on them",
+    )
+
+    def run_command(args: Namespace) -> None:
+        from .server import serve
+
+        secret = os.environ.get("WEBHOOK_SECRET")
+        if not secret:
+            raise SystemExit("WEBHOOK_SECRET must be set to verify webhook deliveries")
+        serve(secret, args.host, args.port, args.workers, args.coalesce_window)
+
+    parser.set_defaults(run_command=run_command)
+
+
 def get_argument_parser() -> ArgumentParser:
     parser = ArgumentParser(
         prog="bioconda-bot",
@@ -65,6 +117,7 @@ def get_argument_parser() -> ArgumentParser:
         ("update", build_parser_update),
         ("automerge", build_parser_automerge),
         ("change", build_parser_changeVisibility),
+        ("serve", build_parser_serve),
     ):
         sub_parser = sub_parsers.add_parser(
             command_name,
@@ -78,4 +131,4 @@ def main(args: Optional[List[str]] = None) -> None:
     basicConfig(level=INFO)
     parser = get_argument_parser()
     parsed_args = parser.parse_args(args)
-    parsed_args.run_command()
+    parsed_args.run_command(parsed_args)
@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import time
+from asyncio import Semaphore, Task, create_task, gather, sleep
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+from weakref import WeakKeyDictionary
+
+from aiohttp import ClientSession
+
+from .cache import get_cache_dir
+from .checks import all_checks_completed, get_check_run_snapshot
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+# Seconds to collect events for a sha before acting on them, set BIOCONDA_BOT_COALESCE_WINDOW
+# (the webhook server uses its --coalesce-window)
+DEFAULT_COALESCE_WINDOW = float(os.environ.get("BIOCONDA_BOT_COALESCE_WINDOW", 0))
+# Done (sha, action) pairs are forgotten after this many seconds or beyond this many entries
+LEDGER_TTL = 14 * 24 * 60 * 60
+MAX_LEDGER_ENTRIES = 10000
+# Number of coalesced actions that run at once
+MAX_COALESCED_ACTIONS = 8
+
+# An action returns True if it took effect and must not be repeated for the sha
+Action = Callable[[], Awaitable[bool]]
+
+
+# (sha, action) pairs that were already handled, persisted between runs
+# The ledger lives in the cache directory. In the bot's GitHub Actions containers that is an
+# ephemeral ~/.cache, unless BIOCONDA_BOT_CACHE_DIR points to a directory that is kept between
+# runs (e.g., with actions/cache); without that, it only dedupes events within one process, i.e.,
+# in the webhook server.
+class DoneLedger:
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or str(get_cache_dir("events") / "done.json")
+        # "sha action" -> epoch seconds when it was done
+        self.done: Dict[str, float] = {}
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as fd:
+                self.done = json.load(fd)
+        except (OSError, ValueError):
+            return
+
+    def save(self) -> None:
+        cutoff = time.time() - LEDGER_TTL
+        entries = sorted((t, key) for key, t in self.done.items() if t >= cutoff)
+        self.done = {key: t for t, key in entries[-MAX_LEDGER_ENTRIES:]}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump(self.done, fd)
+        os.replace(tmp_path, self.path)
+
+    def is_done(self, sha: str, action: str) -> bool:
+        return f"{sha} {action}" in self.done
+
+    def mark_done(self, sha: str, action: str) -> None:
+        self.done[f"{sha} {action}"] = time.time()
+        self.save()
+
+
+# Return True if none of the sha's check runs is still queued or in progress
+# The check runs are fetched afresh, an event just reported that one of them changed.
+async def checks_settled(session: ClientSession, sha: str) -> bool:
+    snapshot = await get_check_run_snapshot(session, sha, max_age=0)
+    return await all_checks_completed(session, sha, snapshot)
+
+
+# Runs an action once per sha, no matter how many events for the sha come in
+# Events for a (sha, action) that arrive within the window are merged into one run. The run only
+# happens once all check runs of the sha completed, the event of the last one to finish triggers
+# it otherwise, so callers must pass the events of failed checks as well. Actions that took effect
+# are recorded in the ledger, repeats are no-ops.
+# With a window, the wait and the action run in a background task, so the caller (e.g., a
+# worker of the webhook server) returns right away; at most max_actions of them run at once.
+class EventCoalescer:
+    def __init__(
+        self,
+        session: ClientSession,
+        window: float = DEFAULT_COALESCE_WINDOW,
+        max_actions: int = MAX_COALESCED_ACTIONS,
+    ) -> None:
+        self.session = session
+        self.window = window
+        self.ledger = DoneLedger()
+        # (sha, action) -> number of events that came in while it was pending
+        self.pending: Dict[Tuple[str, str], int] = {}
+        self.slots = Semaphore(max_actions)
+        self.tasks: Set["Task[None]"] = set()
+
+    async def run(self, sha: str, action: str, run_action: Action) -> None:
+        key = (sha, action)
+        if key in self.pending:
+            self.pending[key] += 1
+            log("Coalesced event for %s of SHA %s", action, sha)
+            return
+        self.pending[key] = 0
+        if self.window > 0:
+            task = create_task(self.run_in_background(sha, action, run_action))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            return
+        await self.run_pending(sha, action, run_action)
+
+    async def run_in_background(self, sha: str, action: str, run_action: Action) -> None:
+        try:
+            await self.run_pending(sha, action, run_action)
+        except Exception:
+            logger.exception("%s failed for SHA %s", action, sha)
+
+    async def run_pending(self, sha: str, action: str, run_action: Action) -> None:
+        key = (sha, action)
+        try:
+            while True:
+                if self.window > 0:
+                    await sleep(self.window)
+                events = self.pending[key]
+                if self.ledger.is_done(sha, action):
+                    log("%s is already done for SHA %s", action, sha)
+                    return
+                async with self.slots:
+                    if not await checks_settled(self.session, sha):
+                        if self.pending[key] > events:
+                            # Another check might have completed in the meantime, look again
+                            continue
+                        return
+                    if await run_action():
+                        self.ledger.mark_done(sha, action)
+                return
+        finally:
+            coalesced = self.pending.pop(key)
+            if coalesced:
+                log("Handled %d events for %s of SHA %s at once", coalesced + 1, action, sha)
+
+    # Cancel the runs that are still waiting, e.g., on shutdown
+    async def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await gather(*self.tasks, return_exceptions=True)
+
+
+_coalescers: "WeakKeyDictionary[ClientSession, EventCoalescer]" = WeakKeyDictionary()
+
+
+# Return the event coalescer bound to a session
+def get_coalescer(session: ClientSession) -> EventCoalescer:
+    coalescer = _coalescers.get(session)
+    if coalescer is None:
+        coalescer = _coalescers[session] = EventCoalescer(session)
+    return coalescer
@@ -4,11 +4,14 @@ import re
 
 from aiohttp import ClientSession
 from typing import List, Tuple
-from yaml import safe_load
 
 from .common import (
     async_exec,
+    create_session,
+    delete_comment,
+    edit_comment,
     fetch_pr_sha_artifacts,
+    get_issue_comments,
     get_job_context,
     get_pr_comment,
     get_pr_info,
@@ -17,12 +20,109 @@ from .common import (
     is_bioconda_member,
     send_comment,
 )
+from .checks import all_checks_passed
+from .coalesce import get_coalescer
+from .github import RECIPES_REPO, get_github
+from .models import JobContext
+from .scheduler import request
+from .tracing import traced
 
 logger = logging.getLogger(__name__)
 log = logger.info
 
+# GitHub rejects comments longer than this
+MAX_COMMENT_SIZE = 65536
+# Room left in each comment for the marker and the continuation/omission notes
+COMMENT_SIZE_RESERVE = 512
+# Larger artifact lists are cut off after this many comments
+MAX_ARTIFACT_COMMENTS = 4
+# Hidden first line of the bot's artifact comments, so they can be found and edited later
+ARTIFACT_COMMENT_MARKER = "<!-- bioconda-bot artifacts"
+ARTIFACT_COMMENT_MARKER_RE = re.compile(r"^<!-- bioconda-bot artifacts sha=(\w+) part=(\d+) -->")
+# First line of a comment that continues the table of the previous one
+CONTINUED_NOTE = "_(continued)_\n\n"
+
+
+def artifact_comment_marker(sha: str, part: int) -> str:
+    return f"{ARTIFACT_COMMENT_MARKER} sha={sha} part={part} -->\n"
+
+
+# Split tables into comment bodies that fit GitHub's size limit
+# Each section is a (header, rows) pair. A table that doesn't fit is continued in the next
+# comment, with its header repeated. Comments beyond max_comments are dropped and the last
+# comment says how many rows are missing.
+def split_comment(
+    sections: List[Tuple[str, List[str]]],
+    max_size: int = MAX_COMMENT_SIZE - COMMENT_SIZE_RESERVE,
+    max_comments: int = MAX_ARTIFACT_COMMENTS,
+) -> List[str]:
+    comments = [""]
+    # Number of table rows in each comment
+    row_counts = [0]
+    for header, rows in sections:
+        if len(comments[-1]) + len(header) > max_size:
+            comments.append("")
+            row_counts.append(0)
+        comments[-1] += header
+        # A row has to fit into a comment of its own, after the note and the header
+        max_row_size = max_size - len(CONTINUED_NOTE) - len(header)
+        for row in rows:
+            if len(row) > max_row_size:
+                row = row[: max_row_size - 2] + "…\n"
+            if len(comments[-1]) + len(row) > max_size:
+                comments.append(f"{CONTINUED_NOTE}{header}")
+                row_counts.append(0)
+            comments[-1] += row
+            row_counts[-1] += 1
+    if len(comments) > max_comments:
+        omitted = sum(row_counts[max_comments:])
+        comments = comments[:max_comments]
+        comments[-1] += f"\n_{omitted} more row(s) omitted, the CI builds list all artifacts._\n"
+    return comments
+
+
+# Create, update or remove the bot's artifact comments on a PR so that they match bodies
+# Unchanged comments are left alone, so repeated events don't cause writes or notifications.
+# Only comments of the bot's own account are touched, anyone could copy the marker. If the
+# bot's login is unknown, new comments are posted.
+async def upsert_artifact_comments(session: ClientSession, pr: int, sha: str, bodies: List[str]) -> None:
+    login = await get_github(session).get_login()
+    existing: List[Tuple[int, int, str]] = []
+    if login is not None:
+        for comment in await get_issue_comments(session, pr):
+            if (comment.get("user") or {}).get("login") != login:
+                continue
+            body = comment.get("body") or ""
+            if match := ARTIFACT_COMMENT_MARKER_RE.match(body):
+                existing.append((int(match.group(2)), comment["id"], body))
+    existing.sort()
+
+    unchanged = 0
+    for part, body in enumerate(bodies):
+        body = artifact_comment_marker(sha, part) + body
+        if part < len(existing):
+            _, comment_id, old_body = existing[part]
+            # GitHub normalizes line endings
+            if old_body.replace("\r\n", "\n") == body:
+                unchanged += 1
+                continue
+            await edit_comment(session, comment_id, body)
+        else:
+            await send_comment(session, pr, body)
+    for _, comment_id, _ in existing[len(bodies):]:
+        await delete_comment(session, comment_id)
+    log(
+        "Artifact comments for PR %d (%s): %d unchanged, %d written, %d removed",
+        pr,
+        sha,
+        unchanged,
+        len(bodies) - unchanged,
+        max(len(existing) - len(bodies), 0),
+    )
 
-# Given a PR and commit sha, post a comment with any artifacts
+
+# Given a PR and commit sha, post (or update) a comment with any artifacts
+@traced
 async def make_artifact_comment(session: ClientSession, pr: int, sha: str) -> None:
     artifactDict = await fetch_pr_sha_artifacts(session, pr, sha)
     
@@ -40,15 +140,16 @@ async def make_artifact_comment(session: ClientSession, pr: int, sha: str) -> No
         elif ci_platform == "github-actions":
             comment += compose_gha_comment(artifacts)
     if len(comment) == 0:
-        comment = ( "No artifacts found on the most recent builds. "
-            "Either the builds failed, the artifacts have been removed due to age, or the recipe was blacklisted/skipped.")
+        sections = [( "No artifacts found on the most recent builds. "
+            "Either the builds failed, the artifacts have been removed due to age, or the recipe was blacklisted/skipped.\n\n", [])]
     else:
-        comment = header + comment
+        sections = [(header, comment.splitlines(keepends=True))]
 
     # Table of containers
     imageHeader = "***\n\nDocker image(s) built:\n\n"
     imageHeader += "Package | Tag | CI | Install with `docker`\n"
     imageHeader += "---------|---------|-----|---------\n"
+    imageRows: List[str] = []
     for [ci_platform, artifacts] in artifactDict.items():
         for URL, artifact in artifacts:
             if artifact.endswith(".tar.gz"):
@@ -60,22 +161,27 @@ async def make_artifact_comment(session: ClientSession, pr: int, sha: str) -> No
                 else:
                     log(f"Skipping image {image_name}: missing separator")
                     continue
-                comment += imageHeader
-                imageHeader = "" # only add the header for the first image
                 if ci_platform == "azure":
-                    comment += f"{package_name} | {tag} | Azure | "
-                    comment += "<details><summary>show</summary>Images for Azure are in the LinuxArtifacts zip file above."
-                    comment += f"`gzip -dc LinuxArtifacts/images/{image_name}.tar.gz \\| docker load`</details>\n"
+                    imageRows.append(
+                        f"{package_name} | {tag} | Azure | "
+                        "<details><summary>show</summary>Images for Azure are in the LinuxArtifacts zip file above."
+                        f"`gzip -dc LinuxArtifacts/images/{image_name}.tar.gz \\| docker load`</details>\n"
+                    )
                 elif ci_platform == "circleci":
-                    comment += f"[{package_name}]({URL}) | {tag} | CircleCI | "
-                    comment += f'<details><summary>show</summary>`curl -L "{URL}" \\| gzip -dc \\| docker load`</details>\n'
+                    imageRows.append(
+                        f"[{package_name}]({URL}) | {tag} | CircleCI | "
+                        f'<details><summary>show</summary>`curl -L "{URL}" \\| gzip -dc \\| docker load`</details>\n'
+                    )
                 elif ci_platform == "github-actions":
-                    comment += f"{package_name} | {tag} | GitHub Actions | "
-                    comment += "<details><summary>show</summary>Images are in the linux-64 zip file above."
-                    comment += f"`gzip -dc images/{image_name}.tar.gz \\| docker load`</details>\n"
-    comment += "\n\n"
-    
-    await send_comment(session, pr, comment)
+                    imageRows.append(
+                        f"{package_name} | {tag} | GitHub Actions | "
+                        "<details><summary>show</summary>Images are in the linux-64 zip file above."
+                        f"`gzip -dc images/{image_name}.tar.gz \\| docker load`</details>\n"
+                    )
+    if imageRows:
+        sections.append((imageHeader, imageRows))
+
+    await upsert_artifact_comments(session, pr, sha, split_comment(sections))
 
 def compose_azure_comment(artifacts: List[Tuple[str, str]]) -> str:
     nPackages = len(artifacts)
@@ -145,17 +251,11 @@ def compose_gha_comment(artifacts: List[Tuple[str, str]]) -> str:
     return comment
 
 # Post a comment on a given PR with its artifacts
+@traced
 async def artifact_checker(session: ClientSession, issue_number: int) -> None:
-    url = f"https://api.github.com/repos/bioconda/bioconda-recipes/pulls/{issue_number}"
-    headers = {
-        "User-Agent": "BiocondaCommentResponder",
-    }
-    async with session.get(url, headers=headers) as response:
-        response.raise_for_status()
-        res = await response.text()
-    pr_info = safe_load(res)
+    pr_info = await get_pr_info(session, issue_number)
 
-    await make_artifact_comment(session, issue_number, pr_info["head"]["sha"])
+    await make_artifact_comment(session, issue_number, pr_info.head_sha)
 
 
 # Reposts a quoted message in a given issue/PR if the user isn't a bioconda member
@@ -173,15 +273,8 @@ async def comment_reposter(session: ClientSession, user: str, pr: int, message:
 
 # Add the "Please review and merge" label to a PR
 async def add_pr_label(session: ClientSession, pr: int) -> None:
-    token = os.environ["BOT_TOKEN"]
-    url = f"https://api.github.com/repos/bioconda/bioconda-recipes/issues/{pr}/labels"
-    headers = {
-        "Authorization": f"token {token}",
-        "User-Agent": "BiocondaCommentResponder",
-    }
     payload = {"labels": ["please review & merge"]}
-    async with session.post(url, headers=headers, json=payload) as response:
-        response.raise_for_status()
+    await get_github(session).request("POST", f"{RECIPES_REPO}/issues/{pr}/labels", json=payload)
 
 
 async def gitter_message(session: ClientSession, msg: str) -> None:
@@ -196,7 +289,7 @@ async def gitter_message(session: ClientSession, msg: str) -> None:
     }
     payload = {"text": msg}
     log("Sending request to %s", url)
-    async with session.post(url, headers=headers, json=payload) as response:
+    async with request(session, "POST", url, headers=headers, json=payload) as response:
         response.raise_for_status()
 
 
@@ -214,13 +307,25 @@ async def notify_ready(session: ClientSession, pr: int) -> None:
 # This requires that a JOB_CONTEXT environment variable, which is made with `toJson(github)`
 async def main() -> None:
     job_context = await get_job_context()
+    async with create_session() as session:
+        await handle(session, job_context)
+
 
-    sha = await get_sha_for_status_check(job_context)
+# Respond to one event, this is shared by main and the webhook server
+async def handle(session: ClientSession, job_context: JobContext) -> None:
+    # Failed checks count as well: the coalescer waits for the last check of the sha to finish,
+    # which may be one that failed, and the builds that passed still get their artifact list.
+    sha = await get_sha_for_status_check(job_context, finished=True)
     if sha:
-        # This is a successful status or check_suite event => post artifact lists.
-        async with ClientSession() as session:
-            for pr in await get_prs_for_sha(session, sha):
+        # This is a finished status or check_suite event => post artifact lists.
+        async def post_artifact_lists() -> bool:
+            prs = await get_prs_for_sha(session, sha)
+            for pr in prs:
                 await artifact_checker(session, pr)
+            # Re-run checks that pass later should update the list, so it's only final once all passed
+            return bool(prs) and await all_checks_passed(session, sha)
+
+        await get_coalescer(session).run(sha, "artifacts", post_artifact_lists)
         return
 
     issue_number, original_comment = await get_pr_comment(job_context)
@@ -228,31 +333,30 @@ async def main() -> None:
         return
 
     comment = original_comment.lower()
-    async with ClientSession() as session:
-        if comment.startswith(("@bioconda-bot", "@biocondabot")):
-            if "please update" in comment:
-                log("This should have been directly invoked via bioconda-bot-update")
-                from .update import update_from_master
-
-                await update_from_master(session, issue_number)
-            elif " hello" in comment:
-                await send_comment(session, issue_number, "Yes?")
-            elif " please fetch artifacts" in comment or " please fetch artefacts" in comment:
-                await artifact_checker(session, issue_number)
-            #elif " please merge" in comment:
-            #    await send_comment(session, issue_number, "Sorry, I'm currently disabled")
-            #    #log("This should have been directly invoked via bioconda-bot-merge")
-            #    #from .merge import request_merge
-            #    #await request_merge(session, issue_number)
-            elif " please add label" in comment:
-                await add_pr_label(session, issue_number)
-                await notify_ready(session, issue_number)
-            # else:
-            #    # Methods in development can go below, flanked by checking who is running them
-            #      if job_context["actor"] != "dpryan79":
-            #          console.log("skipping")
-            #          sys.exit(0)
-        elif "@bioconda/" in comment:
-            await comment_reposter(
-                session, job_context["actor"], issue_number, original_comment
-            )
+    if comment.startswith(("@bioconda-bot", "@biocondabot")):
+        if "please update" in comment:
+            log("This should have been directly invoked via bioconda-bot-update")
+            from .update import update_from_master
+
+            await update_from_master(session, issue_number)
+        elif " hello" in comment:
+            await send_comment(session, issue_number, "Yes?")
+        elif " please fetch artifacts" in comment or " please fetch artefacts" in comment:
+            await artifact_checker(session, issue_number)
+        #elif " please merge" in comment:
+        #    await send_comment(session, issue_number, "Sorry, I'm currently disabled")
+        #    #log("This should have been directly invoked via bioconda-bot-merge")
+        #    #from .merge import request_merge
+        #    #await request_merge(session, issue_number)
+        elif " please add label" in comment:
+            await add_pr_label(session, issue_number)
+            await notify_ready(session, issue_number)
+        # else:
+        #    # Methods in development can go below, flanked by checking who is running them
+        #      if job_context.actor != "dpryan79":
+        #          console.log("skipping")
+        #          sys.exit(0)
+    elif "@bioconda/" in comment:
+        await comment_reposter(
+            session, job_context.actor, issue_number, original_comment
+        )
@@ -2,138 +2,293 @@ import logging
 import os
 import re
 import sys
-from asyncio import gather, sleep
-from asyncio.subprocess import create_subprocess_exec
+from asyncio import Semaphore, gather, sleep
+from asyncio.subprocess import PIPE, create_subprocess_exec
+from json import loads
+from contextlib import asynccontextmanager
 from pathlib import Path
 from shutil import which
-from typing import Any, Dict, List, Optional, Set, Tuple, Mapping
+from tempfile import TemporaryDirectory
+from typing import Any, AsyncIterator, Awaitable, Dict, List, Optional, Set, Tuple, Mapping, TypeVar
 from zipfile import ZipFile
 
-from aiohttp import ClientSession
-from yaml import safe_load
+from aiohttp import ClientSession, TCPConnector
+
+from .cache import get_artifact_cache, link_or_copy
+from .checks import CheckRunSnapshot, get_check_run_snapshot
+from .download import DownloadUnavailable, stream_download
+from .github import RECIPES_REPO, get_github, save_github
+from .members import get_member_roster
+from .models import Artifact, JobContext, PullRequest
+from .pr_index import PRHeadIndex
+from .scheduler import get_scheduler, request
+from .remote_zip import list_remote_zip_contents
+from .tracing import get_tracer, span
 
 logger = logging.getLogger(__name__)
 log = logger.info
 
+T = TypeVar("T")
+
+# Maximum number of concurrent requests to CI providers when looking for artifacts
+MAX_ARTIFACT_REQUESTS = 8
+
+# Connection pool limits of the bot's HTTP session
+MAX_CONNECTIONS = 32
+MAX_CONNECTIONS_PER_HOST = 16
+
 
 async def async_exec(
     command: str, *arguments: str, env: Optional[Dict[str, str]] = None
 ) -> None:
-    process = await create_subprocess_exec(command, *arguments, env=env)
-    return_code = await process.wait()
-    if return_code != 0:
-        raise RuntimeError(
-            f"Failed to execute {command} {arguments} (return code: {return_code})"
-        )
+    with span("exec", os.path.basename(command), subcommand=arguments[0] if arguments else None) as exec_span:
+        process = await create_subprocess_exec(command, *arguments, env=env)
+        return_code = await process.wait()
+        exec_span.set(return_code=return_code)
+        if return_code != 0:
+            raise RuntimeError(
+                f"Failed to execute {command} {arguments} (return code: {return_code})"
+            )
+
+
+# Run a command and return its return code and output, non-zero return codes don't raise
+async def async_exec_output(
+    command: str, *arguments: str, env: Optional[Dict[str, str]] = None
+) -> Tuple[int, str]:
+    with span("exec", os.path.basename(command), subcommand=arguments[0] if arguments else None) as exec_span:
+        process = await create_subprocess_exec(command, *arguments, env=env, stdout=PIPE)
+        stdout, _ = await process.communicate()
+        exec_span.set(return_code=process.returncode)
+    return process.returncode, stdout.decode()
+
+
+# Create a session with a connection pool sized for the bot's concurrent requests
+# The GitHub client's conditional request cache is saved, the requests sent per host are
+# logged and the trace is exported when the session is closed.
+@asynccontextmanager
+async def create_session() -> AsyncIterator[ClientSession]:
+    connector = TCPConnector(
+        limit=MAX_CONNECTIONS,
+        limit_per_host=MAX_CONNECTIONS_PER_HOST,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+    )
+    async with ClientSession(connector=connector) as session:
+        try:
+            yield session
+        finally:
+            save_github(session)
+            get_scheduler(session).log_usage()
+            get_tracer().log_summary()
+            get_tracer().export()
 
 
 # Post a comment on a given issue/PR with text in message
 async def send_comment(session: ClientSession, issue_number: int, message: str) -> None:
-    token = os.environ["BOT_TOKEN"]
-    url = (
-        f"https://api.github.com/repos/bioconda/bioconda-recipes/issues/{issue_number}/comments"
-    )
-    headers = {
-        "Authorization": f"token {token}",
-        "User-Agent": "BiocondaCommentResponder",
-    }
+    path = f"{RECIPES_REPO}/issues/{issue_number}/comments"
     payload = {"body": message}
-    log("Sending comment: url=%s", url)
+    log("Sending comment: url=%s", path)
     log("Sending comment: payload=%s", payload)
-    async with session.post(url, headers=headers, json=payload) as response:
-        status_code = response.status
-        log("the response code was %d", status_code)
-        if status_code < 200 or status_code > 202:
-            sys.exit(1)
+    response = await get_github(session).request(
+        "POST", path, json=payload, raise_for_status=False
+    )
+    status_code = response.status
+    log("the response code was %d", status_code)
+    if status_code < 200 or status_code > 202:
+        raise RuntimeError(f"Failed to send comment to {issue_number} (status: {status_code})")
+
+
+# Replace the text of an existing comment
+async def edit_comment(session: ClientSession, comment_id: int, message: str) -> None:
+    path = f"{RECIPES_REPO}/issues/comments/{comment_id}"
+    log("Editing comment: url=%s", path)
+    response = await get_github(session).request(
+        "PATCH", path, json={"body": message}, raise_for_status=False
+    )
+    if response.status != 200:
+        raise RuntimeError(f"Failed to edit comment {comment_id} (status: {response.status})")
+
+
+async def delete_comment(session: ClientSession, comment_id: int) -> None:
+    path = f"{RECIPES_REPO}/issues/comments/{comment_id}"
+    log("Deleting comment: url=%s", path)
+    response = await get_github(session).request("DELETE", path, raise_for_status=False)
+    if response.status not in (204, 404):
+        raise RuntimeError(f"Failed to delete comment {comment_id} (status: {response.status})")
+
+
+# Return all comments on an issue/PR, oldest first
+async def get_issue_comments(session: ClientSession, issue_number: int) -> List[Dict[str, Any]]:
+    github = get_github(session)
+    per_page = 100
+    comments: List[Dict[str, Any]] = []
+    page = 1
+    while True:
+        page_comments = await github.get_json(
+            f"{RECIPES_REPO}/issues/{issue_number}/comments",
+            params={"per_page": per_page, "page": page},
+        )
+        comments.extend(page_comments)
+        if len(page_comments) < per_page:
+            return comments
+        page += 1
 
 
 # Return true if a user is a member of bioconda
 async def is_bioconda_member(session: ClientSession, user: str) -> bool:
-    token = os.environ["BOT_TOKEN"]
-    url = f"https://api.github.com/orgs/bioconda/members/{user}"
-    headers = {
-        "Authorization": f"token {token}",
-        "User-Agent": "BiocondaCommentResponder",
-    }
-    rc = 404
-    async with session.get(url, headers=headers) as response:
-        try:
-            response.raise_for_status()
-            rc = response.status
-        except:
-            # Do nothing, this just prevents things from crashing on 404
-            pass
-
-    return rc == 204
+    return await get_member_roster(session).is_member(get_github(session), user)
 
 
 # Fetch and return the JSON of a PR
 # This can be run to trigger a test merge
-async def get_pr_info(session: ClientSession, pr: int) -> Any:
-    token = os.environ["BOT_TOKEN"]
-    url = f"https://api.github.com/repos/bioconda/bioconda-recipes/pulls/{pr}"
-    headers = {
-        "Authorization": f"token {token}",
-        "User-Agent": "BiocondaCommentResponder",
-    }
-    async with session.get(url, headers=headers) as response:
-        response.raise_for_status()
-        res = await response.text()
-    pr_info = safe_load(res)
-    return pr_info
+async def get_pr_info(session: ClientSession, pr: int) -> PullRequest:
+    return PullRequest.from_json(await get_github(session).get_json(f"{RECIPES_REPO}/pulls/{pr}"))
 
 
-def list_zip_contents(fname: str) -> [str]:
-    f = ZipFile(fname)
-    return [
-        e.filename
-        for e in f.infolist()
-        if e.filename.endswith((".tar.gz", ".conda", ".tar.bz2"))
-    ]
+# Open PRs with a label, by number
+async def list_labeled_prs(session: ClientSession, label: str, max_pages: int = 10) -> List[int]:
+    github = get_github(session)
+    per_page = 100
+    prs: List[int] = []
+    for page in range(1, max_pages + 1):
+        # The issues endpoint can filter by label, it lists PRs too
+        issues = await github.get_json(
+            f"{RECIPES_REPO}/issues",
+            params={"labels": label, "state": "open", "per_page": per_page, "page": page},
+        )
+        prs.extend(issue["number"] for issue in issues if issue.get("pull_request"))
+        if len(issues) < per_page:
+            break
+    return sorted(prs)
 
 
-# Download a zip file from url to zipName.zip and return that path
-# Timeout is 30 minutes to compensate for any network issues
-async def download_file(session: ClientSession, zipName: str, url: str, headers: Optional[Mapping[str, str]] = None) -> str:
-    async with session.get(url, timeout=60*30, headers=headers) as response:
-        if response.status == 200:
-            ofile = f"{zipName}.zip"
-            with open(ofile, 'wb') as fd:
-                while True:
-                    chunk = await response.content.read(1024*1024*1024)
-                    if not chunk:
-                        break
-                    fd.write(chunk)
-            return ofile
-    return None
+def filter_artifact_names(names: List[str]) -> [str]:
+    return [name for name in names if name.endswith((".tar.gz", ".conda", ".tar.bz2"))]
 
 
-# Find artifact zip files, download them and return their URLs and contents
-async def fetch_azure_zip_files(session: ClientSession, buildId: str) -> [(str, str)]:
+def list_zip_contents(fname: str) -> [str]:
+    f = ZipFile(fname)
+    return filter_artifact_names([e.filename for e in f.infolist()])
+
+
+# Download a zip file from url to zipName.zip (in directory, if given) and return that path
+# If a cache_key is given, the zip is stored in (or served from) the artifact cache and
+# linked to that path. Broken off transfers are resumed and the result is verified against
+# the announced size and expected_sha256 (if given).
+async def download_file(
+    session: ClientSession,
+    zipName: str,
+    url: str,
+    headers: Optional[Mapping[str, str]] = None,
+    directory: Optional[str] = None,
+    cache_key: Optional[Tuple[str, ...]] = None,
+    expected_sha256: Optional[str] = None,
+) -> str:
+    ofile = f"{zipName}.zip"
+    if directory:
+        ofile = os.path.join(directory, ofile)
+    cache = get_artifact_cache() if cache_key else None
+    try:
+        if cache:
+            cached = cache.get(cache_key)
+            if not cached:
+                with cache.open_for_write(cache_key) as fd:
+                    await stream_download(session, url, fd, headers, expected_sha256)
+                cached = str(cache.path(cache_key))
+            link_or_copy(cached, ofile)
+        else:
+            try:
+                with open(ofile, 'wb') as fd:
+                    await stream_download(session, url, fd, headers, expected_sha256)
+            except BaseException:
+                os.remove(ofile)
+                raise
+    except DownloadUnavailable as e:
+        log("Not downloading: %s", e)
+        return None
+    return ofile
+
+
+# Await aw while holding one of the slots of semaphore
+async def bounded(semaphore: Semaphore, aw: Awaitable[T]) -> T:
+    async with semaphore:
+        return await aw
+
+
+# List the packages and images in an artifact zip file
+# Zips in the artifact cache are read locally. Otherwise only the zip index is fetched,
+# unless the server ignores Range requests or a workdir is given (e.g., because the
+# artifacts are about to be uploaded), in which case the zip is kept there.
+async def fetch_zip_contents(
+    session: ClientSession,
+    zipName: str,
+    url: str,
+    headers: Optional[Mapping[str, str]] = None,
+    workdir: Optional[str] = None,
+    cache_key: Optional[Tuple[str, ...]] = None,
+    expected_sha256: Optional[str] = None,
+) -> Optional[List[str]]:
+    cache = get_artifact_cache() if cache_key else None
+    cached = cache.get(cache_key) if cache else None
+    if cached and not workdir:
+        return list_zip_contents(cached)
+    if workdir:
+        fname = await download_file(
+            session, zipName, url, headers, workdir, cache_key, expected_sha256
+        )
+        return list_zip_contents(fname) if fname else None
+    names = await list_remote_zip_contents(session, url, headers)
+    if names is not None:
+        return filter_artifact_names(names)
+    # Each fallback download gets its own directory, so concurrent downloads never share a file
+    with TemporaryDirectory() as tmpdir:
+        fname = await download_file(
+            session, zipName, url, headers, tmpdir, cache_key, expected_sha256
+        )
+        return list_zip_contents(fname) if fname else None
+
+
+# Find artifact zip files and return their URLs and contents
+async def fetch_azure_zip_files(
+    session: ClientSession,
+    buildId: str,
+    workdir: Optional[str] = None,
+    semaphore: Optional[Semaphore] = None,
+) -> [(str, str)]:
     artifacts = []
+    semaphore = semaphore or Semaphore(MAX_ARTIFACT_REQUESTS)
 
     url = f"https://dev.azure.com/bioconda/bioconda-recipes/_apis/build/builds/{buildId}/artifacts?api-version=4.1"
     log("contacting azure %s", url)
-    async with session.get(url) as response:
+    async with semaphore, request(session, "GET", url) as response:
         # Sometimes we get a 301 error, so there are no longer artifacts available
         if response.status == 301 or response.status == 404:
             return artifacts
         res = await response.text()
 
-    res_object = safe_load(res)
+    res_object = loads(res)
     if res_object['count'] == 0:
         return artifacts
 
-    for artifact in res_object['value']:
-        zipName = artifact['name']  # LinuxArtifacts or OSXArtifacts
-        zipUrl = artifact['resource']['downloadUrl']
+    async def fetch_artifact(artifact: Artifact) -> [(str, str)]:
+        zipName = artifact.name  # LinuxArtifacts or OSXArtifacts
+        zipUrl = artifact.url
         log(f"zip name is {zipName} url {zipUrl}")
-        fname = await download_file(session, zipName, zipUrl)
-        if not fname:
-            continue
-        pkgsImages = list_zip_contents(fname)
-        for pkg in pkgsImages:
-            artifacts.append((zipUrl, pkg))
+        pkgsImages = await bounded(
+            semaphore,
+            fetch_zip_contents(
+                session,
+                zipName,
+                zipUrl,
+                workdir=workdir,
+                cache_key=("azure", buildId, artifact.id),
+            ),
+        )
+        return [(zipUrl, pkg) for pkg in pkgsImages or []]
+
+    azure_artifacts = [Artifact.from_azure_json(artifact) for artifact in res_object['value']]
+    for zipFiles in await gather(*map(fetch_artifact, azure_artifacts)):
+        artifacts.extend(zipFiles)
 
     return artifacts
 
@@ -142,70 +297,93 @@ def parse_azure_build_id(url: str) -> str:
     return re.search("buildId=(\d+)", url).group(1)
 
 # Find artifact zip files, download them and return their URLs and contents
-async def fetch_circleci_artifacts(session: ClientSession, workflowId: str) -> [(str, str)]:
+async def fetch_circleci_artifacts(
+    session: ClientSession, workflowId: str, semaphore: Optional[Semaphore] = None
+) -> [(str, str)]:
     artifacts = []
+    semaphore = semaphore or Semaphore(MAX_ARTIFACT_REQUESTS)
 
     url_wf = f"https://circleci.com/api/v2/workflow/{workflowId}/job"
-    async with session.get(url_wf) as response:
+    async with semaphore, request(session, "GET", url_wf) as response:
         # Sometimes we get a 301 error, so there are no longer artifacts available
         if response.status == 301:
             return artifacts
         res_wf = await response.text()
 
-    res_wf_object = safe_load(res_wf)
+    res_wf_object = loads(res_wf)
 
-    if len(res_wf_object["items"]) == 0:
-        return artifacts
-    else:
-        for job in res_wf_object["items"]:
-            if job["name"].startswith(f"build_and_test-"):
-                circleci_job_num = job["job_number"]
-                url = f"https://circleci.com/api/v1.1/project/gh/bioconda/bioconda-recipes/{circleci_job_num}/artifacts"
-
-                async with session.get(url) as response:
-                    response.raise_for_status()
-                    res = await response.text()
-                res_object = safe_load(res)
-                for artifact in res_object:
-                    zipUrl = artifact["url"]
-                    pkg = artifact["path"]
-                    if zipUrl.endswith((".conda", ".tar.bz2")): # (currently excluding container images) or zipUrl.endswith(".tar.gz"):
-                        artifacts.append((zipUrl, pkg))
-        return artifacts
+    async def fetch_job_artifacts(circleci_job_num: int) -> [(str, str)]:
+        url = f"https://circleci.com/api/v1.1/project/gh/bioconda/bioconda-recipes/{circleci_job_num}/artifacts"
+
+        async with semaphore, request(session, "GET", url) as response:
+            response.raise_for_status()
+            res = await response.text()
+        res_object = loads(res)
+        return [
+            (artifact["url"], artifact["path"])
+            for artifact in res_object
+            if artifact["url"].endswith((".conda", ".tar.bz2")) # (currently excluding container images) or zipUrl.endswith(".tar.gz"):
+        ]
+
+    jobs = [
+        job["job_number"]
+        for job in res_wf_object["items"]
+        if job["name"].startswith(f"build_and_test-")
+    ]
+    for jobArtifacts in await gather(*map(fetch_job_artifacts, jobs)):
+        artifacts.extend(jobArtifacts)
+    return artifacts
 
 
-# Find artifact zip files, download them and return their URLs and contents
-async def fetch_gha_zip_files(session: ClientSession, workflowId: str) -> [(str, str)]:
+# Find artifact zip files and return their URLs and contents
+async def fetch_gha_zip_files(
+    session: ClientSession,
+    workflowId: str,
+    workdir: Optional[str] = None,
+    semaphore: Optional[Semaphore] = None,
+) -> [(str, str)]:
     artifacts = []
-    token = os.environ["BOT_TOKEN"]
-    headers = {
-        "Authorization": f"token {token}",
-        "User-Agent": "BiocondaCommentResponder",
-    }
+    semaphore = semaphore or Semaphore(MAX_ARTIFACT_REQUESTS)
+    github = get_github(session)
     # GitHub Actions uses two different URLs, one for downloading from a browser and another for API downloads
-    url = f"https://api.github.com/repos/bioconda/bioconda-recipes/actions/runs/{workflowId}/artifacts"
-    log("contacting github actions %s", url)
-    async with session.get(url, headers=headers) as response:
-        # Sometimes we get a 301 error, so there are no longer artifacts available
-        if response.status == 301:
-            return artifacts
-        res = await response.text()
-
-    res_object = safe_load(res)
+    path = f"{RECIPES_REPO}/actions/runs/{workflowId}/artifacts"
+    log("contacting github actions %s", path)
+    async with semaphore:
+        response = await github.get(path, raise_for_status=False)
+    # Sometimes we get a 301 error, so there are no longer artifacts available
+    if response.status == 301:
+        return artifacts
+    res_object = response.json()
     if res_object['total_count'] == 0:
         return artifacts
 
-    for artifact in res_object['artifacts']:
-        zipName = artifact['name']
-        zipUrl = artifact['archive_download_url']
+    async def fetch_artifact(artifact: Artifact) -> [(str, str)]:
+        zipName = artifact.name
+        zipUrl = artifact.url
         log(f"zip name is {zipName} url {zipUrl}")
-        fname = await download_file(session, zipName, zipUrl, headers)
-        if not fname:
-            continue
-        pkgsImages = list_zip_contents(fname)
-        commentZipUrl = f"https://github.com/bioconda/bioconda-recipes/actions/runs/{workflowId}/artifacts/{artifact['id']}"
-        for pkg in pkgsImages:
-            artifacts.append((commentZipUrl, pkg))
+        pkgsImages = await bounded(
+            semaphore,
+            fetch_zip_contents(
+                session,
+                zipName,
+                zipUrl,
+                github.headers,
+                workdir=workdir,
+                cache_key=(
+                    "github-actions",
+                    workflowId,
+                    artifact.id,
+                    artifact.digest or "",
+                ),
+                expected_sha256=artifact.sha256,
+            ),
+        )
+        commentZipUrl = f"https://github.com/bioconda/bioconda-recipes/actions/runs/{workflowId}/artifacts/{artifact.id}"
+        return [(commentZipUrl, pkg) for pkg in pkgsImages or []]
+
+    gha_artifacts = Artifact.from_json_list(res_object['artifacts'])
+    for zipFiles in await gather(*map(fetch_artifact, gha_artifacts)):
+        artifacts.extend(zipFiles)
 
     return artifacts
 
@@ -214,56 +392,70 @@ def parse_gha_build_id(url: str) -> str:
 
 
 # Given a PR and commit sha, fetch a list of the artifact zip files URLs and their contents
-async def fetch_pr_sha_artifacts(session: ClientSession, pr: int, sha: str) -> Dict[str, List[Tuple[str, str]]]:
-    url = f"https://api.github.com/repos/bioconda/bioconda-recipes/commits/{sha}/check-runs"
-
-    headers = {
-        "User-Agent": "BiocondaCommentResponder",
-        "Accept": "application/vnd.github.antiope-preview+json",
-    }
-    async with session.get(url, headers=headers) as response:
-        response.raise_for_status()
-        res = await response.text()
-    check_runs = safe_load(res)
-
-    artifact_sources = {}
-    for check_run in check_runs["check_runs"]:
+# All CI providers and their artifacts are queried concurrently, with at most
+# max_requests requests in flight. If workdir is given, the Azure/GitHub Actions zip
+# files are downloaded to workdir/azure and workdir/github-actions.
+async def fetch_pr_sha_artifacts(
+    session: ClientSession,
+    pr: int,
+    sha: str,
+    workdir: Optional[str] = None,
+    max_requests: int = MAX_ARTIFACT_REQUESTS,
+    snapshot: Optional[CheckRunSnapshot] = None,
+) -> Dict[str, List[Tuple[str, str]]]:
+    snapshot = snapshot or await get_check_run_snapshot(session, sha)
+
+    def provider_workdir(provider: str) -> Optional[str]:
+        if not workdir:
+            return None
+        path = os.path.join(workdir, provider)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    semaphore = Semaphore(max_requests)
+    fetches = {}
+    for check_run in snapshot.check_runs:
         if (
-            "azure" not in artifact_sources and 
-            check_run["app"]["slug"] == "azure-pipelines" and
-            check_run["name"].startswith("bioconda.bioconda-recipes (test_")
+            "azure" not in fetches and
+            check_run.app == "azure-pipelines" and
+            check_run.name.startswith("bioconda.bioconda-recipes (test_")
         ):
             # azure builds
             # The azure build ID is in the details_url as buildId=\d+
-            buildID = parse_azure_build_id(check_run["details_url"])
-            zipFiles = await fetch_azure_zip_files(session, buildID)
-            artifact_sources["azure"] = zipFiles  # We've already fetched all possible artifacts from Azure
+            buildID = parse_azure_build_id(check_run.details_url)
+            fetches["azure"] = fetch_azure_zip_files(
+                session, buildID, provider_workdir("azure"), semaphore
+            )
         elif (
-            "circleci" not in artifact_sources and 
-            check_run["app"]["slug"] == "circleci-checks"
+            "circleci" not in fetches and
+            check_run.app == "circleci-checks"
         ):
             # Circle CI builds
-            workflowId = safe_load(check_run["external_id"])["workflow-id"]
-            zipFiles = await fetch_circleci_artifacts(session, workflowId)
-            artifact_sources["circleci"] = zipFiles  # We've already fetched all possible artifacts from CircleCI
+            workflowId = loads(check_run.external_id)["workflow-id"]
+            fetches["circleci"] = fetch_circleci_artifacts(session, workflowId, semaphore)
         elif (
-            "github-actions" not in artifact_sources and 
-            check_run["app"]["slug"] == "github-actions"
+            "github-actions" not in fetches and
+            check_run.app == "github-actions"
         ):
             # GitHub Actions builds
-            buildID = parse_gha_build_id(check_run["details_url"])
-            zipFiles = await fetch_gha_zip_files(session, buildID)
-            artifact_sources["github-actions"] = zipFiles  # We've already fetched all possible artifacts from GitHub Actions
+            buildID = parse_gha_build_id(check_run.details_url)
+            fetches["github-actions"] = fetch_gha_zip_files(
+                session, buildID, provider_workdir("github-actions"), semaphore
+            )
 
+    # We only need the first check run of each provider to fetch all of its artifacts
+    artifact_sources = dict(zip(fetches.keys(), await gather(*fetches.values())))
     return artifact_sources
 
 
-async def get_sha_for_status(job_context: Dict[str, Any]) -> Optional[str]:
-    if job_context["event_name"] != "status":
+# With finished=True, failed checks count as well, otherwise only successful ones
+async def get_sha_for_status(job_context: JobContext, finished: bool = False) -> Optional[str]:
+    if job_context.event_name != "status":
         return None
     log("Got %s event", "status")
-    event = job_context["event"]
-    if event["state"] != "success":
+    event = job_context.event
+    state = event["state"]
+    if state == "pending" or (state != "success" and not finished):
         return None
     branches = event.get("branches")
     if not branches:
@@ -274,13 +466,14 @@ async def get_sha_for_status(job_context: Dict[str, Any]) -> Optional[str]:
 
 
 async def get_sha_for_check_suite_or_workflow(
-    job_context: Dict[str, Any], event_name: str
+    job_context: JobContext, event_name: str, finished: bool = False
 ) -> Optional[str]:
-    if job_context["event_name"] != event_name:
+    if job_context.event_name != event_name:
         return None
     log("Got %s event", event_name)
-    event_source = job_context["event"][event_name]
-    if event_source["conclusion"] != "success":
+    event_source = job_context.event[event_name]
+    conclusion = event_source["conclusion"]
+    if conclusion is None or (conclusion != "success" and not finished):
         return None
     sha: Optional[str] = event_source.get("head_sha")
     if not sha:
@@ -293,50 +486,69 @@ async def get_sha_for_check_suite_or_workflow(
     return sha
 
 
-async def get_sha_for_check_suite(job_context: Dict[str, Any]) -> Optional[str]:
-    return await get_sha_for_check_suite_or_workflow(job_context, "check_suite")
+async def get_sha_for_check_suite(job_context: JobContext, finished: bool = False) -> Optional[str]:
+    return await get_sha_for_check_suite_or_workflow(job_context, "check_suite", finished)
 
 
-async def get_sha_for_workflow_run(job_context: Dict[str, Any]) -> Optional[str]:
-    return await get_sha_for_check_suite_or_workflow(job_context, "workflow_run")
+async def get_sha_for_workflow_run(job_context: JobContext, finished: bool = False) -> Optional[str]:
+    return await get_sha_for_check_suite_or_workflow(job_context, "workflow_run", finished)
 
 
-async def get_prs_for_sha(session: ClientSession, sha: str) -> List[int]:
-    headers = {
-        "User-Agent": "BiocondaCommentResponder",
-        "Accept": "application/vnd.github.v3+json",
-    }
+# Scan all open PRs for the ones with the given head sha
+async def scan_prs_for_sha(session: ClientSession, sha: str) -> List[int]:
+    github = get_github(session)
     pr_numbers: List[int] = []
     per_page = 100
     for page in range(1, 20):
-        url = (
-            "https://api.github.com/repos/bioconda/bioconda-recipes/pulls"
-            f"?per_page={per_page}"
-            f"&page={page}"
+        prs = await github.get_json(
+            f"{RECIPES_REPO}/pulls", params={"per_page": per_page, "page": page}
         )
-        async with session.get(url, headers=headers) as response:
-            response.raise_for_status()
-            res = await response.text()
-        prs = safe_load(res)
-        pr_numbers.extend(pr["number"] for pr in prs if pr["head"]["sha"] == sha)
+        pr_numbers.extend(pr.number for pr in PullRequest.from_json_list(prs) if pr.head_sha == sha)
         if len(prs) < per_page:
             break
     return pr_numbers
 
 
-async def get_sha_for_status_check(job_context: Dict[str, Any]) -> Optional[str]:
-    return await get_sha_for_status(job_context) or await get_sha_for_check_suite(job_context)
+# Return the open PRs whose head is sha
+# Ask GitHub for the PRs associated with the commit first, then look the sha up in the
+# (incrementally refreshed) head index. Only scan all open PRs if both come up empty.
+async def get_prs_for_sha(session: ClientSession, sha: str) -> List[int]:
+    github = get_github(session)
+    prs = await github.get_json(f"{RECIPES_REPO}/commits/{sha}/pulls")
+    pr_numbers = [
+        pr.number
+        for pr in PullRequest.from_json_list(prs)
+        if pr.state == "open" and pr.head_sha == sha
+    ]
+    if pr_numbers:
+        log("Found PRs %s for SHA %s via commit", pr_numbers, sha)
+        return pr_numbers
+
+    index = PRHeadIndex()
+    is_refreshed = await index.refresh(github)
+    index.save()
+    pr_numbers = index.lookup(sha)
+    if pr_numbers or is_refreshed:
+        log("Found PRs %s for SHA %s via head index", pr_numbers, sha)
+        return pr_numbers
+
+    log("Scanning all open PRs for SHA %s", sha)
+    return await scan_prs_for_sha(session, sha)
+
+
+async def get_sha_for_status_check(job_context: JobContext, finished: bool = False) -> Optional[str]:
+    return await get_sha_for_status(job_context, finished) or await get_sha_for_check_suite(job_context, finished)
 
 
-async def get_job_context() -> Any:
-    job_context = safe_load(os.environ["JOB_CONTEXT"])
+async def get_job_context() -> JobContext:
+    job_context = JobContext.parse(os.environ["JOB_CONTEXT"])
     log("%s", job_context)
     return job_context
 
 
-async def get_pr_comment(job_context: Dict[str, Any]) -> Tuple[Optional[int], Optional[str]]:
-    event = job_context["event"]
-    if event["issue"].get("pull_request") is None:
+async def get_pr_comment(job_context: JobContext) -> Tuple[Optional[int], Optional[str]]:
+    event = job_context.event
+    if job_context.event_name != "issue_comment" or event["issue"].get("pull_request") is None:
         return None, None
     issue_number = event["issue"]["number"]
 
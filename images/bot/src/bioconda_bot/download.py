@@ -0,0 +1,146 @@
+import logging
+import time
+from asyncio import TimeoutError, sleep
+from hashlib import sha256
+from typing import BinaryIO, Mapping, Optional
+from urllib.parse import urlsplit
+
+from aiohttp import ClientConnectionError, ClientPayloadError, ClientSession, ClientTimeout
+
+from .scheduler import request
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+# Size of the reads from the response, this bounds the memory used per download
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+# Log progress every time this many bytes were downloaded
+PROGRESS_INTERVAL = 100 * 1024 ** 2
+# How often a dropped transfer is resumed before giving up
+MAX_RESUMES = 5
+# No total timeout, large artifacts can take long, but give up on stalled connections
+DOWNLOAD_TIMEOUT = ClientTimeout(total=None, sock_connect=60, sock_read=300)
+
+
+class DownloadError(Exception):
+    pass
+
+
+# The server didn't answer with 200 (e.g., because the artifact expired)
+class DownloadUnavailable(DownloadError):
+    pass
+
+
+# Size, duration and number of resumes of a finished download
+class DownloadStats:
+    __slots__ = ("size", "seconds", "resumes", "sha256")
+
+    def __init__(self, size: int, seconds: float, resumes: int, sha256: str) -> None:
+        self.size = size
+        self.seconds = seconds
+        self.resumes = resumes
+        self.sha256 = sha256
+
+    @property
+    def throughput(self) -> float:
+        return self.size / max(self.seconds, 1e-6)
+
+
+# Stream url into fd with a fixed size buffer
+# A transfer that breaks off is resumed with a Range request from the last written byte
+# (or restarted if the server doesn't honor it). The result is checked against the size
+# announced by the server and, if given, expected_sha256.
+async def stream_download(
+    session: ClientSession,
+    url: str,
+    fd: BinaryIO,
+    headers: Optional[Mapping[str, str]] = None,
+    expected_sha256: Optional[str] = None,
+) -> DownloadStats:
+    with span("download", urlsplit(url).hostname or "", url=url) as download_span:
+        stats = await stream_download_runner(session, url, fd, headers, expected_sha256)
+        download_span.set(bytes=stats.size, resumes=stats.resumes)
+        return stats
+
+
+async def stream_download_runner(
+    session: ClientSession,
+    url: str,
+    fd: BinaryIO,
+    headers: Optional[Mapping[str, str]],
+    expected_sha256: Optional[str],
+) -> DownloadStats:
+    start_time = time.monotonic()
+    written = 0
+    checksum = sha256()
+    total_size: Optional[int] = None
+    etag: Optional[str] = None
+    resumes = 0
+    next_progress = PROGRESS_INTERVAL
+    while True:
+        request_headers = dict(headers or {})
+        if written:
+            request_headers["Range"] = f"bytes={written}-"
+            if etag:
+                # Only resume if the file didn't change in the meantime
+                request_headers["If-Range"] = etag
+        try:
+            async with request(
+                session, "GET", url, headers=request_headers, timeout=DOWNLOAD_TIMEOUT
+            ) as response:
+                if written and response.status == 206:
+                    log("Resuming download of %s at %d bytes", url, written)
+                elif response.status == 200:
+                    if written:
+                        log("Server ignored the Range request, restarting download of %s", url)
+                        fd.seek(0)
+                        fd.truncate()
+                        written = 0
+                        checksum = sha256()
+                        next_progress = PROGRESS_INTERVAL
+                    # The announced size is of the encoded body if a Content-Encoding is used
+                    if response.headers.get("Content-Encoding", "identity") == "identity":
+                        total_size = response.content_length
+                    etag = response.headers.get("ETag")
+                elif written:
+                    raise DownloadError(f"Resuming {url} failed with status {response.status}")
+                else:
+                    raise DownloadUnavailable(f"{url} returned status {response.status}")
+                async for chunk in response.content.iter_chunked(DOWNLOAD_BUFFER_SIZE):
+                    fd.write(chunk)
+                    checksum.update(chunk)
+                    written += len(chunk)
+                    if written >= next_progress:
+                        elapsed = time.monotonic() - start_time
+                        log(
+                            "Downloaded %.0f MiB%s of %s (%.1f MiB/s)",
+                            written / 1024 ** 2,
+                            f" / {total_size / 1024 ** 2:.0f} MiB" if total_size else "",
+                            url,
+                            written / 1024 ** 2 / max(elapsed, 1e-6),
+                        )
+                        next_progress += PROGRESS_INTERVAL
+            break
+        except (ClientPayloadError, ClientConnectionError, TimeoutError) as e:
+            if resumes >= MAX_RESUMES:
+                raise
+            resumes += 1
+            log("Download of %s broke off at %d bytes (%s), retrying", url, written, e)
+            await sleep(resumes)
+
+    if total_size is not None and written != total_size:
+        raise DownloadError(f"{url}: got {written} bytes, expected {total_size}")
+    digest = checksum.hexdigest()
+    if expected_sha256 and digest != expected_sha256:
+        raise DownloadError(f"{url}: sha256 is {digest}, expected {expected_sha256}")
+    stats = DownloadStats(written, time.monotonic() - start_time, resumes, digest)
+    log(
+        "Downloaded %s: %.1f MiB in %.1fs (%.1f MiB/s, %d resumes)",
+        url,
+        stats.size / 1024 ** 2,
+        stats.seconds,
+        stats.throughput / 1024 ** 2,
+        stats.resumes,
+    )
+    return stats
@@ -0,0 +1,102 @@
+import fcntl
+import logging
+import os
+import time
+from asyncio import get_running_loop
+from contextlib import asynccontextmanager
+from tempfile import TemporaryDirectory
+from typing import AsyncContextManager, AsyncIterator, Optional
+
+from .cache import get_cache_dir
+from .common import async_exec
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+UPSTREAM_URL = "https://github.com/bioconda/bioconda-recipes"
+UPSTREAM_BRANCH = "master"
+
+
+# Bare mirror of the upstream master branch, kept in the cache directory between runs
+# Clones use it with --reference, so only the objects that aren't upstream yet are transferred.
+# Refreshing takes an exclusive lock, using it a shared one, so a fetch (or gc) never runs while
+# a clone still borrows objects from it.
+# A mirror with a depth only has the last commits of upstream. git can't use it as a --reference,
+# clones fetch upstream master from its url instead.
+class UpstreamMirror:
+    def __init__(self, path: Optional[str] = None, depth: Optional[int] = None) -> None:
+        self.path = path or str(get_cache_dir("git") / "bioconda-recipes.git")
+        self.lock_path = f"{self.path}.lock"
+        self.depth = depth
+        # file:// makes git use the same protocol as for a remote, so fetches can be shallow and filtered
+        self.url = f"file://{os.path.abspath(self.path)}"
+
+    @asynccontextmanager
+    async def lock(self, exclusive: bool) -> AsyncIterator[None]:
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # flock blocks until other runs are done => use a thread
+            await get_running_loop().run_in_executor(
+                None, fcntl.flock, fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            )
+            yield
+        finally:
+            os.close(fd)
+
+    async def git(self, *args: str) -> None:
+        await async_exec("git", "--git-dir", self.path, *args)
+
+    # Create the mirror or fetch what's new upstream
+    async def refresh(self) -> None:
+        start = time.monotonic()
+        async with self.lock(exclusive=True):
+            created = not os.path.exists(os.path.join(self.path, "HEAD"))
+            if created:
+                await async_exec("git", "init", "--bare", "--quiet", self.path)
+                await self.git("remote", "add", "origin", UPSTREAM_URL)
+                await self.git(
+                    "config",
+                    "remote.origin.fetch",
+                    f"+refs/heads/{UPSTREAM_BRANCH}:refs/heads/{UPSTREAM_BRANCH}",
+                )
+                # Objects must never be pruned, clones in progress might borrow them
+                await self.git("config", "gc.auto", "0")
+                # Let partial clones fetch from it
+                await self.git("config", "uploadpack.allowFilter", "true")
+            depth = [f"--depth={self.depth}"] if self.depth else []
+            await self.git("fetch", "--quiet", "--prune", *depth, "origin")
+        log(
+            "%s git mirror of %s in %.1fs",
+            "Created" if created else "Refreshed",
+            UPSTREAM_URL,
+            time.monotonic() - start,
+        )
+
+    # Hold this while a clone references the mirror
+    def shared(self) -> AsyncContextManager[None]:
+        return self.lock(exclusive=False)
+
+
+# The mirror holds the full upstream history, creating it costs much more than a shallow clone
+# It only pays off if BIOCONDA_BOT_CACHE_DIR is set to a directory that is kept between runs,
+# unlike the default cache directory in the bot's ephemeral GitHub Actions containers.
+def mirror_enabled() -> bool:
+    return bool(os.environ.get("BIOCONDA_BOT_CACHE_DIR"))
+
+
+# Return the upstream mirror, refreshed
+async def get_upstream_mirror() -> UpstreamMirror:
+    mirror = UpstreamMirror()
+    await mirror.refresh()
+    return mirror
+
+
+# Fetch the last depth commits of upstream into a mirror that is removed afterwards
+# This is for runs that update several branches without a persistent cache directory, upstream is
+# then fetched once per run instead of once per branch.
+@asynccontextmanager
+async def temporary_upstream_mirror(depth: int) -> AsyncIterator[UpstreamMirror]:
+    with TemporaryDirectory() as tmpdir:
+        mirror = UpstreamMirror(os.path.join(tmpdir, "bioconda-recipes.git"), depth)
+        await mirror.refresh()
+        yield mirror
@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import time
+from asyncio import Lock, get_running_loop
+from collections import OrderedDict
+from typing import Any, List, Mapping, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+from aiohttp import ClientSession
+
+from .cache import get_cache_dir
+from .scheduler import request
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+GITHUB_API = "https://api.github.com"
+RECIPES_REPO = "/repos/bioconda/bioconda-recipes"
+
+# Number of conditional request validators (and bodies) kept between runs
+MAX_ETAG_CACHE_ENTRIES = 2000
+# Total size of the response bodies kept in memory for conditional requests
+MAX_ETAG_CACHE_SIZE = 32 * 1024 ** 2
+# Larger bodies (e.g., pages of the PR list) are only cached in memory, not saved
+MAX_SAVED_BODY_SIZE = 64 * 1024
+
+CacheEntry = Tuple[Optional[str], Optional[str], str]
+
+
+class GraphQLError(Exception):
+    pass
+
+
+class GitHubResponse:
+    __slots__ = ("status", "headers", "text", "from_cache")
+
+    def __init__(self, status: int, headers: Mapping[str, str], text: str, from_cache: bool = False) -> None:
+        self.status = status
+        self.headers = headers
+        self.text = text
+        self.from_cache = from_cache
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+
+# Client for the GitHub REST API
+# It holds the shared auth headers and an ETag/Last-Modified cache, so repeated reads of
+# unchanged resources are answered with "304 Not Modified", which don't count against the
+# rate limit. Use get_github() to get the client for a session.
+class GitHubClient:
+    def __init__(self, session: ClientSession, token: Optional[str] = None) -> None:
+        self.session = session
+        self.headers = {
+            "User-Agent": "BiocondaCommentResponder",
+            "Accept": "application/vnd.github+json",
+        }
+        if token:
+            self.headers["Authorization"] = f"token {token}"
+        # "url?query accept" -> (ETag, Last-Modified, body), least recently used first
+        self.validators: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        # Total length of the cached bodies
+        self.cache_size = 0
+        # Whether there are new entries that weren't saved yet
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        self.save_lock = Lock()
+        self.not_modified = 0
+        # Login of the token's account, "" if it's unknown
+        self.login: Optional[str] = None
+        self.cache_file = get_cache_dir("github") / "validators.json"
+        self.load()
+
+    def url(self, path: str) -> str:
+        if path.startswith(("https://", "http://")):
+            return path
+        return f"{GITHUB_API}{path}"
+
+    def load(self) -> None:
+        try:
+            with open(self.cache_file) as fd:
+                entries = json.load(fd)
+        except (OSError, ValueError):
+            return
+        for url, etag, last_modified, text in entries:
+            self.store(url, (etag, last_modified, text))
+        self.dirty = False
+
+    def store(self, cache_key: str, entry: CacheEntry) -> None:
+        old_entry = self.validators.pop(cache_key, None)
+        if old_entry is not None:
+            self.cache_size -= len(old_entry[2])
+        self.validators[cache_key] = entry
+        self.cache_size += len(entry[2])
+        while self.cache_size > MAX_ETAG_CACHE_SIZE and len(self.validators) > 1:
+            _, evicted = self.validators.popitem(last=False)
+            self.cache_size -= len(evicted[2])
+        self.dirty = True
+
+    # Return the entries to save, the most recently used ones with small bodies
+    def entries_to_save(self) -> List[List[Optional[str]]]:
+        entries = [
+            [url, *entry] for url, entry in self.validators.items() if len(entry[2]) <= MAX_SAVED_BODY_SIZE
+        ]
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        return entries[-MAX_ETAG_CACHE_ENTRIES:]
+
+    def write(self, entries: List[List[Optional[str]]]) -> None:
+        tmp_file = self.cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "w") as fd:
+            json.dump(entries, fd)
+        os.replace(tmp_file, self.cache_file)
+
+    def save(self) -> None:
+        if self.dirty:
+            self.write(self.entries_to_save())
+        log("GitHub API: %d requests answered with 304 Not Modified", self.not_modified)
+
+    # Save without blocking the event loop, skip it if the last save was less than min_interval ago
+    async def save_async(self, min_interval: float = 0.0) -> None:
+        if not self.dirty or time.monotonic() - self.saved_at < min_interval:
+            return
+        async with self.save_lock:
+            # The entries are collected here, the loop may change the cache while the file is written
+            entries = self.entries_to_save()
+            await get_running_loop().run_in_executor(None, self.write, entries)
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        params: Optional[Mapping[str, Any]] = None,
+        json: Any = None,
+        headers: Optional[Mapping[str, str]] = None,
+        raise_for_status: bool = True,
+    ) -> GitHubResponse:
+        url = self.url(path)
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+        cache_key = None
+        # Concurrent requests may evict the entry before the response arrives => keep it
+        cached: Optional[CacheEntry] = None
+        if method == "GET":
+            query = "&".join(f"{k}={v}" for k, v in sorted((params or {}).items()))
+            cache_key = f"{url}?{query} {request_headers['Accept']}"
+            cached = self.validators.get(cache_key)
+            if cached is not None:
+                etag, last_modified, _ = cached
+                if etag:
+                    request_headers["If-None-Match"] = etag
+                if last_modified:
+                    request_headers["If-Modified-Since"] = last_modified
+        async with request(
+            self.session, method, url, params=params, json=json, headers=request_headers
+        ) as response:
+            if response.status == 304 and cache_key and cached is not None:
+                self.not_modified += 1
+                if cache_key in self.validators:
+                    self.validators.move_to_end(cache_key)
+                else:
+                    self.store(cache_key, cached)
+                return GitHubResponse(200, response.headers, cached[2], True)
+            if raise_for_status:
+                response.raise_for_status()
+            text = await response.text()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if cache_key and response.status == 200 and (etag or last_modified):
+                self.store(cache_key, (etag, last_modified, text))
+            return GitHubResponse(response.status, response.headers, text)
+
+    async def get(self, path: str, **kwargs: Any) -> GitHubResponse:
+        return await self.request("GET", path, **kwargs)
+
+    async def get_json(self, path: str, **kwargs: Any) -> Any:
+        response = await self.request("GET", path, **kwargs)
+        return response.json()
+
+    # Return the login of the account the token belongs to, None if it can't be determined
+    # Set BIOCONDA_BOT_LOGIN for tokens that can't read /user (e.g., GitHub App tokens).
+    async def get_login(self) -> Optional[str]:
+        if self.login is None:
+            login = os.environ.get("BIOCONDA_BOT_LOGIN", "")
+            if not login:
+                response = await self.get("/user", raise_for_status=False)
+                if response.status == 200:
+                    login = response.json()["login"]
+                else:
+                    log("Can't determine the bot's login (status %d)", response.status)
+            self.login = login
+        return self.login or None
+
+    # Run a GraphQL query and return its data, raise GraphQLError if it reported errors
+    async def graphql(self, query: str, variables: Mapping[str, Any]) -> Any:
+        response = await self.request("POST", "/graphql", json={"query": query, "variables": variables})
+        result = response.json()
+        if result.get("errors"):
+            raise GraphQLError("; ".join(error.get("message", str(error)) for error in result["errors"]))
+        return result["data"]
+
+
+_clients: "WeakKeyDictionary[ClientSession, GitHubClient]" = WeakKeyDictionary()
+
+
+# Return the GitHub client bound to a session
+def get_github(session: ClientSession) -> GitHubClient:
+    client = _clients.get(session)
+    if client is None:
+        client = _clients[session] = GitHubClient(session, os.environ.get("BOT_TOKEN"))
+    return client
+
+
+# Store the conditional request cache of the session's GitHub client, if it was used
+def save_github(session: ClientSession) -> None:
+    client = _clients.get(session)
+    if client is not None:
+        client.save()
+
+
+# Like save_github, but write in a thread and at most every min_interval seconds
+async def save_github_async(session: ClientSession, min_interval: float = 0.0) -> None:
+    client = _clients.get(session)
+    if client is not None:
+        await client.save_async(min_interval)
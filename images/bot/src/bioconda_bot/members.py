@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import re
+import time
+from asyncio import Lock, gather
+from typing import Dict, List, Optional, Set
+from weakref import WeakKeyDictionary
+
+from aiohttp import ClientSession
+
+from .cache import get_cache_dir
+from .github import GitHubClient
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+ORG = "bioconda"
+# Refetch the full member list when it's older than this
+MEMBER_ROSTER_TTL = 6 * 60 * 60
+# Users that weren't members are looked up again after this many seconds
+NON_MEMBER_TTL = 10 * 60
+MEMBERS_PER_PAGE = 100
+
+
+# Return the page number of rel="last" in a Link header
+def get_last_page(link: Optional[str]) -> Optional[int]:
+    match = re.search(r'<[^>]*[?&]page=(\d+)[^>]*>;\s*rel="last"', link or "")
+    return int(match.group(1)) if match else None
+
+
+# Logins of the bioconda org members, persisted between runs
+# The full list is fetched (all pages at once) when it's older than MEMBER_ROSTER_TTL. Users that
+# aren't on the list are checked individually, since they might have joined since then.
+class MemberRoster:
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or str(get_cache_dir("github") / "members.json")
+        # Lower case logins
+        self.members: Set[str] = set()
+        # Epoch seconds of the last full fetch
+        self.fetched_at = 0.0
+        # Lower case login -> epoch seconds when it was found not to be a member
+        self.non_members: Dict[str, float] = {}
+        self.lock = Lock()
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            return
+        self.members = set(data["members"])
+        self.fetched_at = data["fetched_at"]
+
+    def save(self) -> None:
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump({"members": sorted(self.members), "fetched_at": self.fetched_at}, fd)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def is_stale(self) -> bool:
+        return time.time() - self.fetched_at > MEMBER_ROSTER_TTL
+
+    async def refresh(self, github: GitHubClient) -> None:
+        path = f"/orgs/{ORG}/members"
+
+        async def get_page(page: int) -> List[str]:
+            members = await github.get_json(path, params={"per_page": MEMBERS_PER_PAGE, "page": page})
+            return [member["login"].lower() for member in members]
+
+        response = await github.get(path, params={"per_page": MEMBERS_PER_PAGE, "page": 1})
+        members = [member["login"].lower() for member in response.json()]
+        last_page = get_last_page(response.headers.get("Link"))
+        if last_page is not None:
+            for page_members in await gather(*map(get_page, range(2, last_page + 1))):
+                members.extend(page_members)
+        elif len(members) == MEMBERS_PER_PAGE:
+            # No Link header, walk the pages one by one
+            page = 1
+            while True:
+                page += 1
+                page_members = await get_page(page)
+                members.extend(page_members)
+                if len(page_members) < MEMBERS_PER_PAGE:
+                    break
+        self.members = set(members)
+        self.fetched_at = time.time()
+        self.non_members.clear()
+        log("Fetched %d members of %s", len(self.members), ORG)
+        self.save()
+
+    # Check a single user, e.g., one that joined since the last full fetch
+    async def lookup(self, github: GitHubClient, user: str) -> bool:
+        # 404 just means "not a member", so don't raise on errors
+        response = await github.get(f"/orgs/{ORG}/members/{user}", raise_for_status=False)
+        return response.status == 204
+
+    async def is_member(self, github: GitHubClient, user: str) -> bool:
+        login = user.lower()
+        async with self.lock:
+            if self.is_stale:
+                try:
+                    await self.refresh(github)
+                except Exception as error:
+                    log("Fetching the members of %s failed (%s), checking users one by one", ORG, error)
+            if login in self.members:
+                return True
+            if time.time() - self.non_members.get(login, 0.0) < NON_MEMBER_TTL:
+                return False
+        if await self.lookup(github, user):
+            self.members.add(login)
+            self.save()
+            return True
+        self.non_members[login] = time.time()
+        return False
+
+
+_rosters: "WeakKeyDictionary[ClientSession, MemberRoster]" = WeakKeyDictionary()
+
+
+# Return the member roster bound to a session
+def get_member_roster(session: ClientSession) -> MemberRoster:
+    roster = _rosters.get(session)
+    if roster is None:
+        roster = _rosters[session] = MemberRoster()
+    return roster
@@ -2,19 +2,21 @@ import logging
 import os
 import re
 import sys
-from asyncio import gather, sleep
+import time
+from asyncio import Semaphore, gather, get_running_loop, sleep
 from asyncio.subprocess import create_subprocess_exec
 from enum import Enum, auto
 from pathlib import Path
 from shutil import which
-from typing import Any, Dict, List, Optional, Set, Tuple
+from tempfile import TemporaryDirectory
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
 from zipfile import ZipFile, ZipInfo
 
 from aiohttp import ClientSession
-from yaml import safe_load
 
 from .common import (
     async_exec,
+    create_session,
     fetch_pr_sha_artifacts,
     get_job_context,
     get_pr_comment,
@@ -22,11 +24,39 @@ from .common import (
     is_bioconda_member,
     send_comment,
 )
+from .channel import get_channel_index, read_package_info
+from .github import RECIPES_REPO, get_github
+from .models import Commit, JobContext, PullRequest, Review
+from .pr_snapshot import PRSnapshot, get_pr_snapshot
+from .registry import push_docker_archive
+from .scheduler import request
+from .tracing import span, traced
+from .zipstream import exec_with_member_fifo, extract_member
 
 logger = logging.getLogger(__name__)
 log = logger.info
 
 
+# Number of concurrent uploads to anaconda.org and quay.io
+MAX_PACKAGE_UPLOADS = 4
+MAX_IMAGE_UPLOADS = 2
+
+# Polling of the mergeable state: first interval, growth factor, longest interval, give up after
+MERGEABLE_POLL_INITIAL = 0.5
+MERGEABLE_POLL_BACKOFF = 2.0
+MERGEABLE_POLL_MAX_INTERVAL = 8.0
+MERGEABLE_POLL_DEADLINE = 60.0
+
+# GitHub lists at most this many commits of a PR
+MAX_PR_COMMITS = 250
+COMMITS_PER_PAGE = 100
+# Limit for the list of commit messages in the squash commit
+MAX_COMMIT_MESSAGE_SIZE = 32 * 1024
+
+MERGE_INIT_MESSAGE = "I will attempt to upload artifacts and merge this PR. This may take some time, please have patience."
+MERGE_ERROR_MESSAGE = "I received an error uploading the build artifacts or merging the PR!"
+
+
 class MergeState(Enum):
     UNKNOWN = auto()
     MERGEABLE = auto()
@@ -36,68 +66,85 @@ class MergeState(Enum):
 
 
 # Ensure there's at least one approval by a member
-async def approval_review(session: ClientSession, issue_number: int) -> bool:
-    token = os.environ["BOT_TOKEN"]
-    url = f"https://api.github.com/repos/bioconda/bioconda-recipes/pulls/{issue_number}/reviews"
-    headers = {
-        "Authorization": f"token {token}",
-        "User-Agent": "BiocondaCommentResponder",
-    }
-    async with session.get(url, headers=headers) as response:
-        response.raise_for_status()
-        res = await response.text()
-    reviews = safe_load(res)
-
-    approved_reviews = [review for review in reviews if review["state"] == "APPROVED"]
+# A snapshot already tells the author association, only other authors need a membership check.
+async def approval_review(
+    session: ClientSession, issue_number: int, snapshot: Optional[PRSnapshot] = None
+) -> bool:
+    if snapshot is not None:
+        if snapshot.approved_by_member():
+            return True
+        approved_reviews = snapshot.reviews_to_check()
+    else:
+        reviews = Review.from_json_list(
+            await get_github(session).get_json(f"{RECIPES_REPO}/pulls/{issue_number}/reviews")
+        )
+        approved_reviews = [review for review in reviews if review.state == "APPROVED"]
     if not approved_reviews:
         return False
 
     # Ensure the review author is a member
     return any(
-        gather(
+        await gather(
             *(
-                is_bioconda_member(session, review["user"]["login"])
+                is_bioconda_member(session, review.user)
                 for review in approved_reviews
+                if review.user
             )
         )
     )
 
 
 # Check the mergeable state of a PR
+# GitHub computes mergeable in the background after the PR info was requested, it's null until
+# then. Poll it with growing intervals until it's known or the deadline passed.
+@traced
 async def check_is_mergeable(
-    session: ClientSession, issue_number: int, second_try: bool = False
+    session: ClientSession,
+    issue_number: int,
+    deadline: float = MERGEABLE_POLL_DEADLINE,
+    snapshot: Optional[PRSnapshot] = None,
 ) -> MergeState:
-    token = os.environ["BOT_TOKEN"]
-    # Sleep a couple of seconds to allow the background process to finish
-    if second_try:
-        await sleep(3)
-
-    # PR info
-    url = f"https://api.github.com/repos/bioconda/bioconda-recipes/pulls/{issue_number}"
-    headers = {
-        "Authorization": f"token {token}",
-        "User-Agent": "BiocondaCommentResponder",
-    }
-    async with session.get(url, headers=headers) as response:
-        response.raise_for_status()
-        res = await response.text()
-    pr_info = safe_load(res)
+    start = time.monotonic()
+    pr_info: Union[PullRequest, PRSnapshot]
+    if snapshot is not None:
+        pr_info = snapshot
+        approved = await approval_review(session, issue_number, snapshot)
+    else:
+        # The reviews don't depend on the mergeable state, fetch them in the meantime
+        pr_info, approved = await gather(
+            get_pr_info(session, issue_number), approval_review(session, issue_number)
+        )
+    delay = MERGEABLE_POLL_INITIAL
+    polls = 1
+    while pr_info.mergeable is None and not pr_info.merged:
+        if time.monotonic() - start + delay > deadline:
+            log("GitHub did not compute the mergeable state of PR %d within %.0fs", issue_number, deadline)
+            break
+        with span("wait", "mergeable", pr=issue_number):
+            await sleep(delay)
+        delay = min(delay * MERGEABLE_POLL_BACKOFF, MERGEABLE_POLL_MAX_INTERVAL)
+        pr_info = await get_pr_info(session, issue_number)
+        polls += 1
+    else:
+        log(
+            "Mergeable state of PR %d known after %.1fs (%d polls)",
+            issue_number,
+            time.monotonic() - start,
+            polls,
+        )
 
-    if pr_info.get("merged"):
+    if pr_info.merged:
         return MergeState.MERGED
 
     # We need mergeable == true and mergeable_state == clean, an approval by a member and
-    if pr_info.get("mergeable") is None and not second_try:
-        return await check_is_mergeable(session, issue_number, True)
-
-    # Check approved reviews beforehand because we (somehow?) get NOT_MERGEABLE otherwise.
-    if not await approval_review(session, issue_number):
+    # check approved reviews beforehand because we (somehow?) get NOT_MERGEABLE otherwise.
+    if not approved:
         return MergeState.NEEDS_REVIEW
 
     if (
-        pr_info.get("mergeable") is None
-        or not pr_info["mergeable"]
-        or pr_info["mergeable_state"] != "clean"
+        pr_info.mergeable is None
+        or not pr_info.mergeable
+        or pr_info.mergeable_state != "clean"
     ):
         return MergeState.NOT_MERGEABLE
 
@@ -106,6 +153,7 @@ async def check_is_mergeable(
 
 # Ensure uploaded containers are in repos that have public visibility
 # TODO: This should ping @bioconda/core if it fails
+@traced
 async def toggle_visibility(session: ClientSession, container_repo: str) -> None:
     url = f"https://quay.io/api/v1/repository/biocontainers/{container_repo}/changevisibility"
     QUAY_OAUTH_TOKEN = os.environ["QUAY_OAUTH_TOKEN"]
@@ -116,7 +164,7 @@ async def toggle_visibility(session: ClientSession, container_repo: str) -> None
     body = {"visibility": "public"}
     rc = 0
     try:
-        async with session.post(url, headers=headers, json=body) as response:
+        async with request(session, "POST", url, headers=headers, json=body) as response:
             rc = response.status
     except:
         # Do nothing
@@ -189,33 +237,37 @@ async def toggle_visibility(session: ClientSession, container_repo: str) -> None
 #    os.remove(file_name)
 
 
-async def upload_package(session: ClientSession, zf: ZipFile, e: ZipInfo):
-    log(f"extracting {e.filename}")
-    fName = zf.extract(e)
-
-    log(f"uploading {fName}")
-    ANACONDA_TOKEN = os.environ["ANACONDA_TOKEN"]
-    await async_exec("anaconda", "-t", ANACONDA_TOKEN, "upload", fName, "--force")
-
-    log("cleaning up")
-    os.remove(fName)
+# anaconda-client needs a seekable file, so the package is written to a private temporary directory
+# Packages already on the channel with the same sha256 (e.g., from an earlier, failed merge) are
+# skipped. Returns whether the package was uploaded.
+async def upload_package(session: ClientSession, zf: ZipFile, e: ZipInfo) -> bool:
+    try:
+        package = await get_running_loop().run_in_executor(None, read_package_info, zf, e)
+    except Exception as error:
+        log(f"can't read the package info of {e.filename} ({error}), uploading it")
+        package = None
+    if package and await get_channel_index(session).contains(package):
+        log(f"skipping {package}, it is on the channel already (sha256 {package.sha256})")
+        return False
 
+    with TemporaryDirectory() as tmpdir:
+        log(f"extracting {e.filename}")
+        fName = await extract_member(zf, e, os.path.join(tmpdir, e.filename.split("/").pop()))
 
-async def upload_image(session: ClientSession, zf: ZipFile, e: ZipInfo):
-    basename = e.filename.split("/").pop()
-    image_name = basename.replace("\n", "").replace(".tar.gz", "")
+        log(f"uploading {fName}")
+        ANACONDA_TOKEN = os.environ["ANACONDA_TOKEN"]
+        await async_exec("anaconda", "-t", ANACONDA_TOKEN, "upload", fName, "--force")
+    return True
 
-    log(f"extracting {e.filename}")
-    fName = zf.extract(e)
-    # Skopeo can't handle a : in the file name, so we need to remove it
-    newFName = fName.replace(":", "")
-    os.rename(fName, newFName)
 
-    log(f"uploading with skopeo: {newFName} {image_name}")
+# The image is streamed from the zip file to skopeo through a FIFO instead of being extracted
+# first. skopeo can't seek in a compressed docker-archive, so it still copies it to a temporary
+# file of its own. Push with skopeo, which sends the whole image every time
+async def upload_image_skopeo(zf: ZipFile, e: ZipInfo, image_name: str) -> None:
+    log(f"uploading with skopeo: {e.filename} {image_name}")
     # This can fail, retry with 5 second delays
     count = 0
     maxTries = 5
-    success = False
     QUAY_LOGIN = os.environ["QUAY_LOGIN"]
     env = os.environ.copy()
     # TODO: Fix skopeo package to find certificates on its own.
@@ -223,91 +275,259 @@ async def upload_image(session: ClientSession, zf: ZipFile, e: ZipInfo):
     if not skopeo_path:
         raise RuntimeError("skopeo not found")
     env["SSL_CERT_DIR"] = str(Path(skopeo_path).parents[1].joinpath("ssl"))
-    while count < maxTries:
+    with TemporaryDirectory() as tmpdir:
+        # Skopeo can't handle a : in the file name, so use a fixed name
+        fifo = os.path.join(tmpdir, "image.tar.gz")
+        while count < maxTries:
+            try:
+                await exec_with_member_fifo(
+                    zf,
+                    e,
+                    fifo,
+                    "skopeo",
+                    "--command-timeout",
+                    "600s",
+                    "copy",
+                    f"docker-archive:{fifo}",
+                    f"docker://quay.io/biocontainers/{image_name}",
+                    "--dest-creds",
+                    QUAY_LOGIN,
+                    env=env,
+                )
+                break
+            except:
+                count += 1
+                if count == maxTries:
+                    raise
+            await sleep(5)
+
+
+async def upload_image(session: ClientSession, zf: ZipFile, e: ZipInfo) -> bool:
+    basename = e.filename.split("/").pop()
+    image_name = basename.replace("\n", "").replace(".tar.gz", "").replace("%3A", ":")
+    repository, _, tag = image_name.partition(":")
+
+    # Push with skopeo unless BIOCONDA_BOT_IMAGE_PUSH=registry, which pushes layer by layer
+    # (spooling the layers to disk) and falls back to skopeo on errors
+    if os.environ.get("BIOCONDA_BOT_IMAGE_PUSH", "skopeo") == "registry":
+        log(f"uploading to the registry: {e.filename} {image_name}")
         try:
-            await async_exec(
-                "skopeo",
-                "--command-timeout",
-                "600s",
-                "copy",
-                f"docker-archive:{newFName}",
-                f"docker://quay.io/biocontainers/{image_name}",
-                "--dest-creds",
-                QUAY_LOGIN,
-                env=env,
-            )
-            success = True
-            break
-        except:
-            count += 1
-            if count == maxTries:
-                raise
-        await sleep(5)
-    if success:
-        await toggle_visibility(session, basename.split(":")[0] if ":" in basename else basename.split("%3A")[0])
-
-    log("cleaning up")
-    os.remove(newFName)
-
-
-# Given an already downloaded zip file name in the current working directory, upload the contents
-async def extract_and_upload(session: ClientSession, fName: str) -> int:
-    if os.path.exists(fName):
-        zf = ZipFile(fName)
+            with TemporaryDirectory() as spool_dir:
+                await push_docker_archive(
+                    session,
+                    zf,
+                    e,
+                    f"biocontainers/{repository}",
+                    tag or "latest",
+                    spool_dir,
+                    os.environ["QUAY_LOGIN"],
+                )
+        except Exception as error:
+            log(f"Layer-wise push of {image_name} failed ({error}), falling back to skopeo")
+            await upload_image_skopeo(zf, e, image_name)
+    else:
+        await upload_image_skopeo(zf, e, image_name)
+    await toggle_visibility(session, repository)
+    return True
+
+
+# Outcome of uploading one artifact
+class UploadResult:
+    __slots__ = ("artifact", "destination", "seconds", "error", "skipped")
+
+    def __init__(
+        self,
+        artifact: str,
+        destination: str,
+        seconds: float,
+        error: Optional[BaseException] = None,
+        skipped: bool = False,
+    ) -> None:
+        self.artifact = artifact
+        self.destination = destination
+        self.seconds = seconds
+        self.error = error
+        # The destination had the artifact already
+        self.skipped = skipped
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __str__(self) -> str:
+        if not self.ok:
+            status = f"failed ({self.error})"
+        else:
+            status = "skipped, already uploaded" if self.skipped else "ok"
+        return f"{self.artifact} -> {self.destination}: {status} after {self.seconds:.1f}s"
+
+
+# Run one upload in a slot of its destination's pool, failures are captured in the result
+async def upload_member(
+    session: ClientSession,
+    zf: ZipFile,
+    e: ZipInfo,
+    uploader: Callable[[ClientSession, ZipFile, ZipInfo], Awaitable[bool]],
+    destination: str,
+    slots: Semaphore,
+) -> UploadResult:
+    async with slots:
+        start = time.monotonic()
+        try:
+            uploaded = await uploader(session, zf, e)
+        except Exception as error:
+            logger.exception("Uploading %s to %s failed", e.filename, destination)
+            return UploadResult(e.filename, destination, time.monotonic() - start, error)
+    return UploadResult(e.filename, destination, time.monotonic() - start, skipped=not uploaded)
+
+
+# Given the path of an already downloaded zip file, upload the contents without extracting it
+# Packages and images are uploaded concurrently, limited by the slots of each destination.
+async def extract_and_upload(
+    session: ClientSession,
+    fName: str,
+    package_slots: Optional[Semaphore] = None,
+    image_slots: Optional[Semaphore] = None,
+) -> List[UploadResult]:
+    if not os.path.exists(fName):
+        return []
+    package_slots = package_slots or Semaphore(MAX_PACKAGE_UPLOADS)
+    image_slots = image_slots or Semaphore(MAX_IMAGE_UPLOADS)
+    with ZipFile(fName) as zf:
+        uploads = []
         for e in zf.infolist():
             if e.filename.endswith((".conda", ".tar.bz2")):
-                await upload_package(session, zf, e)
+                uploads.append(
+                    upload_member(session, zf, e, upload_package, "anaconda.org", package_slots)
+                )
             elif e.filename.endswith('.tar.gz'):
-                await upload_image(session, zf, e)
-        return 0
-    return 1
+                uploads.append(upload_member(session, zf, e, upload_image, "quay.io", image_slots))
+        return list(await gather(*uploads))
 
 
 # Upload artifacts to quay.io and anaconda, return the commit sha
 # Only call this for mergeable PRs!
-async def upload_artifacts(session: ClientSession, pr: int) -> str:
+@traced
+async def upload_artifacts(session: ClientSession, pr: int, sha: Optional[str] = None) -> str:
     # Get last sha
-    pr_info = await get_pr_info(session, pr)
-    sha: str = pr_info["head"]["sha"]
-
-    # Fetch the artifacts (a list of (URL, artifact) tuples actually)
-    artifactDict = await fetch_pr_sha_artifacts(session, pr, sha)
-    # Merge is deprecated, so leaving as Azure only
-    artifacts = artifactDict["azure"]
-    artifacts = [
-        artifact
-        for (URL, artifact) in artifacts
-        if artifact.endswith((".gz", ".conda", ".tar.bz2"))
-    ]
-    assert artifacts
-
-    # Download/upload Artifacts
-    for zipFileName in ["LinuxArtifacts.zip", "OSXArtifacts.zip"]:
-        await extract_and_upload(session, zipFileName)
-
+    if sha is None:
+        sha = (await get_pr_info(session, pr)).head_sha
+
+    with TemporaryDirectory() as workdir:
+        # Fetch the artifacts (a list of (URL, artifact) tuples actually)
+        artifactDict = await fetch_pr_sha_artifacts(session, pr, sha, workdir=workdir)
+        # Merge is deprecated, so leaving as Azure only
+        artifacts = artifactDict["azure"]
+        artifacts = [
+            artifact
+            for (URL, artifact) in artifacts
+            if artifact.endswith((".gz", ".conda", ".tar.bz2"))
+        ]
+        assert artifacts
+
+        # Download/upload Artifacts, all zip files share the upload slots
+        package_slots = Semaphore(MAX_PACKAGE_UPLOADS)
+        image_slots = Semaphore(MAX_IMAGE_UPLOADS)
+        results = [
+            result
+            for zip_results in await gather(
+                *(
+                    extract_and_upload(
+                        session, os.path.join(workdir, "azure", zipFileName), package_slots, image_slots
+                    )
+                    for zipFileName in ["LinuxArtifacts.zip", "OSXArtifacts.zip"]
+                )
+            )
+            for result in zip_results
+        ]
+
+    for result in results:
+        log("upload %s", result)
+    skipped = [result.artifact for result in results if result.skipped]
+    if skipped:
+        log("Skipped %d of %d uploads that were already done: %s", len(skipped), len(results), ", ".join(skipped))
+    failed = [result for result in results if not result.ok]
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} of {len(results)} uploads failed: "
+            + ", ".join(result.artifact for result in failed)
+        )
     return sha
 
 
-# Assume we have no more than 250 commits in a PR, which is probably reasonable in most cases
-async def get_pr_commit_message(session: ClientSession, issue_number: int) -> str:
-    token = os.environ["BOT_TOKEN"]
-    url = f"https://api.github.com/repos/bioconda/bioconda-recipes/pulls/{issue_number}/commits"
-    headers = {
-        "Authorization": f"token {token}",
-        "User-Agent": "BiocondaCommentResponder",
+# List the commit messages of a PR, newest first
+# The number of commits from the PR info gives the number of pages, which are fetched
+# concurrently. GitHub lists at most 250 commits, the message notes any that are left out,
+# as well as those that didn't fit into MAX_COMMIT_MESSAGE_SIZE.
+async def get_pr_commit_message(
+    session: ClientSession, issue_number: int, commit_count: Optional[int] = None
+) -> str:
+    if commit_count is None:
+        commit_count = (await get_pr_info(session, issue_number)).commits or 0
+    github = get_github(session)
+    pages = max(1, -(-min(commit_count, MAX_PR_COMMITS) // COMMITS_PER_PAGE))
+    commit_pages = await gather(
+        *(
+            github.get_json(
+                f"{RECIPES_REPO}/pulls/{issue_number}/commits",
+                params={"per_page": COMMITS_PER_PAGE, "page": page},
+            )
+            for page in range(1, pages + 1)
+        )
+    )
+    commits = [commit for page in commit_pages for commit in Commit.from_json_list(page)]
+    return format_commit_messages([commit.message for commit in commits], commit_count)
+
+
+# Join commit messages (oldest first) into the list for the squash commit
+def format_commit_messages(messages: List[str], commit_count: int) -> str:
+    lines: List[str] = []
+    size = 0
+    for message in reversed(messages):
+        line = f" * {message}\n"
+        if size + len(line) > MAX_COMMIT_MESSAGE_SIZE:
+            break
+        lines.append(line)
+        size += len(line)
+    omitted = max(commit_count, len(messages)) - len(lines)
+    if omitted:
+        lines.append(f" * ... and {omitted} more commit{'s' if omitted > 1 else ''}\n")
+    return "".join(lines)
+
+
+# Squash merge the uploaded head sha of a PR, return the response code
+async def put_merge(session: ClientSession, pr: int, sha: str, msg: Optional[str] = None) -> int:
+    # Carry over the commit messages
+    if msg is None:
+        msg = await get_pr_commit_message(session, pr)
+
+    # Hit merge
+    path = f"{RECIPES_REPO}/pulls/{pr}/merge"
+    payload = {
+        "sha": sha,
+        "commit_title": f"[ci skip] Merge PR {pr}",
+        "commit_message": f"Merge PR #{pr}, commits were: \n{msg}",
+        "merge_method": "squash",
     }
-    async with session.get(url, headers=headers) as response:
-        response.raise_for_status()
-        res = await response.text()
-    commits = safe_load(res)
-    message = "".join(f" * {commit['commit']['message']}\n" for commit in reversed(commits))
-    return message
+    log("Putting merge commit")
+    response = await get_github(session).request(
+        "PUT", path, json=payload, raise_for_status=False
+    )
+    rc = response.status
+    log("body %s", payload)
+    log("merge_pr the response code was %s", rc)
+    return rc
 
 
 # Merge a PR
-async def merge_pr(session: ClientSession, pr: int, init_message: str) -> MergeState:
-    token = os.environ["BOT_TOKEN"]
-    mergeable = await check_is_mergeable(session, pr)
+# Everything about the PR is read from one GraphQL snapshot if possible, REST otherwise
+@traced
+async def merge_pr(
+    session: ClientSession, pr: int, init_message: str, snapshot: Optional[PRSnapshot] = None
+) -> MergeState:
+    if snapshot is None:
+        snapshot = await get_pr_snapshot(session, pr)
+    mergeable = await check_is_mergeable(session, pr, snapshot=snapshot)
     log("mergeable state of %s is %s", pr, mergeable)
     if mergeable is not MergeState.MERGEABLE:
         return mergeable
@@ -316,42 +536,22 @@ async def merge_pr(session: ClientSession, pr: int, init_message: str) -> MergeS
         await send_comment(session, pr, init_message)
     try:
         log("uploading artifacts")
-        sha = await upload_artifacts(session, pr)
+        sha = await upload_artifacts(session, pr, snapshot.head_sha if snapshot else None)
         log("artifacts uploaded")
 
-        # Carry over last 250 commit messages
-        msg = await get_pr_commit_message(session, pr)
-
-        # Hit merge
-        url = f"https://api.github.com/repos/bioconda/bioconda-recipes/pulls/{pr}/merge"
-        headers = {
-            "Authorization": f"token {token}",
-            "User-Agent": "BiocondaCommentResponder",
-        }
-        payload = {
-            "sha": sha,
-            "commit_title": f"[ci skip] Merge PR {pr}",
-            "commit_message": f"Merge PR #{pr}, commits were: \n{msg}",
-            "merge_method": "squash",
-        }
-        log("Putting merge commit")
-        async with session.put(url, headers=headers, json=payload) as response:
-            rc = response.status
-        log("body %s", payload)
-        log("merge_pr the response code was %s", rc)
+        msg = format_commit_messages(snapshot.commit_messages, snapshot.commits) if snapshot else None
+        await put_merge(session, pr, sha, msg)
     except:
-        await send_comment(
-            session,
-            pr,
-            "I received an error uploading the build artifacts or merging the PR!",
-        )
+        await send_comment(session, pr, MERGE_ERROR_MESSAGE)
         logger.exception("Upload failed", exc_info=True)
     return MergeState.MERGED
 
 
-async def request_merge(session: ClientSession, pr: int) -> MergeState:
-    init_message = "I will attempt to upload artifacts and merge this PR. This may take some time, please have patience."
-    merged = await merge_pr(session, pr, init_message)
+@traced
+async def request_merge(
+    session: ClientSession, pr: int, snapshot: Optional[PRSnapshot] = None
+) -> MergeState:
+    merged = await merge_pr(session, pr, MERGE_INIT_MESSAGE, snapshot)
     if merged is MergeState.NEEDS_REVIEW:
         await send_comment(
             session,
@@ -366,6 +566,12 @@ async def request_merge(session: ClientSession, pr: int) -> MergeState:
 # This requires that a JOB_CONTEXT environment variable, which is made with `toJson(github)`
 async def main() -> None:
     job_context = await get_job_context()
+    async with create_session() as session:
+        await handle(session, job_context)
+
+
+# Respond to one event, this is shared by main and the webhook server
+async def handle(session: ClientSession, job_context: JobContext) -> None:
     issue_number, original_comment = await get_pr_comment(job_context)
     if issue_number is None or original_comment is None:
         return
@@ -373,5 +579,4 @@ async def main() -> None:
     comment = original_comment.lower()
     if comment.startswith(("@bioconda-bot", "@biocondabot")):
         if " please merge" in comment:
-            async with ClientSession() as session:
-                await request_merge(session, issue_number)
+            await request_merge(session, issue_number)
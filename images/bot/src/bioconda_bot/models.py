@@ -0,0 +1,207 @@
+from json import loads
+from typing import Any, Dict, List, Optional, Type, TypeVar
+
+M = TypeVar("M", bound="Model")
+
+
+# Base class of the response models
+# Models only keep the fields the bot uses, in slots, instead of the full decoded JSON.
+class Model:
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls: Type[M], data: Dict[str, Any]) -> M:
+        raise NotImplementedError
+
+    @classmethod
+    def from_json_list(cls: Type[M], data: List[Dict[str, Any]]) -> List[M]:
+        return [cls.from_json(item) for item in data]
+
+    @classmethod
+    def parse(cls: Type[M], text: str) -> M:
+        return cls.from_json(loads(text))
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class PullRequest(Model):
+    __slots__ = (
+        "number",
+        "state",
+        "head_sha",
+        "head_ref",
+        "head_repo",
+        "merged",
+        "mergeable",
+        "mergeable_state",
+        "commits",
+        "updated_at",
+    )
+
+    def __init__(
+        self,
+        number: int,
+        state: str,
+        head_sha: str,
+        head_ref: str,
+        head_repo: Optional[str],
+        merged: bool,
+        mergeable: Optional[bool],
+        mergeable_state: Optional[str],
+        commits: Optional[int],
+        updated_at: str,
+    ) -> None:
+        self.number = number
+        self.state = state
+        self.head_sha = head_sha
+        self.head_ref = head_ref
+        self.head_repo = head_repo
+        self.merged = merged
+        self.mergeable = mergeable
+        self.mergeable_state = mergeable_state
+        # Only part of the full PR info, not of PR listings
+        self.commits = commits
+        self.updated_at = updated_at
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "PullRequest":
+        head = data["head"]
+        return cls(
+            data["number"],
+            data["state"],
+            head["sha"],
+            head["ref"],
+            # The repository is gone if the fork was deleted
+            (head.get("repo") or {}).get("full_name"),
+            bool(data.get("merged")),
+            data.get("mergeable"),
+            data.get("mergeable_state"),
+            data.get("commits"),
+            data["updated_at"],
+        )
+
+
+class Review(Model):
+    __slots__ = ("state", "user", "author_association")
+
+    def __init__(self, state: str, user: Optional[str], author_association: Optional[str]) -> None:
+        self.state = state
+        self.user = user
+        self.author_association = author_association
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Review":
+        return cls(
+            data["state"],
+            (data.get("user") or {}).get("login"),
+            data.get("author_association"),
+        )
+
+
+class Label(Model):
+    __slots__ = ("name",)
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Label":
+        return cls(data["name"])
+
+
+class Commit(Model):
+    __slots__ = ("sha", "message")
+
+    def __init__(self, sha: str, message: str) -> None:
+        self.sha = sha
+        self.message = message
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Commit":
+        return cls(data["sha"], data["commit"]["message"])
+
+
+class CheckRun(Model):
+    __slots__ = ("name", "app", "status", "conclusion", "details_url", "external_id")
+
+    def __init__(
+        self,
+        name: str,
+        app: Optional[str],
+        status: str,
+        conclusion: Optional[str],
+        details_url: Optional[str],
+        external_id: Optional[str],
+    ) -> None:
+        self.name = name
+        # Slug of the GitHub App that created the check run
+        self.app = app
+        self.status = status
+        self.conclusion = conclusion
+        self.details_url = details_url
+        self.external_id = external_id
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "CheckRun":
+        return cls(
+            data["name"],
+            (data.get("app") or {}).get("slug"),
+            data["status"],
+            data.get("conclusion"),
+            data.get("details_url"),
+            data.get("external_id"),
+        )
+
+
+# A downloadable CI artifact (zip file)
+class Artifact(Model):
+    __slots__ = ("id", "name", "url", "digest", "size")
+
+    def __init__(
+        self, id: str, name: str, url: str, digest: Optional[str] = None, size: Optional[int] = None
+    ) -> None:
+        self.id = id
+        self.name = name
+        self.url = url
+        self.digest = digest
+        self.size = size
+
+    # Hex digest of a "sha256:..." digest
+    @property
+    def sha256(self) -> Optional[str]:
+        if self.digest and self.digest.startswith("sha256:"):
+            return self.digest[len("sha256:"):]
+        return None
+
+    # Entry of the GitHub Actions artifacts API
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Artifact":
+        return cls(
+            str(data["id"]),
+            data["name"],
+            data["archive_download_url"],
+            data.get("digest"),
+            data.get("size_in_bytes"),
+        )
+
+    # Entry of the Azure build artifacts API
+    @classmethod
+    def from_azure_json(cls, data: Dict[str, Any]) -> "Artifact":
+        return cls(str(data.get("id", data["name"])), data["name"], data["resource"]["downloadUrl"])
+
+
+# The toJson(github) context of the GitHub Actions job
+# The webhook payload in event is kept as decoded JSON, since its layout depends on event_name.
+class JobContext(Model):
+    __slots__ = ("event_name", "actor", "event")
+
+    def __init__(self, event_name: str, actor: Optional[str], event: Dict[str, Any]) -> None:
+        self.event_name = event_name
+        self.actor = actor
+        self.event = event
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "JobContext":
+        return cls(data["event_name"], data.get("actor"), data.get("event") or {})
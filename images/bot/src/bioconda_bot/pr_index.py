@@ -0,0 +1,78 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+from .cache import get_cache_dir
+from .github import RECIPES_REPO, GitHubClient
+from .models import PullRequest
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+# Stop refreshing the index after this many pages, the caller falls back to a full scan then
+MAX_INDEX_PAGES = 20
+
+
+# Head sha -> PR number index of the open bioconda-recipes PRs, persisted between runs
+# It's refreshed incrementally by walking the PRs sorted by their last update time
+# until a PR that was already seen at the last refresh shows up.
+class PRHeadIndex:
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or str(get_cache_dir("github") / "pr-heads.json")
+        # PR number -> head sha, only for open PRs
+        self.heads: Dict[int, str] = {}
+        # updated_at of the most recently updated PR seen so far (ISO 8601 strings sort by time)
+        self.updated_at: Optional[str] = None
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            return
+        self.heads = {int(pr): sha for pr, sha in data["heads"].items()}
+        self.updated_at = data["updated_at"]
+
+    def save(self) -> None:
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump({"heads": self.heads, "updated_at": self.updated_at}, fd)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, sha: str) -> List[int]:
+        return sorted(pr for pr, head_sha in self.heads.items() if head_sha == sha)
+
+    # Walk PRs updated since the last refresh, return False if the index couldn't be brought up to date
+    async def refresh(self, github: GitHubClient) -> bool:
+        if self.updated_at is None:
+            # First run, all open PRs need to be indexed
+            params = {"state": "open", "sort": "updated", "direction": "desc"}
+        else:
+            # Closed PRs need to be seen too, to drop them from the index
+            params = {"state": "all", "sort": "updated", "direction": "desc"}
+        per_page = 100
+        newest = self.updated_at
+        for page in range(1, MAX_INDEX_PAGES + 1):
+            prs = await github.get_json(
+                f"{RECIPES_REPO}/pulls", params={**params, "per_page": per_page, "page": page}
+            )
+            for pr in PullRequest.from_json_list(prs):
+                if self.updated_at is not None and pr.updated_at < self.updated_at:
+                    self.updated_at = newest
+                    return True
+                if newest is None or pr.updated_at > newest:
+                    newest = pr.updated_at
+                if pr.state == "open":
+                    self.heads[pr.number] = pr.head_sha
+                else:
+                    self.heads.pop(pr.number, None)
+            if len(prs) < per_page:
+                self.updated_at = newest
+                return True
+        # Too far behind, start over with the open PRs next time
+        log("PR head index refresh stopped after %d pages", MAX_INDEX_PAGES)
+        self.heads = {}
+        self.updated_at = None
+        return False
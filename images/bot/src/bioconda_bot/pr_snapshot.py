@@ -0,0 +1,186 @@
+import logging
+from typing import Any, Dict, List, Optional, Set
+
+from aiohttp import ClientSession
+
+from .github import GitHubClient, get_github
+from .models import Review
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+REPO_OWNER = "bioconda"
+REPO_NAME = "bioconda-recipes"
+# GitHub lists at most 250 commits of a PR, in pages of up to 100
+MAX_SNAPSHOT_COMMIT_PAGES = 3
+
+PR_FIELDS = """
+    number
+    state
+    merged
+    mergeable
+    mergeStateStatus
+    headRefOid
+    headRefName
+    headRepository { nameWithOwner }
+    labels(first: 100) { nodes { name } }
+    reviews(first: 100, states: APPROVED) {
+        nodes { state authorAssociation author { login } }
+    }
+    headCommit: commits(last: 1) {
+        nodes { commit { statusCheckRollup { state } } }
+    }
+"""
+
+COMMITS_FIELDS = """
+    commits(first: 100, after: $after) {
+        totalCount
+        pageInfo { hasNextPage endCursor }
+        nodes { commit { oid message } }
+    }
+"""
+
+PR_QUERY = f"""
+query($owner: String!, $name: String!, $number: Int!, $after: String) {{
+    repository(owner: $owner, name: $name) {{
+        pullRequest(number: $number) {{ {PR_FIELDS} {COMMITS_FIELDS} }}
+    }}
+}}
+"""
+
+COMMITS_QUERY = f"""
+query($owner: String!, $name: String!, $number: Int!, $after: String) {{
+    repository(owner: $owner, name: $name) {{
+        pullRequest(number: $number) {{ {COMMITS_FIELDS} }}
+    }}
+}}
+"""
+
+# GraphQL mergeable -> REST mergeable
+MERGEABLE_VALUES = {"MERGEABLE": True, "CONFLICTING": False}
+# Review authors with these associations are members of the bioconda organization
+MEMBER_ASSOCIATIONS = {"MEMBER", "OWNER"}
+
+
+# Everything the merge path needs to know about a PR, from one (paginated) GraphQL query
+# The field names match the PullRequest model where they overlap.
+class PRSnapshot:
+    __slots__ = (
+        "number",
+        "state",
+        "head_sha",
+        "head_ref",
+        "head_repo",
+        "merged",
+        "mergeable",
+        "mergeable_state",
+        "commits",
+        "labels",
+        "reviews",
+        "commit_messages",
+        "check_state",
+    )
+
+    def __init__(
+        self,
+        number: int,
+        state: str,
+        head_sha: str,
+        head_ref: str,
+        head_repo: Optional[str],
+        merged: bool,
+        mergeable: Optional[bool],
+        mergeable_state: Optional[str],
+        commits: int,
+        labels: Set[str],
+        reviews: List[Review],
+        commit_messages: List[str],
+        check_state: Optional[str],
+    ) -> None:
+        self.number = number
+        self.state = state
+        self.head_sha = head_sha
+        self.head_ref = head_ref
+        self.head_repo = head_repo
+        self.merged = merged
+        self.mergeable = mergeable
+        self.mergeable_state = mergeable_state
+        self.commits = commits
+        self.labels = labels
+        # Approving reviews only
+        self.reviews = reviews
+        # Oldest first, at most the first 250
+        self.commit_messages = commit_messages
+        # Combined state of the head commit's checks and statuses, e.g., "SUCCESS" or "PENDING"
+        self.check_state = check_state
+
+    @classmethod
+    def from_graphql(cls, data: Dict[str, Any], commit_messages: List[str]) -> "PRSnapshot":
+        head_commits = data["headCommit"]["nodes"]
+        rollup = head_commits[0]["commit"]["statusCheckRollup"] if head_commits else None
+        merge_state_status = data.get("mergeStateStatus")
+        return cls(
+            data["number"],
+            data["state"].lower(),
+            data["headRefOid"],
+            data["headRefName"],
+            (data.get("headRepository") or {}).get("nameWithOwner"),
+            data["merged"],
+            MERGEABLE_VALUES.get(data["mergeable"]),
+            merge_state_status.lower() if merge_state_status else None,
+            data["commits"]["totalCount"],
+            {label["name"] for label in data["labels"]["nodes"]},
+            [
+                Review(
+                    review["state"],
+                    (review.get("author") or {}).get("login"),
+                    review.get("authorAssociation"),
+                )
+                for review in data["reviews"]["nodes"]
+            ],
+            commit_messages,
+            (rollup or {}).get("state"),
+        )
+
+    @classmethod
+    async def fetch(cls, github: GitHubClient, pr: int) -> "PRSnapshot":
+        variables: Dict[str, Any] = {"owner": REPO_OWNER, "name": REPO_NAME, "number": pr, "after": None}
+        data = (await github.graphql(PR_QUERY, variables))["repository"]["pullRequest"]
+        commits = data["commits"]
+        commit_messages = [node["commit"]["message"] for node in commits["nodes"]]
+        pages = 1
+        # Cursors have to be followed, so the remaining pages are fetched one after the other
+        while commits["pageInfo"]["hasNextPage"] and pages < MAX_SNAPSHOT_COMMIT_PAGES:
+            variables["after"] = commits["pageInfo"]["endCursor"]
+            result = await github.graphql(COMMITS_QUERY, variables)
+            commits = result["repository"]["pullRequest"]["commits"]
+            commit_messages.extend(node["commit"]["message"] for node in commits["nodes"])
+            pages += 1
+        return cls.from_graphql(data, commit_messages)
+
+    # Approving reviews whose author's membership still has to be checked
+    def reviews_to_check(self) -> List[Review]:
+        return [review for review in self.reviews if review.author_association not in MEMBER_ASSOCIATIONS]
+
+    def approved_by_member(self) -> bool:
+        return any(review.author_association in MEMBER_ASSOCIATIONS for review in self.reviews)
+
+
+# Fetch the snapshot of a PR, return None if GraphQL isn't available so the caller uses REST
+async def get_pr_snapshot(session: ClientSession, pr: int) -> Optional[PRSnapshot]:
+    try:
+        snapshot = await PRSnapshot.fetch(get_github(session), pr)
+    except Exception as error:
+        log("GraphQL snapshot of PR %d failed (%s), using the REST API", pr, error)
+        return None
+    log(
+        "PR %d: head %s, mergeable %s (%s), checks %s, %d approvals, labels %s",
+        pr,
+        snapshot.head_sha,
+        snapshot.mergeable,
+        snapshot.mergeable_state,
+        snapshot.check_state,
+        len(snapshot.reviews),
+        ", ".join(sorted(snapshot.labels)) or "none",
+    )
+    return snapshot
@@ -0,0 +1,348 @@
+import gzip
+import json
+import logging
+import os
+import re
+import tarfile
+from asyncio import Semaphore, gather, get_running_loop
+from collections import OrderedDict
+from hashlib import sha256
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+from weakref import WeakKeyDictionary
+from zipfile import ZipFile, ZipInfo
+
+from aiohttp import BasicAuth, ClientSession, ClientTimeout
+from yarl import URL
+
+from .cache import get_cache_dir
+from .scheduler import request
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+# Set BIOCONDA_BOT_REGISTRY to push to another registry, e.g., http://localhost:5000 for testing
+DEFAULT_REGISTRY = "https://quay.io"
+MANIFEST_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+CONFIG_MEDIA_TYPE = "application/vnd.docker.container.image.v1+json"
+GZIP_LAYER_MEDIA_TYPE = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+# Number of concurrent blob uploads per image
+MAX_BLOB_UPLOADS = 4
+# Files of the archive up to this size are kept in memory, larger ones are layers
+SMALL_FILE_SIZE = 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+# Uncompressed layers are gzipped with this level (and no timestamp or file name), so the same
+# layer always gets the same digest
+LAYER_COMPRESS_LEVEL = 6
+# Number of blob digests whose repository is remembered for cross-repository mounts
+MAX_MOUNT_INDEX_ENTRIES = 5000
+BLOB_TIMEOUT = ClientTimeout(total=None, sock_connect=60, sock_read=600)
+
+
+class RegistryError(Exception):
+    pass
+
+
+# A blob (config or layer) of the image
+class Blob:
+    __slots__ = ("digest", "size", "media_type", "path", "data")
+
+    def __init__(
+        self,
+        digest: str,
+        size: int,
+        media_type: str,
+        path: Optional[str] = None,
+        data: Optional[bytes] = None,
+    ) -> None:
+        self.digest = digest
+        self.size = size
+        self.media_type = media_type
+        # Layers are spooled to path, configs are kept in data
+        self.path = path
+        self.data = data
+
+
+# Pass writes through to fd while keeping track of their size and digest
+class HashingWriter:
+    def __init__(self, fd) -> None:
+        self.fd = fd
+        self.checksum = sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.checksum.update(data)
+        self.size += len(data)
+        return self.fd.write(data)
+
+    def flush(self) -> None:
+        self.fd.flush()
+
+    @property
+    def digest(self) -> str:
+        return f"sha256:{self.checksum.hexdigest()}"
+
+
+# Spool a layer to path, gzipped, and return its blob
+# Compressed layers are copied unchanged. The uncompressed layers of "docker save" are gzipped
+# deterministically, so a layer shared by several images (e.g., the base image) gets the same
+# digest in all of them and is only pushed once, while pulls still get compressed layers.
+def spool_layer(src, path: str) -> Blob:
+    head = src.read(2)
+    with open(path, "wb") as fd:
+        writer = HashingWriter(fd)
+        if head == b"\x1f\x8b":
+            dst = writer
+        else:
+            dst = gzip.GzipFile(filename="", mode="wb", fileobj=writer, compresslevel=LAYER_COMPRESS_LEVEL, mtime=0)
+        try:
+            dst.write(head)
+            while True:
+                chunk = src.read(COPY_BUFFER_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        finally:
+            if dst is not writer:
+                dst.close()
+    return Blob(writer.digest, writer.size, GZIP_LAYER_MEDIA_TYPE, path=path)
+
+
+# Read a docker-archive (as written by "docker save") from a zip member in one pass
+# Returns the config and the layer blobs in the order of the image's manifest.json.
+def read_docker_archive(zf: ZipFile, e: ZipInfo, spool_dir: str) -> Tuple[Blob, List[Blob]]:
+    small_files: Dict[str, bytes] = {}
+    layers: Dict[str, Blob] = {}
+    with zf.open(e) as member, tarfile.open(fileobj=member, mode="r|*") as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            src = tar.extractfile(info)
+            if info.size <= SMALL_FILE_SIZE:
+                small_files[info.name] = src.read()
+            else:
+                layers[info.name] = spool_layer(src, os.path.join(spool_dir, f"layer{len(layers)}"))
+    if "manifest.json" not in small_files:
+        raise RegistryError(f"{e.filename} has no manifest.json")
+    (manifest,) = json.loads(small_files["manifest.json"])
+    config_data = small_files.get(manifest["Config"])
+    if config_data is None:
+        raise RegistryError(f"{e.filename}: config {manifest['Config']} not found")
+    config = Blob(f"sha256:{sha256(config_data).hexdigest()}", len(config_data), CONFIG_MEDIA_TYPE, data=config_data)
+    blobs = []
+    for name in manifest["Layers"]:
+        if name not in layers and name in small_files:
+            # Tiny layer, spool it like the others
+            layers[name] = spool_layer(BytesIO(small_files[name]), os.path.join(spool_dir, f"layer{len(layers)}"))
+        if name not in layers:
+            raise RegistryError(f"{e.filename}: layer {name} not found")
+        blobs.append(layers[name])
+    return config, blobs
+
+
+# Repositories that blobs were pushed to (or found in), persisted between runs
+# A blob that the target repository lacks is mounted from the repository it was last seen in,
+# which doesn't transfer any data. Without a persistent cache directory only the blobs of the
+# current run are known.
+class MountIndex:
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or str(get_cache_dir("registry") / "blobs.json")
+        # Digest -> repository, least recently used first
+        self.repositories: "OrderedDict[str, str]" = OrderedDict()
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as fd:
+                self.repositories.update(json.load(fd))
+        except (OSError, ValueError):
+            return
+
+    def save(self) -> None:
+        while len(self.repositories) > MAX_MOUNT_INDEX_ENTRIES:
+            self.repositories.popitem(last=False)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump(self.repositories, fd)
+        os.replace(tmp_path, self.path)
+
+    # Return a repository other than repository that has the blob
+    def source(self, digest: str, repository: str) -> Optional[str]:
+        source = self.repositories.get(digest)
+        return source if source != repository else None
+
+    def add(self, digest: str, repository: str) -> None:
+        self.repositories[digest] = repository
+        self.repositories.move_to_end(digest)
+
+
+_mount_indexes: "WeakKeyDictionary[ClientSession, MountIndex]" = WeakKeyDictionary()
+
+
+# Return the mount index bound to a session, so concurrent pushes see each other's blobs
+def get_mount_index(session: ClientSession) -> MountIndex:
+    index = _mount_indexes.get(session)
+    if index is None:
+        index = _mount_indexes[session] = MountIndex()
+    return index
+
+
+# Minimal Docker Registry HTTP API V2 client for pushing images
+class RegistryClient:
+    def __init__(self, session: ClientSession, base_url: str, credentials: Optional[str] = None) -> None:
+        self.session = session
+        self.base_url = base_url.rstrip("/")
+        self.auth = BasicAuth(*credentials.split(":", 1)) if credentials else None
+        # Scopes -> bearer token
+        self.tokens: Dict[Tuple[str, ...], str] = {}
+
+    # Get a bearer token for the repository (and pulls from mount_from) if the registry asks for one
+    async def headers(self, repository: str, mount_from: Optional[str] = None) -> Dict[str, str]:
+        scopes: Tuple[str, ...] = (f"repository:{repository}:pull,push",)
+        if mount_from:
+            scopes += (f"repository:{mount_from}:pull",)
+        if scopes in self.tokens:
+            return {"Authorization": f"Bearer {self.tokens[scopes]}"}
+        async with request(self.session, "GET", f"{self.base_url}/v2/") as response:
+            challenge = response.headers.get("WWW-Authenticate", "")
+            status = response.status
+        if status == 200:
+            return {}
+        if challenge.lower().startswith("basic") and self.auth:
+            return {"Authorization": self.auth.encode()}
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        if "realm" not in params:
+            raise RegistryError(f"Unsupported registry authentication: {challenge!r}")
+        query: List[Tuple[str, str]] = [("scope", scope) for scope in scopes]
+        if "service" in params:
+            query.append(("service", params["service"]))
+        async with request(
+            self.session, "GET", params["realm"], params=query, auth=self.auth
+        ) as response:
+            response.raise_for_status()
+            token_response = await response.json()
+        self.tokens[scopes] = token_response.get("token") or token_response["access_token"]
+        return {"Authorization": f"Bearer {self.tokens[scopes]}"}
+
+    async def blob_exists(self, repository: str, digest: str) -> bool:
+        headers = await self.headers(repository)
+        url = f"{self.base_url}/v2/{repository}/blobs/{digest}"
+        async with request(self.session, "HEAD", url, headers=headers) as response:
+            return response.status == 200
+
+    # Mount the blob from mount_from if given, otherwise (or if that fails) start an upload
+    # Returns the upload URL, None if the blob was mounted.
+    async def start_upload(self, repository: str, digest: str, mount_from: Optional[str] = None) -> Optional[str]:
+        headers = await self.headers(repository, mount_from)
+        url = f"{self.base_url}/v2/{repository}/blobs/uploads/"
+        params = {"mount": digest, "from": mount_from} if mount_from else None
+        async with request(self.session, "POST", url, params=params, headers=headers) as response:
+            if response.status == 201 and mount_from:
+                return None
+            if response.status != 202:
+                raise RegistryError(f"Starting upload of {digest} failed: {response.status}")
+            return urljoin(f"{self.base_url}/", response.headers["Location"])
+
+    async def upload_blob(self, repository: str, blob: Blob, location: str) -> None:
+        headers = await self.headers(repository)
+        upload_url = URL(location, encoded=True).update_query(digest=blob.digest)
+        headers = {**headers, "Content-Type": "application/octet-stream", "Content-Length": str(blob.size)}
+        if blob.data is not None:
+            data = blob.data
+        else:
+            data = open(blob.path, "rb")
+        try:
+            async with request(
+                self.session, "PUT", str(upload_url), max_retries=0, data=data, headers=headers, timeout=BLOB_TIMEOUT
+            ) as response:
+                if response.status != 201:
+                    raise RegistryError(f"Upload of {blob.digest} failed: {response.status} {await response.text()}")
+        finally:
+            if blob.data is None:
+                data.close()
+
+    async def put_manifest(self, repository: str, tag: str, manifest: bytes) -> None:
+        headers = {**await self.headers(repository), "Content-Type": MANIFEST_MEDIA_TYPE}
+        url = f"{self.base_url}/v2/{repository}/manifests/{tag}"
+        async with request(self.session, "PUT", url, data=manifest, headers=headers) as response:
+            if response.status not in (200, 201):
+                raise RegistryError(f"Pushing manifest {repository}:{tag} failed: {response.status} {await response.text()}")
+
+
+def build_manifest(config: Blob, layers: List[Blob]) -> bytes:
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": MANIFEST_MEDIA_TYPE,
+        "config": {"mediaType": CONFIG_MEDIA_TYPE, "size": config.size, "digest": config.digest},
+        "layers": [
+            {"mediaType": layer.media_type, "size": layer.size, "digest": layer.digest}
+            for layer in layers
+        ],
+    }
+    return json.dumps(manifest, indent=3).encode()
+
+
+# Push the image in a docker-archive zip member to repository:tag
+# The layers have to be spooled to spool_dir, since their digests are needed before they're
+# sent. Only blobs the repository doesn't have yet are transferred (concurrently): those the
+# mount index knows from another repository are mounted, the rest are uploaded. So a retry
+# after a failed push only sends what is still missing. Returns the number of bytes uploaded.
+async def push_docker_archive(
+    session: ClientSession,
+    zf: ZipFile,
+    e: ZipInfo,
+    repository: str,
+    tag: str,
+    spool_dir: str,
+    credentials: Optional[str] = None,
+    max_tries: int = 5,
+) -> int:
+    registry = RegistryClient(session, os.environ.get("BIOCONDA_BOT_REGISTRY", DEFAULT_REGISTRY), credentials)
+    index = get_mount_index(session)
+    # Reading the layers is blocking => use a thread
+    config, layers = await get_running_loop().run_in_executor(None, read_docker_archive, zf, e, spool_dir)
+    blobs = {blob.digest: blob for blob in [config, *layers]}
+    slots = Semaphore(MAX_BLOB_UPLOADS)
+    uploaded = 0
+    mounted = 0
+
+    async def push_blob(blob: Blob) -> None:
+        nonlocal uploaded, mounted
+        async with slots:
+            if not await registry.blob_exists(repository, blob.digest):
+                location = await registry.start_upload(
+                    repository, blob.digest, index.source(blob.digest, repository)
+                )
+                if location is None:
+                    mounted += blob.size
+                else:
+                    await registry.upload_blob(repository, blob, location)
+                    uploaded += blob.size
+            index.add(blob.digest, repository)
+
+    for attempt in range(1, max_tries + 1):
+        try:
+            await gather(*map(push_blob, blobs.values()))
+            await registry.put_manifest(repository, tag, build_manifest(config, layers))
+            break
+        except Exception as error:
+            if attempt == max_tries:
+                raise
+            log("Push of %s:%s failed (%s), resuming (attempt %d/%d)", repository, tag, error, attempt + 1, max_tries)
+            registry.tokens.clear()
+    try:
+        index.save()
+    except OSError as error:
+        log("Saving the blob mount index failed (%s)", error)
+    total = sum(blob.size for blob in blobs.values())
+    log(
+        "Pushed %s:%s: uploaded %.1f MiB, mounted %.1f MiB, %.1f MiB of %d blobs were already in the repository",
+        repository,
+        tag,
+        uploaded / 1024 ** 2,
+        mounted / 1024 ** 2,
+        (total - uploaded - mounted) / 1024 ** 2,
+        len(blobs),
+    )
+    return uploaded
@@ -0,0 +1,124 @@
+import logging
+import re
+import struct
+from typing import List, Mapping, Optional, Tuple
+
+from aiohttp import ClientSession
+
+from .scheduler import request
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+# End of central directory record: fixed part + maximum comment length
+EOCD_SIGNATURE = b"PK\x05\x06"
+EOCD_SIZE = 22
+EOCD_MAX_SEARCH = EOCD_SIZE + 0xFFFF
+ZIP64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+ZIP64_LOCATOR_SIZE = 20
+ZIP64_EOCD_SIGNATURE = b"PK\x06\x06"
+ZIP64_EOCD_SIZE = 56
+CENTRAL_DIRECTORY_SIGNATURE = b"PK\x01\x02"
+CENTRAL_DIRECTORY_SIZE = 46
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+# Fetch a byte range of url, return (data, total size of the remote file)
+# A suffix range is requested if start is negative.
+async def fetch_range(
+    session: ClientSession,
+    url: str,
+    start: int,
+    end: Optional[int] = None,
+    headers: Optional[Mapping[str, str]] = None,
+) -> Tuple[bytes, int]:
+    if start < 0:
+        byte_range = f"bytes={start}"
+    else:
+        byte_range = f"bytes={start}-{'' if end is None else end}"
+    request_headers = dict(headers or {})
+    request_headers["Range"] = byte_range
+    async with request(session, "GET", url, headers=request_headers) as response:
+        if response.status != 206:
+            # Either an error or the server ignored the Range header and is sending the whole file
+            raise RangeNotSupported(f"{url} answered {byte_range} with {response.status}")
+        content_range = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+        if not content_range:
+            raise RangeNotSupported(f"{url} returned no usable Content-Range")
+        data = await response.read()
+    return data, int(content_range.group(1))
+
+
+# Return (offset, size) of the central directory from the bytes at the end of the file
+def parse_central_directory_location(tail: bytes, tail_offset: int) -> Tuple[int, int]:
+    eocd_pos = tail.rfind(EOCD_SIGNATURE)
+    if eocd_pos < 0 or len(tail) - eocd_pos < EOCD_SIZE:
+        raise ValueError("end of central directory record not found")
+    (_, _, _, _, n_entries, cd_size, cd_offset, _) = struct.unpack(
+        "<4sHHHHIIH", tail[eocd_pos:eocd_pos + EOCD_SIZE]
+    )
+    if n_entries != 0xFFFF and cd_size != 0xFFFFFFFF and cd_offset != 0xFFFFFFFF:
+        return cd_offset, cd_size
+
+    # Zip64, the real values are in the zip64 end of central directory record
+    locator_pos = eocd_pos - ZIP64_LOCATOR_SIZE
+    if locator_pos < 0 or tail[locator_pos:locator_pos + 4] != ZIP64_LOCATOR_SIGNATURE:
+        raise ValueError("zip64 end of central directory locator not found")
+    (_, _, zip64_eocd_offset, _) = struct.unpack(
+        "<4sIQI", tail[locator_pos:locator_pos + ZIP64_LOCATOR_SIZE]
+    )
+    record_pos = zip64_eocd_offset - tail_offset
+    if record_pos < 0:
+        raise ValueError("zip64 end of central directory record not in fetched range")
+    record = tail[record_pos:record_pos + ZIP64_EOCD_SIZE]
+    if len(record) != ZIP64_EOCD_SIZE or record[:4] != ZIP64_EOCD_SIGNATURE:
+        raise ValueError("zip64 end of central directory record not found")
+    (_, _, _, _, _, _, _, _, cd_size, cd_offset) = struct.unpack("<4sQHHIIQQQQ", record)
+    return cd_offset, cd_size
+
+
+# Return the file names listed in a central directory
+def parse_central_directory(data: bytes) -> List[str]:
+    names = []
+    pos = 0
+    while pos + CENTRAL_DIRECTORY_SIZE <= len(data):
+        if data[pos:pos + 4] != CENTRAL_DIRECTORY_SIGNATURE:
+            break
+        flags = struct.unpack("<H", data[pos + 8:pos + 10])[0]
+        name_len, extra_len, comment_len = struct.unpack("<HHH", data[pos + 28:pos + 34])
+        raw_name = data[pos + CENTRAL_DIRECTORY_SIZE:pos + CENTRAL_DIRECTORY_SIZE + name_len]
+        # Same decoding rules as zipfile: bit 11 marks UTF-8 names
+        names.append(raw_name.decode("utf-8" if flags & 0x800 else "cp437"))
+        pos += CENTRAL_DIRECTORY_SIZE + name_len + extra_len + comment_len
+    return names
+
+
+# List the file names in a remote zip file by only fetching its central directory
+# Returns None if the server doesn't support Range requests or the file can't be parsed,
+# in which case the caller needs to download the whole file.
+async def list_remote_zip_contents(
+    session: ClientSession, url: str, headers: Optional[Mapping[str, str]] = None
+) -> Optional[List[str]]:
+    try:
+        tail, total_size = await fetch_range(session, url, -EOCD_MAX_SEARCH, headers=headers)
+        tail_offset = total_size - len(tail)
+        fetched = len(tail)
+        cd_offset, cd_size = parse_central_directory_location(tail, tail_offset)
+        if cd_offset >= tail_offset:
+            # Small zip, the central directory was part of the first request
+            start = cd_offset - tail_offset
+            central_directory = tail[start:start + cd_size]
+        else:
+            central_directory, _ = await fetch_range(
+                session, url, cd_offset, cd_offset + cd_size - 1, headers=headers
+            )
+            fetched += len(central_directory)
+    except (RangeNotSupported, ValueError, struct.error) as e:
+        log("Cannot read zip index remotely, falling back to a full download: %s", e)
+        return None
+    names = parse_central_directory(central_directory)
+    log("Read %d zip entries from %d bytes of %s", len(names), fetched, url)
+    return names
@@ -0,0 +1,249 @@
+import logging
+import random
+import time
+from asyncio import TimeoutError, sleep
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncContextManager, AsyncIterator, Dict, Iterator, List, Mapping, Optional, Tuple
+from urllib.parse import urlsplit
+from weakref import WeakKeyDictionary
+
+from aiohttp import ClientConnectionError, ClientResponse, ClientSession
+
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+MAX_RETRIES = 5
+# Exponential backoff: BACKOFF_BASE * 2 ** attempt seconds (with full jitter), at most BACKOFF_MAX
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# Never wait longer than this for a rate limit window to reset
+MAX_RATE_LIMIT_WAIT = 15 * 60
+# Start spreading out requests once less than this fraction of the rate limit is left
+LOW_BUDGET_FRACTION = 0.1
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Methods that are safe to repeat after a server error or a dropped connection
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+# Return the name of the rate limit a request counts against, GitHub reports it in X-RateLimit-Resource
+# GraphQL and search requests have their own rate limits, separate from the core REST API one.
+def get_rate_limit_resource(path: str) -> str:
+    if path.startswith("/graphql"):
+        return "graphql"
+    if path.startswith("/search/"):
+        return "search"
+    return "core"
+
+
+# Requests sent to one rate limit (resource) of a host
+class Usage:
+    __slots__ = ("requests", "retries", "waited")
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.retries = 0
+        self.waited = 0.0
+
+
+# (host, resource) -> usage of the requests sent in a scoped_usage() block
+_scoped_usage: "ContextVar[Optional[Dict[Tuple[str, str], Usage]]]" = ContextVar(
+    "bioconda_bot_usage", default=None
+)
+
+
+# Count the requests sent in this block (and the tasks started in it) separately
+# The webhook server uses this to report the usage of each event, while other events are handled
+# concurrently with the same session.
+@contextmanager
+def scoped_usage() -> Iterator[Dict[Tuple[str, str], Usage]]:
+    usage: Dict[Tuple[str, str], Usage] = {}
+    token = _scoped_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _scoped_usage.reset(token)
+
+
+# Rate limit state and usage of one rate limit (resource) of a host
+class HostBudget:
+    __slots__ = ("limit", "remaining", "reset", "usage")
+
+    def __init__(self) -> None:
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        # Epoch seconds when the rate limit window resets
+        self.reset: Optional[float] = None
+        # For the lifetime of the session
+        self.usage = Usage()
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        try:
+            if "X-RateLimit-Limit" in headers:
+                self.limit = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Reset" in headers:
+                self.reset = float(headers["X-RateLimit-Reset"])
+        except ValueError:
+            pass
+
+    # Seconds to wait before the next request so the budget lasts until the window resets
+    def delay(self) -> float:
+        if self.remaining is None or self.limit is None or self.reset is None:
+            return 0.0
+        until_reset = self.reset - time.time()
+        if until_reset <= 0:
+            return 0.0
+        if self.remaining <= 0:
+            return min(until_reset, MAX_RATE_LIMIT_WAIT)
+        if self.remaining < self.limit * LOW_BUDGET_FRACTION:
+            return min(until_reset / self.remaining, BACKOFF_MAX)
+        return 0.0
+
+
+# Return the delay requested by a rate limited response, None if it isn't rate limited
+def get_rate_limit_delay(response: ClientResponse) -> Optional[float]:
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            return BACKOFF_MAX
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        try:
+            return max(0.0, float(response.headers["X-RateLimit-Reset"]) - time.time())
+        except (KeyError, ValueError):
+            return BACKOFF_MAX
+    return None
+
+
+# Sends all of the bot's HTTP requests
+# It tracks the rate limit budget of each host and resource (from the X-RateLimit-* headers), spreads
+# requests out when a budget runs low and retries rate limited (403/429) and transient (5xx,
+# connection errors) failures with jittered exponential backoff.
+class RequestScheduler:
+    def __init__(self, session: ClientSession, max_retries: int = MAX_RETRIES) -> None:
+        self.session = session
+        self.max_retries = max_retries
+        # (host, resource) -> budget
+        self.budgets: Dict[Tuple[str, str], HostBudget] = {}
+
+    def budget(self, host: str, resource: str) -> HostBudget:
+        key = (host, resource)
+        if key not in self.budgets:
+            self.budgets[key] = HostBudget()
+        return self.budgets[key]
+
+    async def wait(self, usages: List[Usage], host: str, delay: float, reason: str) -> None:
+        if delay <= 0:
+            return
+        log("Waiting %.1fs before the next request to %s (%s)", delay, host, reason)
+        for usage in usages:
+            usage.waited += delay
+        with span("wait", host, reason=reason):
+            await sleep(delay)
+
+    # Set max_retries=0 for requests whose body can only be sent once (e.g., file objects)
+    @asynccontextmanager
+    async def request(
+        self, method: str, url: str, max_retries: Optional[int] = None, **kwargs: Any
+    ) -> AsyncIterator[ClientResponse]:
+        method = method.upper()
+        max_retries = self.max_retries if max_retries is None else max_retries
+        parts = urlsplit(url)
+        host = parts.hostname or ""
+        key = (host, get_rate_limit_resource(parts.path))
+        budget = self.budget(*key)
+        usages = [budget.usage]
+        scoped = _scoped_usage.get()
+        if scoped is not None:
+            usages.append(scoped.setdefault(key, Usage()))
+        attempt = 0
+        with span("http", f"{method} {host}", url=url) as http_span:
+            while True:
+                await self.wait(usages, host, budget.delay(), "rate limit budget is low")
+                for usage in usages:
+                    usage.requests += 1
+                try:
+                    response = await self.session.request(method, url, **kwargs)
+                except (ClientConnectionError, TimeoutError) as e:
+                    if method not in IDEMPOTENT_METHODS or attempt >= max_retries:
+                        raise
+                    delay = self.backoff(attempt)
+                    reason = f"{type(e).__name__}: {e}"
+                else:
+                    # The response says which rate limit it counted against
+                    resource = response.headers.get("X-RateLimit-Resource")
+                    (self.budget(host, resource) if resource else budget).update(response.headers)
+                    delay = self.retry_delay(method, response, attempt, max_retries)
+                    if delay is None:
+                        http_span.set(status=response.status, retries=attempt, bytes=response.content_length)
+                        try:
+                            yield response
+                        finally:
+                            response.release()
+                        return
+                    reason = f"status {response.status}"
+                    response.release()
+                attempt += 1
+                for usage in usages:
+                    usage.retries += 1
+                await self.wait(usages, host, delay, f"retry {attempt}/{max_retries} after {reason}")
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    # Return how long to wait before retrying a request, None if the response should be used
+    def retry_delay(
+        self, method: str, response: ClientResponse, attempt: int, max_retries: int
+    ) -> Optional[float]:
+        if attempt >= max_retries:
+            return None
+        if response.status in (403, 429):
+            # Primary and secondary rate limits are reported as 403 or 429
+            delay = get_rate_limit_delay(response)
+            if delay is None:
+                return self.backoff(attempt) if response.status == 429 else None
+            return min(delay, MAX_RATE_LIMIT_WAIT) + random.uniform(0, BACKOFF_BASE)
+        if response.status in RETRY_STATUSES and method in IDEMPOTENT_METHODS:
+            return self.backoff(attempt)
+        return None
+
+    # Log the usage of the whole session, or the one of a scoped_usage() block
+    def log_usage(self, usages: Optional[Dict[Tuple[str, str], Usage]] = None) -> None:
+        if usages is None:
+            usages = {key: budget.usage for key, budget in self.budgets.items()}
+        for (host, resource), usage in sorted(usages.items()):
+            budget = self.budget(host, resource)
+            remaining = "unknown" if budget.remaining is None else f"{budget.remaining}/{budget.limit}"
+            log(
+                "%s (%s): %d requests, %d retries, %.1fs waited, rate limit remaining: %s",
+                host,
+                resource,
+                usage.requests,
+                usage.retries,
+                usage.waited,
+                remaining,
+            )
+
+
+_schedulers: "WeakKeyDictionary[ClientSession, RequestScheduler]" = WeakKeyDictionary()
+
+
+# Return the request scheduler bound to a session
+def get_scheduler(session: ClientSession) -> RequestScheduler:
+    scheduler = _schedulers.get(session)
+    if scheduler is None:
+        scheduler = _schedulers[session] = RequestScheduler(session)
+    return scheduler
+
+
+# Send a request through the session's scheduler, use as "async with request(...) as response:"
+def request(
+    session: ClientSession, method: str, url: str, **kwargs: Any
+) -> AsyncContextManager[ClientResponse]:
+    return get_scheduler(session).request(method, url, **kwargs)
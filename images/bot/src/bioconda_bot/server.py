@@ -0,0 +1,189 @@
+import hmac
+import json
+import logging
+import time
+from asyncio import Queue, QueueFull, create_task, gather
+from hashlib import sha256
+from importlib import import_module
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from aiohttp import ClientSession, web
+
+from .coalesce import get_coalescer
+from .common import create_session
+from .github import save_github_async
+from .models import JobContext
+from .scheduler import get_scheduler, scoped_usage
+from .tracing import get_tracer, span
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+# Number of events handled concurrently
+DEFAULT_WORKERS = 8
+# Deliveries beyond this many queued events are refused with 503, GitHub shows them as failed
+MAX_QUEUED_EVENTS = 1000
+# Seconds to collect status events for a sha before acting on them
+DEFAULT_SERVER_COALESCE_WINDOW = 30.0
+# Remember this many delivery IDs to ignore redeliveries
+MAX_RECENT_DELIVERIES = 10000
+# Save the ETag cache at most this often (in seconds), it's saved on shutdown as well
+GITHUB_SAVE_INTERVAL = 60.0
+
+Handler = Callable[[ClientSession, JobContext], Awaitable[None]]
+
+
+# Return the names of the modules whose handle() should process an event
+# This mirrors which bioconda-bot subcommand the GitHub Actions workflows run for an event.
+def route(job_context: JobContext) -> List[str]:
+    if job_context.event_name == "issue_comment":
+        comment = ((job_context.event.get("comment") or {}).get("body") or "").lower()
+        if comment.startswith(("@bioconda-bot", "@biocondabot")):
+            if "please update" in comment:
+                return ["update"]
+            if " please merge" in comment:
+                return ["merge"]
+            if " please toggle visibility" in comment:
+                return ["changeVisibility"]
+        return ["comment"]
+    if job_context.event_name in ("status", "check_suite"):
+        return ["comment", "automerge"]
+    if job_context.event_name in ("workflow_run", "pull_request_review", "pull_request"):
+        return ["automerge"]
+    return []
+
+
+def get_handler(name: str) -> Handler:
+    handler: Handler = import_module(f".{name}", __package__).handle
+    return handler
+
+
+# Check the X-Hub-Signature-256 header of a delivery
+def verify_signature(secret: bytes, body: bytes, signature: Optional[str]) -> bool:
+    if not signature or not signature.startswith("sha256="):
+        return False
+    expected = hmac.new(secret, body, sha256).hexdigest()
+    return hmac.compare_digest(expected, signature[len("sha256="):])
+
+
+class WebhookServer:
+    def __init__(
+        self,
+        secret: str,
+        workers: int = DEFAULT_WORKERS,
+        max_queued: int = MAX_QUEUED_EVENTS,
+        coalesce_window: float = DEFAULT_SERVER_COALESCE_WINDOW,
+    ) -> None:
+        self.secret = secret.encode()
+        self.workers = workers
+        self.coalesce_window = coalesce_window
+        self.max_queued = max_queued
+        self.queue: "Optional[Queue[JobContext]]" = None
+        self.recent_deliveries: Dict[str, None] = {}
+        self.handled = 0
+        self.failed = 0
+
+    async def receive(self, req: web.Request) -> web.Response:
+        assert self.queue is not None
+        body = await req.read()
+        if not verify_signature(self.secret, body, req.headers.get("X-Hub-Signature-256")):
+            return web.Response(status=401, text="invalid signature")
+        event_name = req.headers.get("X-GitHub-Event", "")
+        if event_name == "ping":
+            return web.Response(text="pong")
+        delivery = req.headers.get("X-GitHub-Delivery", "")
+        if delivery in self.recent_deliveries:
+            return web.Response(status=202, text="already queued")
+        try:
+            event: Dict[str, Any] = json.loads(body)
+        except ValueError:
+            return web.Response(status=400, text="invalid JSON")
+        job_context = JobContext(event_name, (event.get("sender") or {}).get("login"), event)
+        if not route(job_context):
+            return web.Response(status=202, text="ignored")
+        try:
+            self.queue.put_nowait(job_context)
+        except QueueFull:
+            return web.Response(status=503, text="queue is full")
+        if delivery:
+            self.recent_deliveries[delivery] = None
+            while len(self.recent_deliveries) > MAX_RECENT_DELIVERIES:
+                del self.recent_deliveries[next(iter(self.recent_deliveries))]
+        log("Queued %s event %s (%d queued)", event_name, delivery, self.queue.qsize())
+        return web.Response(status=202, text="queued")
+
+    async def health(self, req: web.Request) -> web.Response:
+        assert self.queue is not None
+        return web.json_response(
+            {"queued": self.queue.qsize(), "handled": self.handled, "failed": self.failed}
+        )
+
+    async def handle(self, session: ClientSession, job_context: JobContext) -> None:
+        # Other events are handled concurrently with the same session, so count this one's requests
+        # and spans separately. Coalesced actions that run in the background are only in the totals.
+        with scoped_usage() as usage, get_tracer().scoped() as spans:
+            for name in route(job_context):
+                await self.handle_with(name, session, job_context)
+        get_scheduler(session).log_usage(usage)
+        get_tracer().log_summary(spans)
+        # Persist the ETag cache, so a restart keeps it
+        await save_github_async(session, GITHUB_SAVE_INTERVAL)
+        get_tracer().export()
+
+    async def handle_with(self, name: str, session: ClientSession, job_context: JobContext) -> None:
+        start = time.monotonic()
+        try:
+            with span("event", job_context.event_name, handler=name):
+                await get_handler(name)(session, job_context)
+        except Exception:
+            self.failed += 1
+            logger.exception("%s failed on a %s event", name, job_context.event_name)
+        else:
+            self.handled += 1
+            log("%s handled a %s event in %.1fs", name, job_context.event_name, time.monotonic() - start)
+
+    async def work(self, session: ClientSession, queue: "Queue[JobContext]") -> None:
+        while True:
+            job_context = await queue.get()
+            try:
+                await self.handle(session, job_context)
+            finally:
+                queue.task_done()
+
+    # Share one pooled session between all workers for the lifetime of the app
+    async def run_workers(self, app: web.Application) -> AsyncIterator[None]:
+        # Create the queue here, it has to belong to the loop the app runs in
+        self.queue = queue = Queue(self.max_queued)
+        async with create_session() as session:
+            get_coalescer(session).window = self.coalesce_window
+            tasks = [create_task(self.work(session, queue)) for _ in range(self.workers)]
+            yield
+            for task in tasks:
+                task.cancel()
+            await gather(*tasks, return_exceptions=True)
+            await get_coalescer(session).close()
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.post("/", self.receive),
+                web.post("/webhook", self.receive),
+                web.get("/healthz", self.health),
+            ]
+        )
+        app.cleanup_ctx.append(self.run_workers)
+        return app
+
+
+# Receive GitHub webhook deliveries and handle them like the GitHub Actions jobs would
+def serve(
+    secret: str,
+    host: str,
+    port: int,
+    workers: int = DEFAULT_WORKERS,
+    coalesce_window: float = DEFAULT_SERVER_COALESCE_WINDOW,
+) -> None:
+    server = WebhookServer(secret, workers, coalesce_window=coalesce_window)
+    log("Serving webhooks on %s:%d with %d workers", host, port, workers)
+    web.run_app(server.make_app(), host=host, port=port, print=None)
@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from itertools import count
+from typing import Any, Awaitable, Callable, ContextManager, DefaultDict, Dict, Iterator, List, Optional, Tuple, TypeVar
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+T = TypeVar("T")
+
+# Set these to export the spans as JSON lines (appended) and metrics as a Prometheus textfile
+TRACE_FILE_VARIABLE = "BIOCONDA_BOT_TRACE_FILE"
+METRICS_FILE_VARIABLE = "BIOCONDA_BOT_METRICS_FILE"
+METRICS_PREFIX = "bioconda_bot"
+
+_current_span: "ContextVar[Optional[Span]]" = ContextVar("bioconda_bot_span", default=None)
+# Spans finished in a Tracer.scoped() block
+_scoped_spans: "ContextVar[Optional[List[Span]]]" = ContextVar("bioconda_bot_scoped_spans", default=None)
+
+
+# One timed operation, e.g., a handler, an HTTP request, a download or a subprocess
+class Span:
+    __slots__ = ("span_id", "parent_id", "kind", "name", "start", "duration", "attributes", "error")
+
+    def __init__(self, span_id: int, parent_id: Optional[int], kind: str, name: str, attributes: Dict[str, Any]) -> None:
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.kind = kind
+        self.name = name
+        # Epoch seconds
+        self.start = time.time()
+        self.duration = 0.0
+        # Status codes, byte counts, return codes, ...
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_json(self, trace_id: str) -> Dict[str, Any]:
+        return {
+            "trace_id": trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "kind": self.kind,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+# Totals of the finished spans of one kind and name
+class SpanTotals:
+    __slots__ = ("count", "seconds", "errors", "bytes")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+        self.errors = 0
+        self.bytes = 0
+
+    def add(self, span: "Span") -> None:
+        self.count += 1
+        self.seconds += span.duration
+        self.errors += span.error is not None
+        self.bytes += span.attributes.get("bytes") or 0
+
+
+# Collects the spans of this process
+# Spans nest through a context variable, so spans started in tasks created inside a span (e.g.,
+# with gather) become its children. Finished spans are kept until the next export, the totals
+# for the metrics are kept for the lifetime of the process.
+class Tracer:
+    def __init__(self) -> None:
+        self.trace_id = uuid4().hex
+        self.ids = count(1)
+        self.finished: List[Span] = []
+        self.totals: DefaultDict[Tuple[str, str], SpanTotals] = defaultdict(SpanTotals)
+
+    @contextmanager
+    def span(self, kind: str, name: str, **attributes: Any) -> Iterator[Span]:
+        parent = _current_span.get()
+        span = Span(next(self.ids), parent.span_id if parent else None, kind, name, attributes)
+        token = _current_span.set(span)
+        start = time.monotonic()
+        try:
+            yield span
+        except BaseException as error:
+            span.error = type(error).__name__
+            raise
+        finally:
+            span.duration = time.monotonic() - start
+            _current_span.reset(token)
+            self.finish(span)
+
+    def finish(self, span: Span) -> None:
+        self.finished.append(span)
+        self.totals[span.kind, span.name].add(span)
+        scoped = _scoped_spans.get()
+        if scoped is not None:
+            scoped.append(span)
+
+    # Collect the spans finished in this block (and the tasks started in it) separately
+    # The webhook server uses this to summarize each event, while other events are handled
+    # concurrently.
+    @contextmanager
+    def scoped(self) -> Iterator[List[Span]]:
+        spans: List[Span] = []
+        token = _scoped_spans.set(spans)
+        try:
+            yield spans
+        finally:
+            _scoped_spans.reset(token)
+
+    def export_jsonl(self, path: str, spans: List[Span]) -> None:
+        with open(path, "a") as fd:
+            for span in spans:
+                fd.write(json.dumps(span.to_json(self.trace_id), default=str))
+                fd.write("\n")
+
+    def export_prometheus(self, path: str) -> None:
+        metrics = (
+            ("spans_total", "Number of finished spans", lambda totals: totals.count),
+            ("span_seconds_total", "Time spent in spans", lambda totals: totals.seconds),
+            ("span_errors_total", "Number of spans that raised", lambda totals: totals.errors),
+            ("span_bytes_total", "Bytes transferred in spans", lambda totals: totals.bytes),
+        )
+        lines: List[str] = []
+        for metric, help_text, value in metrics:
+            lines.append(f"# HELP {METRICS_PREFIX}_{metric} {help_text}")
+            lines.append(f"# TYPE {METRICS_PREFIX}_{metric} counter")
+            for (kind, name), totals in sorted(self.totals.items()):
+                labels = f'kind="{escape_label(kind)}",name="{escape_label(name)}"'
+                lines.append(f"{METRICS_PREFIX}_{metric}{{{labels}}} {value(totals)}")
+        lines.append(f"# HELP {METRICS_PREFIX}_last_export_timestamp_seconds Time of the last export")
+        lines.append(f"# TYPE {METRICS_PREFIX}_last_export_timestamp_seconds gauge")
+        lines.append(f"{METRICS_PREFIX}_last_export_timestamp_seconds {time.time()}")
+        # The textfile collector may read at any time => write the file in one go
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fd:
+            fd.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    # Write the spans finished since the last export and the metrics, if the files are configured
+    def export(self) -> None:
+        spans, self.finished = self.finished, []
+        trace_file = os.environ.get(TRACE_FILE_VARIABLE)
+        metrics_file = os.environ.get(METRICS_FILE_VARIABLE)
+        try:
+            if trace_file:
+                self.export_jsonl(trace_file, spans)
+            if metrics_file:
+                self.export_prometheus(metrics_file)
+        except OSError as error:
+            log("Exporting the trace failed (%s)", error)
+
+    # Log the totals of all spans of the process, or the ones of the spans of a scoped() block
+    def log_summary(self, spans: Optional[List[Span]] = None) -> None:
+        by_kind: DefaultDict[str, SpanTotals] = defaultdict(SpanTotals)
+        if spans is not None:
+            for span in spans:
+                by_kind[span.kind].add(span)
+        else:
+            for (kind, _), totals in self.totals.items():
+                kind_totals = by_kind[kind]
+                kind_totals.count += totals.count
+                kind_totals.seconds += totals.seconds
+                kind_totals.errors += totals.errors
+        for kind, totals in sorted(by_kind.items()):
+            log("Trace: %d %s spans, %.1fs, %d errors", totals.count, kind, totals.seconds, totals.errors)
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+# Start a span as a child of the current one, use as "with span(...) as s:"
+def span(kind: str, name: str, **attributes: Any) -> ContextManager[Span]:
+    return _tracer.span(kind, name, **attributes)
+
+
+# Run a coroutine function in a "handler" span named after it
+def traced(function: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    @wraps(function)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        with span("handler", function.__name__):
+            return await function(*args, **kwargs)
+
+    return wrapper
@@ -1,72 +1,349 @@
 import logging
-import sys
+import os
+import time
+from asyncio import Semaphore, gather
+from contextlib import AsyncExitStack, asynccontextmanager
+from enum import Enum, auto
+from tempfile import TemporaryDirectory
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
 
 from aiohttp import ClientSession
 
 from .common import (
     async_exec,
+    async_exec_output,
+    create_session,
     get_job_context,
     get_pr_comment,
     get_pr_info,
+    list_labeled_prs,
     send_comment,
 )
+from .git_mirror import (
+    UPSTREAM_BRANCH,
+    UPSTREAM_URL,
+    UpstreamMirror,
+    get_upstream_mirror,
+    mirror_enabled,
+    temporary_upstream_mirror,
+)
+from .models import JobContext
+from .tracing import traced
 
 logger = logging.getLogger(__name__)
 log = logger.info
 
 
-# Update a branch from upstream master, this should be run in a try/catch
-async def update_from_master_runner(session: ClientSession, pr: int) -> None:
-    async def git(*args: str) -> None:
-        return await async_exec("git", *args)
+GIT_USER_NAME = "BiocondaBot"
+GIT_USER_EMAIL = "biocondabot@gmail.com"
+MAX_CLONE_DEPTH = 2000
+# Number of PR branches updated concurrently by the bulk update
+MAX_BULK_UPDATES = 4
 
-    # Setup git, otherwise we can't push
-    await git("config", "--global", "user.email", "biocondabot@gmail.com")
-    await git("config", "--global", "user.name", "BiocondaBot")
 
-    pr_info = await get_pr_info(session, pr)
-    remote_branch = pr_info["head"]["ref"]
-    remote_repo = pr_info["head"]["repo"]["full_name"]
-
-    max_depth = 2000
-    # Clone
-    await git(
-        "clone",
-        f"--depth={max_depth}",
-        f"--branch={remote_branch}",
-        f"git@github.com:{remote_repo}.git",
-        "bioconda-recipes",
-    )
+class UpdateStatus(Enum):
+    UPDATED = auto()
+    UP_TO_DATE = auto()
+    CONFLICT = auto()
+    FAILED = auto()
+
+
+# Upstream master can't be merged into the branch without resolving conflicts
+class MergeConflict(Exception):
+    pass
+
+
+async def git(*args: str) -> None:
+    return await async_exec("git", *args)
+
+
+# Merge upstream master into the branch in a bare clone and push the merge commit
+# The merge is computed with "git merge-tree --write-tree" (git >= 2.38), so no work tree is
+# ever checked out and only the blobs of the files that changed on both sides are fetched.
+# Without a full mirror, the last MAX_CLONE_DEPTH commits of both sides have to include the merge
+# base, like for the merge in a work tree. Returns None if the merge has conflicts or can't be
+# done this way.
+async def update_without_checkout(
+    tmpdir: str, remote_repo: str, remote_branch: str, mirror: Optional[UpstreamMirror]
+) -> Optional[UpdateStatus]:
+    repo = os.path.join(tmpdir, "bioconda-recipes.git")
+
+    async def git_r(*args: str) -> None:
+        return await git("--git-dir", repo, *args)
+
+    async def git_output(*args: str) -> Tuple[int, str]:
+        return await async_exec_output("git", "--git-dir", repo, *args)
+
+    start = time.monotonic()
+    upstream_ref = f"+refs/heads/{UPSTREAM_BRANCH}:refs/remotes/upstream/{UPSTREAM_BRANCH}"
+    if mirror and not mirror.depth:
+        await git(
+            "clone",
+            "--bare",
+            f"--reference={mirror.path}",
+            "--filter=blob:none",
+            "--single-branch",
+            f"--branch={remote_branch}",
+            f"git@github.com:{remote_repo}.git",
+            repo,
+        )
+        await git_r("fetch", mirror.path, upstream_ref)
+    else:
+        await git(
+            "clone",
+            "--bare",
+            f"--depth={MAX_CLONE_DEPTH}",
+            "--filter=blob:none",
+            "--single-branch",
+            f"--branch={remote_branch}",
+            f"git@github.com:{remote_repo}.git",
+            repo,
+        )
+        # A named remote, so the blobs merge-tree needs can be fetched from it on demand
+        await git_r("remote", "add", "upstream", mirror.url if mirror else UPSTREAM_URL)
+        await git_r("fetch", f"--depth={MAX_CLONE_DEPTH}", "--filter=blob:none", "upstream", upstream_ref)
+    log("Cloned %s (%s) without checkout in %.1fs", remote_repo, remote_branch, time.monotonic() - start)
+
+    branch = f"refs/heads/{remote_branch}"
+    upstream = f"refs/remotes/upstream/{UPSTREAM_BRANCH}"
+    _, head = await git_output("rev-parse", branch)
+    _, upstream_head = await git_output("rev-parse", upstream)
+    head, upstream_head = head.strip(), upstream_head.strip()
+
+    if (await git_output("merge-base", "--is-ancestor", upstream_head, head))[0] == 0:
+        log("%s (%s) is already up to date", remote_repo, remote_branch)
+        return UpdateStatus.UP_TO_DATE
+    if (await git_output("merge-base", "--is-ancestor", head, upstream_head))[0] == 0:
+        # Fast-forward, like "git merge" would
+        new_head = upstream_head
+    else:
+        start = time.monotonic()
+        return_code, output = await git_output("merge-tree", "--write-tree", head, upstream_head)
+        if return_code != 0:
+            # 1 means conflicts, anything else an older git without --write-tree or no merge base
+            # within the cloned history
+            log("merge-tree returned %d, falling back to a merge in a work tree", return_code)
+            return None
+        tree = output.split()[0]
+        env = {
+            **os.environ,
+            "GIT_AUTHOR_NAME": GIT_USER_NAME,
+            "GIT_AUTHOR_EMAIL": GIT_USER_EMAIL,
+            "GIT_COMMITTER_NAME": GIT_USER_NAME,
+            "GIT_COMMITTER_EMAIL": GIT_USER_EMAIL,
+        }
+        message = f"Merge remote-tracking branch 'upstream/{UPSTREAM_BRANCH}' into {remote_branch}"
+        return_code, output = await async_exec_output(
+            "git", "--git-dir", repo, "commit-tree", tree, "-p", head, "-p", upstream_head, "-m", message, env=env
+        )
+        if return_code != 0:
+            raise RuntimeError(f"git commit-tree failed (return code: {return_code})")
+        new_head = output.strip()
+        log("Merged upstream into %s (%s) in %.1fs", remote_repo, remote_branch, time.monotonic() - start)
+
+    start = time.monotonic()
+    await git_r("push", "origin", f"{new_head}:{branch}")
+    log("Pushed %s (%s) in %.1fs", remote_repo, remote_branch, time.monotonic() - start)
+    return UpdateStatus.UPDATED
+
+
+# Merge upstream master into the branch in a work tree and push it, raise MergeConflict on conflicts
+async def update_with_checkout(
+    tmpdir: str, remote_repo: str, remote_branch: str, mirror: Optional[UpstreamMirror]
+) -> UpdateStatus:
+    clone_dir = os.path.join(tmpdir, "bioconda-recipes")
 
     async def git_c(*args: str) -> None:
-        return await git("-C", "bioconda-recipes", *args)
+        return await git("-C", clone_dir, *args)
+
+    start = time.monotonic()
+    if mirror and not mirror.depth:
+        # Only the fork's own commits are transferred, blobs only when they're needed
+        await git(
+            "clone",
+            f"--reference={mirror.path}",
+            "--filter=blob:none",
+            "--single-branch",
+            f"--branch={remote_branch}",
+            f"git@github.com:{remote_repo}.git",
+            clone_dir,
+        )
+    else:
+        await git(
+            "clone",
+            f"--depth={MAX_CLONE_DEPTH}",
+            f"--branch={remote_branch}",
+            f"git@github.com:{remote_repo}.git",
+            clone_dir,
+        )
+    log("Cloned %s (%s) in %.1fs", remote_repo, remote_branch, time.monotonic() - start)
+
+    # Setup git in the clone only, otherwise we can't push
+    await git_c("config", "user.email", GIT_USER_EMAIL)
+    await git_c("config", "user.name", GIT_USER_NAME)
 
     # Add/pull upstream
-    await git_c("remote", "add", "upstream", "https://github.com/bioconda/bioconda-recipes")
-    await git_c("fetch", f"--depth={max_depth}", "upstream", "master")
+    start = time.monotonic()
+    if mirror and not mirror.depth:
+        # The mirror is up to date, so fetching from it is local
+        await git_c("remote", "add", "upstream", mirror.path)
+        await git_c("fetch", "upstream", UPSTREAM_BRANCH)
+    else:
+        await git_c("remote", "add", "upstream", mirror.url if mirror else UPSTREAM_URL)
+        await git_c("fetch", f"--depth={MAX_CLONE_DEPTH}", "upstream", UPSTREAM_BRANCH)
+    log("Fetched upstream master in %.1fs", time.monotonic() - start)
 
     # Merge
-    await git_c("merge", "upstream/master")
+    _, head = await async_exec_output("git", "-C", clone_dir, "rev-parse", "HEAD")
+    try:
+        await git_c("merge", f"upstream/{UPSTREAM_BRANCH}")
+    except RuntimeError as error:
+        raise MergeConflict(f"Merging upstream/{UPSTREAM_BRANCH} into {remote_branch} failed") from error
+    _, new_head = await async_exec_output("git", "-C", clone_dir, "rev-parse", "HEAD")
+    if new_head == head:
+        log("%s (%s) is already up to date", remote_repo, remote_branch)
+        return UpdateStatus.UP_TO_DATE
 
+    start = time.monotonic()
     await git_c("push")
+    log("Pushed %s (%s) in %.1fs", remote_repo, remote_branch, time.monotonic() - start)
+    return UpdateStatus.UPDATED
 
 
-# Merge the upstream master branch into a PR branch, leave a message on error
+# Return the refreshed upstream mirror, or None if it can't (or shouldn't) be used
+async def get_upstream_mirror_or_none() -> Optional[UpstreamMirror]:
+    if not mirror_enabled():
+        log("No persistent BIOCONDA_BOT_CACHE_DIR, using a shallow clone instead of the git mirror")
+        return None
+    try:
+        return await get_upstream_mirror()
+    except Exception as error:
+        log("Can't use the git mirror (%s), cloning without it", error)
+        return None
+
+
+# Return the upstream mirror for the updates of one run
+# Without the persistent mirror, upstream is fetched once into a temporary shallow one. If that
+# fails, the updates fetch upstream themselves.
+@asynccontextmanager
+async def get_run_mirror() -> AsyncIterator[Optional[UpstreamMirror]]:
+    mirror = await get_upstream_mirror_or_none()
+    if mirror:
+        yield mirror
+        return
+    async with AsyncExitStack() as stack:
+        try:
+            mirror = await stack.enter_async_context(temporary_upstream_mirror(MAX_CLONE_DEPTH))
+        except Exception as error:
+            log("Can't fetch upstream into a temporary mirror (%s), fetching it for each update", error)
+        yield mirror
+
+
+# Update the branch of a PR from upstream master, using an already refreshed mirror if there is one
+@traced
+async def update_pr_branch(session: ClientSession, pr: int, mirror: Optional[UpstreamMirror]) -> UpdateStatus:
+    pr_info = await get_pr_info(session, pr)
+    remote_branch = pr_info.head_ref
+    remote_repo = pr_info.head_repo
+
+    # Clone into a private directory, so concurrent updates (e.g., in the webhook server) don't clash
+    with TemporaryDirectory() as tmpdir:
+        async with AsyncExitStack() as stack:
+            if mirror:
+                await stack.enter_async_context(mirror.shared())
+            status = await update_without_checkout(tmpdir, remote_repo, remote_branch, mirror)
+            if status is not None:
+                return status
+            return await update_with_checkout(tmpdir, remote_repo, remote_branch, mirror)
+
+
+# Update a branch from upstream master, this should be run in a try/catch
+async def update_from_master_runner(session: ClientSession, pr: int) -> UpdateStatus:
+    return await update_pr_branch(session, pr, await get_upstream_mirror_or_none())
+
+
+# Merge the upstream master branch into a PR branch, leave a message on error and re-raise it
+@traced
 async def update_from_master(session: ClientSession, pr: int) -> None:
     try:
         await update_from_master_runner(session, pr)
-    except Exception as e:
+    except Exception:
         await send_comment(
             session,
             pr,
             "I encountered an error updating your PR branch. You can report this to bioconda/core if you'd like.\n-The Bot",
         )
-        sys.exit(1)
+        raise
+
+
+# Outcome of updating one PR in a bulk update
+class UpdateResult:
+    __slots__ = ("pr", "status", "error", "duration")
+
+    def __init__(self, pr: int) -> None:
+        self.pr = pr
+        self.status = UpdateStatus.FAILED
+        self.error: Optional[str] = None
+        self.duration = 0.0
+
+    def __str__(self) -> str:
+        error = f" ({self.error})" if self.error else ""
+        return f"PR {self.pr}: {self.status.name}{error} in {self.duration:.1f}s"
+
+
+# Update the branches of many PRs from upstream master
+# Upstream is fetched once into the persistent or a temporary mirror, which all the updates then
+# share. Failures are only reported, no comments are left on the PRs.
+@traced
+async def update_many(
+    session: ClientSession, prs: Iterable[int], max_workers: int = MAX_BULK_UPDATES
+) -> List[UpdateResult]:
+    start = time.monotonic()
+    results = [UpdateResult(pr) for pr in sorted(set(prs))]
+    slots = Semaphore(max_workers)
+
+    async def update(result: UpdateResult, mirror: Optional[UpstreamMirror]) -> None:
+        async with slots:
+            pr_start = time.monotonic()
+            try:
+                result.status = await update_pr_branch(session, result.pr, mirror)
+            except MergeConflict:
+                result.status = UpdateStatus.CONFLICT
+            except Exception as error:
+                logger.exception("Bulk update: updating PR %d failed", result.pr)
+                result.error = str(error)
+            result.duration = time.monotonic() - pr_start
+
+    async with get_run_mirror() as mirror:
+        await gather(*(update(result, mirror) for result in results))
+
+    for result in results:
+        log("Bulk update: %s", result)
+    counts = ", ".join(
+        f"{sum(result.status is status for result in results)} {status.name.lower()}" for status in UpdateStatus
+    )
+    log("Bulk update: %d PRs in %.1fs: %s", len(results), time.monotonic() - start, counts)
+    return results
+
+
+async def bulk_main(prs: List[int], label: Optional[str], max_workers: int) -> None:
+    async with create_session() as session:
+        if label:
+            prs = [*prs, *await list_labeled_prs(session, label)]
+        results = await update_many(session, prs, max_workers)
+    if any(result.status is UpdateStatus.FAILED for result in results):
+        raise SystemExit("Some PR branches could not be updated")
 
 
 # This requires that a JOB_CONTEXT environment variable, which is made with `toJson(github)`
 async def main() -> None:
     job_context = await get_job_context()
+    async with create_session() as session:
+        await handle(session, job_context)
+
+
+# Respond to one event, this is shared by main and the webhook server
+async def handle(session: ClientSession, job_context: JobContext) -> None:
     issue_number, original_comment = await get_pr_comment(job_context)
     if issue_number is None or original_comment is None:
         return
@@ -74,5 +351,4 @@ async def main() -> None:
     comment = original_comment.lower()
     if comment.startswith(("@bioconda-bot", "@biocondabot")):
         if "please update" in comment:
-            async with ClientSession() as session:
-                await update_from_master(session, issue_number)
+            await update_from_master(session, issue_number)
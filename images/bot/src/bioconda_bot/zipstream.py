@@ -0,0 +1,67 @@
+import logging
+import os
+import shutil
+from asyncio import get_running_loop, wait
+from typing import Dict, Optional
+from zipfile import ZipFile, ZipInfo
+
+from .common import async_exec
+
+logger = logging.getLogger(__name__)
+log = logger.info
+
+# Buffer size for copying zip members, bounds the memory used per stream
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+
+def copy_member(zf: ZipFile, e: ZipInfo, path: str) -> None:
+    with zf.open(e) as src, open(path, "wb") as dst:
+        shutil.copyfileobj(src, dst, STREAM_BUFFER_SIZE)
+
+
+# Write a zip member to path without keeping the directory structure of the zip file
+# Use this for tools that need a seekable file, the caller removes it.
+async def extract_member(zf: ZipFile, e: ZipInfo, path: str) -> str:
+    await get_running_loop().run_in_executor(None, copy_member, zf, e, path)
+    return path
+
+
+# Run a command that reads a zip member from fifo_path
+# The member is decompressed from the zip straight into a named pipe instead of being extracted
+# first. The command must read the file sequentially and only once, it may still spool the data to
+# a temporary file of its own (skopeo does that for compressed docker-archives).
+async def exec_with_member_fifo(
+    zf: ZipFile,
+    e: ZipInfo,
+    fifo_path: str,
+    command: str,
+    *arguments: str,
+    env: Optional[Dict[str, str]] = None,
+) -> None:
+    os.mkfifo(fifo_path)
+    try:
+        # Opening and writing the FIFO blocks until the command reads it => use a thread
+        writer = get_running_loop().run_in_executor(None, copy_member, zf, e, fifo_path)
+        try:
+            await async_exec(command, *arguments, env=env)
+        finally:
+            # Unblock the writer in case the command never opened the FIFO. The writer might not
+            # have reached open() yet (e.g., while other copies keep the executor busy), so repeat
+            # this until it's done.
+            while not writer.done():
+                try:
+                    os.close(os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+                await wait({writer}, timeout=0.1)
+            try:
+                await writer
+            except OSError as error:
+                # Only report this if the command succeeded, otherwise its error is more useful
+                writer_error: Optional[OSError] = error
+            else:
+                writer_error = None
+        if writer_error:
+            raise RuntimeError(f"{command} did not read all of {e.filename}: {writer_error}")
+    finally:
+        os.remove(fifo_path)
@@ -0,0 +1,113 @@
+# Splitting artifact tables into comments and updating the bot's comments in place
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+from bioconda_bot import comment
+from bioconda_bot.comment import (
+    CONTINUED_NOTE,
+    MAX_COMMENT_SIZE,
+    artifact_comment_marker,
+    split_comment,
+    upsert_artifact_comments,
+)
+
+HEADER = "Arch | Package\n-----|--------\n"
+
+
+# Return the rows of the comments, without the headers and continuation notes
+def split_rows(comments: List[str]) -> List[str]:
+    rows = []
+    for body in comments:
+        if body.startswith(CONTINUED_NOTE):
+            body = body[len(CONTINUED_NOTE):]
+        assert body.startswith(HEADER)
+        rows.extend(body[len(HEADER):].splitlines(keepends=True))
+    return rows
+
+
+def test_split_comment_fits_into_one():
+    rows = ["linux-64 | a\n", "osx-64 | b\n"]
+    assert split_comment([(HEADER, rows)]) == [HEADER + "".join(rows)]
+
+
+def test_split_comment_at_the_size_limit():
+    max_size = 1000
+    # Rows that exactly fill a continued comment, rows one character too long and short rows
+    exact = max_size - len(CONTINUED_NOTE) - len(HEADER)
+    rows = [f"{i:04d}".ljust(size - 1, "x") + "\n" for i, size in enumerate([exact, exact + 1, 10, exact, 10] * 3)]
+    comments = split_comment([(HEADER, rows)], max_size=max_size, max_comments=100)
+    assert all(len(body) <= max_size for body in comments)
+    assert all(body.startswith(CONTINUED_NOTE + HEADER) for body in comments[1:])
+    split = split_rows(comments)
+    assert len(split) == len(rows)
+    for row, original in zip(split, rows):
+        if len(original) > exact:
+            assert len(row) <= exact and row.endswith("…\n") and original.startswith(row[:-2])
+        else:
+            assert row == original
+
+
+def test_split_comment_starts_a_new_comment_for_a_header_that_does_not_fit():
+    max_size = 200
+    rows = ["x" * (max_size - len(CONTINUED_NOTE) - len(HEADER) - 10) + "\n"]
+    comments = split_comment([(HEADER, rows), (HEADER, ["y\n"])], max_size=max_size)
+    assert comments == [HEADER + rows[0], HEADER + "y\n"]
+
+
+def test_split_comment_omits_rows_beyond_max_comments():
+    rows = [f"{i:03d}".ljust(99, "x") + "\n" for i in range(100)]
+    comments = split_comment([(HEADER, rows)], max_size=1000, max_comments=2)
+    assert len(comments) == 2
+    kept = len(split_rows([comments[0], comments[1][: comments[1].rindex("\n_")]]))
+    assert comments[-1].endswith(f"_{len(rows) - kept} more row(s) omitted, the CI builds list all artifacts._\n")
+
+
+def test_split_comment_with_marker_fits_github_limit():
+    rows = [f"{i:05d} | ".ljust(299, "x") + "\n" for i in range(2000)]
+    sha = "0" * 40
+    comments = split_comment([(HEADER, rows)])
+    assert len(comments) > 1
+    assert all(len(artifact_comment_marker(sha, part) + body) <= MAX_COMMENT_SIZE for part, body in enumerate(comments))
+
+
+class FakeGitHub:
+    async def get_login(self) -> Optional[str]:
+        return "BiocondaBot"
+
+
+def test_upsert_artifact_comments(monkeypatch):
+    sha = "abc123"
+    existing = [
+        {"id": 1, "user": {"login": "BiocondaBot"}, "body": artifact_comment_marker(sha, 0) + "same"},
+        {"id": 2, "user": {"login": "BiocondaBot"}, "body": artifact_comment_marker(sha, 1) + "old"},
+        {"id": 3, "user": {"login": "BiocondaBot"}, "body": artifact_comment_marker(sha, 2) + "gone"},
+        # Someone else quoting the marker, this must not be touched
+        {"id": 4, "user": {"login": "someone"}, "body": artifact_comment_marker(sha, 0) + "quote"},
+        {"id": 5, "user": {"login": "BiocondaBot"}, "body": "Something else"},
+    ]
+    calls: List[Tuple[Any, ...]] = []
+
+    async def get_issue_comments(session: Any, pr: int) -> List[Dict[str, Any]]:
+        return existing
+
+    async def edit_comment(session: Any, comment_id: int, body: str) -> None:
+        calls.append(("edit", comment_id, body))
+
+    async def send_comment(session: Any, pr: int, body: str) -> None:
+        calls.append(("send", pr, body))
+
+    async def delete_comment(session: Any, comment_id: int) -> None:
+        calls.append(("delete", comment_id))
+
+    monkeypatch.setattr(comment, "get_github", lambda session: FakeGitHub())
+    monkeypatch.setattr(comment, "get_issue_comments", get_issue_comments)
+    monkeypatch.setattr(comment, "edit_comment", edit_comment)
+    monkeypatch.setattr(comment, "send_comment", send_comment)
+    monkeypatch.setattr(comment, "delete_comment", delete_comment)
+
+    asyncio.run(upsert_artifact_comments(None, 42, sha, ["same", "new"]))
+    assert calls == [("edit", 2, artifact_comment_marker(sha, 1) + "new"), ("delete", 3)]
+
+    calls.clear()
+    asyncio.run(upsert_artifact_comments(None, 42, sha, ["same", "old", "gone", "more"]))
+    assert calls == [("send", 42, artifact_comment_marker(sha, 3) + "more")]
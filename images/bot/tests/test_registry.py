@@ -0,0 +1,202 @@
+# Push docker-archives to a minimal in-process registry
+# Set BIOCONDA_BOT_TEST_REGISTRY to push to a real one instead, e.g., one started with
+#   docker run -d -p 5000:5000 registry:2
+#   BIOCONDA_BOT_TEST_REGISTRY=http://localhost:5000 python -m pytest
+import asyncio
+import gzip
+import io
+import json
+import os
+import tarfile
+from hashlib import sha256
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+from zipfile import ZipFile
+
+from aiohttp import web
+
+from bioconda_bot.common import create_session
+from bioconda_bot.registry import GZIP_LAYER_MEDIA_TYPE, push_docker_archive, spool_layer
+from bioconda_bot.scheduler import request
+
+TEST_REGISTRY = os.environ.get("BIOCONDA_BOT_TEST_REGISTRY")
+
+
+# Just enough of the Docker Registry HTTP API V2 for pushes, without authentication
+class Registry:
+    def __init__(self) -> None:
+        # Repository -> digest -> blob
+        self.blobs: Dict[str, Dict[str, bytes]] = {}
+        self.manifests: Dict[Tuple[str, str], bytes] = {}
+        self.mounts: List[Tuple[str, str]] = []
+        self.app = web.Application(client_max_size=1024 ** 3)
+        repository = r"{repository:.+?}"
+        self.app.add_routes(
+            [
+                web.get("/v2/", self.base),
+                web.head(f"/v2/{repository}/blobs/{{digest}}", self.head_blob),
+                web.post(f"/v2/{repository}/blobs/uploads/", self.start_upload),
+                web.put(f"/v2/{repository}/blobs/uploads/{{upload}}", self.upload),
+                web.put(f"/v2/{repository}/manifests/{{tag}}", self.put_manifest),
+                web.get(f"/v2/{repository}/manifests/{{tag}}", self.get_manifest),
+            ]
+        )
+
+    async def base(self, req: web.Request) -> web.Response:
+        return web.Response()
+
+    async def head_blob(self, req: web.Request) -> web.Response:
+        blobs = self.blobs.get(req.match_info["repository"], {})
+        return web.Response(status=200 if req.match_info["digest"] in blobs else 404)
+
+    async def start_upload(self, req: web.Request) -> web.Response:
+        repository = req.match_info["repository"]
+        digest, source = req.query.get("mount"), req.query.get("from")
+        if digest and digest in self.blobs.get(source or "", {}):
+            self.blobs.setdefault(repository, {})[digest] = self.blobs[source][digest]
+            self.mounts.append((repository, digest))
+            return web.Response(status=201)
+        return web.Response(status=202, headers={"Location": f"/v2/{repository}/blobs/uploads/{uuid4().hex}"})
+
+    async def upload(self, req: web.Request) -> web.Response:
+        data = await req.read()
+        digest = req.query["digest"]
+        if digest != f"sha256:{sha256(data).hexdigest()}":
+            return web.Response(status=400, text="digest mismatch")
+        self.blobs.setdefault(req.match_info["repository"], {})[digest] = data
+        return web.Response(status=201)
+
+    async def put_manifest(self, req: web.Request) -> web.Response:
+        self.manifests[req.match_info["repository"], req.match_info["tag"]] = await req.read()
+        return web.Response(status=201)
+
+    async def get_manifest(self, req: web.Request) -> web.Response:
+        manifest = self.manifests.get((req.match_info["repository"], req.match_info["tag"]))
+        if manifest is None:
+            return web.Response(status=404)
+        return web.Response(body=manifest, content_type="application/json")
+
+
+def make_layer(name: str, size: int) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        tar.addfile(info, io.BytesIO(os.urandom(size)))
+    return buffer.getvalue()
+
+
+# Write a gzipped "docker save" archive of an image with these layers into a zip file
+def make_archive_zip(path: str, member: str, layers: List[bytes]) -> None:
+    diff_ids = [f"sha256:{sha256(layer).hexdigest()}" for layer in layers]
+    config = json.dumps({"architecture": "amd64", "os": "linux", "rootfs": {"type": "layers", "diff_ids": diff_ids}}).encode()
+    files: Dict[str, bytes] = {f"{diff_id[7:]}/layer.tar": layer for diff_id, layer in zip(diff_ids, layers)}
+    files["config.json"] = config
+    files["manifest.json"] = json.dumps(
+        [{"Config": "config.json", "RepoTags": [], "Layers": [f"{diff_id[7:]}/layer.tar" for diff_id in diff_ids]}]
+    ).encode()
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    with ZipFile(path, "w") as zf:
+        zf.writestr(member, gzip.compress(buffer.getvalue()))
+
+
+# Push the images of the zip files one after the other with one session, like the bot does
+# Returns the bytes uploaded and the manifest of each push.
+async def push_all(
+    registry_url: str, pushes: List[Tuple[str, str]], spool_dir: str
+) -> List[Tuple[int, Dict[str, Any]]]:
+    results = []
+    async with create_session() as session:
+        for path, repository in pushes:
+            with ZipFile(path) as zf:
+                (e,) = zf.infolist()
+                uploaded = await push_docker_archive(session, zf, e, repository, "1", spool_dir)
+            async with request(
+                session,
+                "GET",
+                f"{registry_url}/v2/{repository}/manifests/1",
+                headers={"Accept": "application/vnd.docker.distribution.manifest.v2+json"},
+            ) as response:
+                assert response.status == 200
+                results.append((uploaded, await response.json(content_type=None)))
+    return results
+
+
+async def run_pushes(
+    pushes: List[Tuple[str, str]], spool_dir: str, registry: Optional[Registry], monkeypatch
+) -> List[Tuple[int, Dict[str, Any]]]:
+    if registry is None:
+        monkeypatch.setenv("BIOCONDA_BOT_REGISTRY", TEST_REGISTRY)
+        return await push_all(TEST_REGISTRY, pushes, spool_dir)
+    runner = web.AppRunner(registry.app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        registry_url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        monkeypatch.setenv("BIOCONDA_BOT_REGISTRY", registry_url)
+        return await push_all(registry_url, pushes, spool_dir)
+    finally:
+        await runner.cleanup()
+
+
+def blob_sizes(manifest: Dict[str, Any]) -> int:
+    return manifest["config"]["size"] + sum(layer["size"] for layer in manifest["layers"])
+
+
+def test_spool_layer_is_deterministic(tmp_path):
+    layer = make_layer("layer", 100 * 1024)
+    first = spool_layer(io.BytesIO(layer), str(tmp_path / "first"))
+    second = spool_layer(io.BytesIO(layer), str(tmp_path / "second"))
+    assert first.digest == second.digest
+    assert first.media_type == GZIP_LAYER_MEDIA_TYPE
+    with gzip.open(first.path) as fd:
+        assert fd.read() == layer
+    # Layers that are compressed already are kept as they are
+    data = gzip.compress(layer)
+    compressed = spool_layer(io.BytesIO(data), str(tmp_path / "compressed"))
+    assert compressed.digest == f"sha256:{sha256(data).hexdigest()}"
+
+
+def test_push_skips_and_mounts_shared_layers(tmp_path, monkeypatch):
+    monkeypatch.setenv("BIOCONDA_BOT_CACHE_DIR", str(tmp_path / "cache"))
+    registry = None if TEST_REGISTRY else Registry()
+    base = make_layer("base", 2 * 1024 * 1024)
+    first = make_layer("first", 1024 * 1024 + 1)
+    second = make_layer("second", 1024)
+    prefix = f"bioconda-bot-test-{uuid4().hex[:8]}"
+    spool_dir = tmp_path / "spool"
+    spool_dir.mkdir()
+    make_archive_zip(str(tmp_path / "one.zip"), "images/one.tar.gz", [base, first])
+    make_archive_zip(str(tmp_path / "two.zip"), "images/two.tar.gz", [base, second])
+
+    (one, (again, _), two) = asyncio.run(
+        run_pushes(
+            [
+                (str(tmp_path / "one.zip"), f"{prefix}/one"),
+                (str(tmp_path / "one.zip"), f"{prefix}/one"),
+                (str(tmp_path / "two.zip"), f"{prefix}/two"),
+            ],
+            str(spool_dir),
+            registry,
+            monkeypatch,
+        )
+    )
+    # Everything is uploaded the first time, the layers compressed
+    uploaded, manifest = one
+    assert uploaded == blob_sizes(manifest)
+    assert all(layer["mediaType"] == GZIP_LAYER_MEDIA_TYPE for layer in manifest["layers"])
+    # Pushing the same image again doesn't send anything
+    assert again == 0
+    # The base layer gets the same digest and is mounted from the first repository
+    uploaded, manifest_two = two
+    base_layer = manifest["layers"][0]
+    assert manifest_two["layers"][0]["digest"] == base_layer["digest"]
+    assert uploaded == blob_sizes(manifest_two) - base_layer["size"]
+    if registry is not None:
+        assert registry.mounts == [(f"{prefix}/two", base_layer["digest"])]
@@ -0,0 +1,91 @@
+# List the contents of zip files served with (and without) Range support by a local server
+import asyncio
+import io
+import re
+from typing import List, Optional
+from zipfile import ZipFile
+
+from aiohttp import web
+
+from bioconda_bot.common import create_session
+from bioconda_bot.remote_zip import (
+    EOCD_MAX_SEARCH,
+    list_remote_zip_contents,
+    parse_central_directory,
+    parse_central_directory_location,
+)
+
+
+def make_zip(names: List[str], comment: bytes = b"") -> bytes:
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w") as zf:
+        for name in names:
+            zf.writestr(name, name.encode())
+        zf.comment = comment
+    return buffer.getvalue()
+
+
+# Serve data at /file.zip, answering Range requests with the requested slice
+def make_app(data: bytes, ranges: bool = True) -> web.Application:
+    async def handle(req: web.Request) -> web.Response:
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", req.headers.get("Range", ""))
+        if not ranges or not match:
+            return web.Response(body=data)
+        start, end = match.groups()
+        if not start:
+            # Suffix range
+            start, end = max(len(data) - int(end), 0), len(data) - 1
+        else:
+            start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+        return web.Response(
+            status=206,
+            body=data[start:end + 1],
+            headers={"Content-Range": f"bytes {start}-{end}/{len(data)}"},
+        )
+
+    app = web.Application()
+    app.router.add_get("/file.zip", handle)
+    return app
+
+
+async def list_served_zip(data: bytes, ranges: bool = True) -> Optional[List[str]]:
+    runner = web.AppRunner(make_app(data, ranges))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    try:
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}/file.zip"
+        async with create_session() as session:
+            return await list_remote_zip_contents(session, url)
+    finally:
+        await runner.cleanup()
+
+
+def test_parse_small_zip():
+    names = ["a.txt", "dir/b.tar.bz2", "ünïcode.conda"]
+    data = make_zip(names, comment=b"some comment")
+    cd_offset, cd_size = parse_central_directory_location(data, 0)
+    assert parse_central_directory(data[cd_offset:cd_offset + cd_size]) == names
+
+
+def test_list_small_zip():
+    names = ["a.txt", "dir/b.tar.bz2"]
+    assert asyncio.run(list_served_zip(make_zip(names))) == names
+
+
+def test_list_zip_with_central_directory_outside_the_tail():
+    names = [f"linux-64/package-{i}-{'x' * 200}.tar.bz2" for i in range(500)]
+    data = make_zip(names)
+    assert len(data) > 2 * EOCD_MAX_SEARCH
+    assert asyncio.run(list_served_zip(data)) == names
+
+
+def test_list_zip64():
+    # More than 0xFFFF entries make zipfile write the zip64 end of central directory records
+    names = [f"{i}" for i in range(0x10000 + 1)]
+    data = make_zip(names)
+    assert b"PK\x06\x06" in data[-EOCD_MAX_SEARCH:]
+    assert asyncio.run(list_served_zip(data)) == names
+
+
+def test_list_without_range_support():
+    assert asyncio.run(list_served_zip(make_zip(["a.txt"]), ranges=False)) is None